@@ -1,12 +1,25 @@
-from flask import Flask, render_template, jsonify, redirect, url_for, request
+from flask import Flask, Response, g, render_template, jsonify, redirect, url_for, request
+import numpy as np
 import pandas as pd
-from ib_client import IBClient
-import asyncio
-import plotly.graph_objects as go
+from aws_dynamo import MarketDataStore
+from bar_cache import BarCache, window_bounds
+from ingest_bus import bus_from_env
+from contracts import default_contracts, load_universe
+from ib_pool import pool_from_env
+from pacing import default_scheduler
+from live_feed import LiveFeed
+from bar_store import PRICE_COLUMNS, to_epoch_ns
+from resample import TIMEFRAMES, resample_arrays
+from payloads import FORMATS, bars_etag, encode_bars, gzip_body
+from chart_cache import RenderCache, etag_for, frame_key, plotly_bundle
+from downsample import CANDLE_PIXELS, LINE_PIXELS, lttb, lttb_indices, ohlc_downsample, points_for_width
+from metrics import REGISTRY, SamplingProfiler, timed
 from datetime import datetime, timedelta
 import random
-from pytz import timezone
 import os
+import sys
+import threading
+import time
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -15,86 +28,289 @@ load_dotenv()
 # Get timezone from .env
 APP_TIMEZONE = os.getenv('APP_TIMEZONE', 'UTC')  # Default to UTC if not set
 
+# Width in pixels the dashboard charts are downsampled for unless ?width= or ?max_points= is given
+CHART_WIDTH = int(os.getenv('CHART_WIDTH', '1600'))
+
 app = Flask(__name__)
 
+# SYMBOL_UNIVERSE (a symbol list or a file of symbols) is qualified in the background once the
+# IB pool is created, so searches and fetches over it never wait on a contract round trip
+SYMBOL_UNIVERSE = load_universe(os.getenv('SYMBOL_UNIVERSE', ''))
+
+# The store, bar cache, IB pool and live feed are created by the first request that needs them,
+# so importing the app opens no store file and starts no thread
+_bar_cache = None
+_ib_pool = None
+_live_feed = None
+_setup_lock = threading.RLock()
+
+def get_bar_cache():
+    """
+    The bar cache shared across requests, so bars fetched by one are served locally to the next.
+    Fetched bars reach the store and InfluxDB through the ingest bus, off the request path.
+    """
+    global _bar_cache
+    if _bar_cache is None:
+        with _setup_lock:
+            if _bar_cache is None:
+                _bar_cache = BarCache(MarketDataStore(), bus=bus_from_env())
+    return _bar_cache
+
+def get_ib_pool():
+    """Long-lived IB connections on their own event loop thread, borrowed by every route."""
+    global _ib_pool
+    if _ib_pool is None:
+        with _setup_lock:
+            if _ib_pool is None:
+                pool = pool_from_env(get_bar_cache())
+                if SYMBOL_UNIVERSE:
+                    threading.Thread(
+                        target=lambda: pool.run(lambda client: client.contracts.hydrate_async(client.ib, SYMBOL_UNIVERSE, refresh=True)),
+                        name='contract-hydration', daemon=True
+                    ).start()
+                _ib_pool = pool
+    return _ib_pool
+
+def get_live_feed():
+    """One upstream bar subscription per symbol, fanned out to every /api/stream listener."""
+    global _live_feed
+    if _live_feed is None:
+        with _setup_lock:
+            if _live_feed is None:
+                _live_feed = LiveFeed(get_ib_pool())
+    return _live_feed
+
+# Rendered figure HTML per (symbol, resolution, latest bar), and whole pages per symbol set
+figure_cache = RenderCache()
+page_cache = RenderCache(max_entries=8)
+
+# Where /api/spy-data reads history unless ?source= is given: 'ib' (the bar cache, then IB) or
+# 'influx' (one columnar query with the aggregation done by InfluxDB)
+HISTORY_SOURCE = os.getenv('HISTORY_SOURCE', 'ib')
+
+# ?_profile=1 returns a sampled profile of the request instead of its body when this is enabled
+PROFILE_REQUESTS = os.getenv('PROFILE_REQUESTS', '0') == '1'
+# Threads sampled along with the request's own: the IB pool loop by default, '*' for every thread
+PROFILE_THREADS = tuple(name for name in os.getenv('PROFILE_THREADS', 'ib-pool').split(',') if name)
+
+REQUEST_SECONDS = REGISTRY.histogram('http_request_seconds', 'Flask request handling time per endpoint.')
+
+def _caches():
+    caches = {'bars': _bar_cache, 'figures': figure_cache, 'pages': page_cache, 'contracts': default_contracts}
+    return {name: cache for name, cache in caches.items() if cache is not None}  # The bar cache once created
+
+def _cache_counts(attribute):
+    caches = _caches()
+    return [({'cache': name}, getattr(cache, attribute)) for name, cache in caches.items()]
+
+def _hit_ratios():
+    caches = _caches()
+    return [({'cache': name}, cache.hits / (cache.hits + cache.misses) if cache.hits + cache.misses else float('nan'))
+            for name, cache in caches.items()]
+
+def _queue_depths():
+    depths = [({'queue': 'live_feed'}, _live_feed.queue_depth())] if _live_feed is not None else []
+    influx = sys.modules.get('influxdb_handler')  # Only reported once something has imported it
+    if influx is not None and influx._write_pipeline is not None:
+        depths.append(({'queue': 'influx_write'}, influx._write_pipeline.pending))
+    if _ib_pool is not None and _ib_pool._idle is not None:
+        depths.append(({'queue': 'ib_pool_idle_clients'}, _ib_pool._idle.qsize()))
+    return depths
+
+def _influx_lines():
+    influx = sys.modules.get('influxdb_handler')
+    pipeline = influx._write_pipeline if influx is not None else None
+    if pipeline is None:
+        return []
+    return [({'outcome': 'written'}, pipeline.lines_written), ({'outcome': 'dropped'}, pipeline.lines_dropped)]
+
+REGISTRY.counter('cache_hits_total', 'Cache lookups served from cache.', lambda: _cache_counts('hits'))
+REGISTRY.counter('cache_misses_total', 'Cache lookups that had to fetch or render.', lambda: _cache_counts('misses'))
+REGISTRY.gauge('cache_hit_ratio', 'Hits over lookups since start.', _hit_ratios)
+REGISTRY.gauge('queue_depth', 'Items waiting in in-process queues.', _queue_depths)
+REGISTRY.counter('influx_lines_total', 'Line protocol lines handled by the InfluxDB write pipeline.', _influx_lines)
+REGISTRY.counter('ib_pacing_waits_total', 'IB requests the pacing scheduler had to delay.', lambda: (_ib_pool and _ib_pool.pacing or default_scheduler).waits)
+REGISTRY.counter('ib_pool_connects_total', 'IB connections opened by the pool, including reconnects.', lambda: _ib_pool.connects if _ib_pool is not None else 0)
+REGISTRY.counter('live_feed_messages_total', 'Server-sent bar messages.', lambda: [
+    ({'outcome': 'sent'}, _live_feed.messages_sent), ({'outcome': 'dropped'}, _live_feed.messages_dropped)
+] if _live_feed is not None else [])
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if PROFILE_REQUESTS and request.args.get('_profile') == '1':
+        g.profiler = SamplingProfiler(threads=PROFILE_THREADS).start()
+
+@app.after_request
+def record_request(response):
+    REQUEST_SECONDS.observe(time.perf_counter() - g.request_started, endpoint=request.endpoint or 'unknown')
+    profiler = g.pop('profiler', None)
+    if profiler is not None and not response.is_streamed:
+        profiler.stop()
+        # Folded stacks, e.g. for flamegraph.pl or speedscope
+        return Response(profiler.collapsed(), mimetype='text/plain', headers={'X-Profile-Samples': str(profiler.samples)})
+    if profiler is not None:
+        profiler.stop()
+    return response
+
+def requested_points(pixels_per_point, default_width=None):
+    """Point budget from ?max_points= or ?width= (in pixels); None means no downsampling."""
+    max_points = request.args.get('max_points', type=int)
+    if max_points:
+        return max(max_points, 3)
+    width = request.args.get('width', default_width, type=int)
+    return points_for_width(width, pixels_per_point) if width else None
+
+def render_symbol_chart(symbol, symbol_data, max_points):
+    """Build the candlestick figure for one symbol and return its HTML (without plotly.js)."""
+    import plotly.graph_objects as go  # Loaded by the first render, not at startup
+    # Moving averages are maintained by the bar cache; compute them only if they are missing
+    symbol_data = symbol_data.copy()
+    for window in (20, 50):
+        column = f'sma{window}'
+        if column in symbol_data and symbol_data[column].notna().any():
+            symbol_data[f'MA{window}'] = symbol_data[column]
+        else:
+            symbol_data[f'MA{window}'] = symbol_data['close'].rolling(window=window).mean()
+
+    # Long ranges are re-bucketed into coarser candles so the chart size doesn't grow with them
+    symbol_data = ohlc_downsample(symbol_data, max_points)
+
+    # Create candlestick chart with moving averages and volume overlay
+    fig = go.Figure(data=[
+        go.Candlestick(
+            x=symbol_data['timestamp'],
+            open=symbol_data['open'],
+            high=symbol_data['high'],
+            low=symbol_data['low'],
+            close=symbol_data['close'],
+            name='Candlestick'
+        ),
+        go.Scatter(
+            x=symbol_data['timestamp'],
+            y=symbol_data['MA20'],
+            mode='lines',
+            line=dict(color='blue', width=1),
+            name='20-day MA'
+        ),
+        go.Scatter(
+            x=symbol_data['timestamp'],
+            y=symbol_data['MA50'],
+            mode='lines',
+            line=dict(color='red', width=1),
+            name='50-day MA'
+        )
+    ])
+
+    # Add volume as a bar chart
+    fig.add_trace(go.Bar(
+        x=symbol_data['timestamp'],
+        y=symbol_data['volume'],
+        name='Volume',
+        marker_color='lightgray',
+        yaxis='y2'
+    ))
+
+    # Update layout for dual y-axis and interactivity
+    fig.update_layout(
+        title=f'Advanced Candlestick Chart for {symbol}',
+        xaxis_title='Timestamp',
+        yaxis_title='Price',
+        yaxis2=dict(
+            title='Volume',
+            overlaying='y',
+            side='right'
+        ),
+        xaxis_rangeslider_visible=False,
+        dragmode='pan'  # Enable mouse drag and zoom
+    )
+    with timed('chart_serialize'):
+        return fig.to_html(full_html=False, include_plotlyjs=False)
+
+def influx_history(symbol, duration, timeframe=None):
+    """Epoch-ns timestamps and closes of the window from InfluxDB, in `timeframe` candles if given."""
+    from influx_query import get_reader  # Needs the InfluxDB client, so only loaded when used
+    start, _ = window_bounds(duration)
+    bars = get_reader().arrays(symbol, start, timeframe=timeframe)
+    return bars['timestamp'], bars['close']
+
+def ib_history(symbol, duration, timeframe=None):
+    """The same from the bar cache (fetching from IB on a miss), resampled locally."""
+    data = get_ib_pool().run(lambda client: client.fetch_historical_data_async(symbol, duration=duration, bar_size='1 min'))
+    if data.empty:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+    if timeframe is not None:
+        candles = resample_arrays(to_epoch_ns(data['timestamp']), *(data[name].to_numpy() for name in PRICE_COLUMNS), timeframe)
+        return candles['timestamp'], candles['close']
+    return to_epoch_ns(data['timestamp']), data['close'].to_numpy(dtype=np.float64)
+
+def timed_render(symbol, symbol_data, max_points):
+    with timed('chart_render'):
+        return render_symbol_chart(symbol, symbol_data, max_points)
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus text exposition of the in-process metrics."""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def index():
-    # Create a new asyncio event loop for the current thread
-    asyncio.set_event_loop(asyncio.new_event_loop())
-    loop = asyncio.get_event_loop()
-
-    # Fetch data using IBClient
-    ib_client = IBClient()
+    # Fetch data with a pooled IBClient
     symbols = ['SPY', 'QQQ']
-    combined_data = ib_client.fetch_multiple_symbols(symbols)
+    combined_data = get_ib_pool().run(lambda client: client.fetch_multiple_symbols_async(symbols))
 
-    # Create candlestick charts for each symbol
-    figures = []
+    # Figures and the page are only rebuilt when a symbol's latest bar changes
+    max_points = requested_points(CANDLE_PIXELS, CHART_WIDTH)
+    figures, keys = [], []
     for symbol in symbols:
         symbol_data = combined_data[combined_data['symbol'] == symbol]
+        key = (symbol, max_points, frame_key(symbol_data))
+        keys.append(key)
+        figures.append(figure_cache.get_or_render(key, lambda: timed_render(symbol, symbol_data, max_points)))
 
-        # Calculate moving averages
-        symbol_data['MA20'] = symbol_data['close'].rolling(window=20).mean()
-        symbol_data['MA50'] = symbol_data['close'].rolling(window=50).mean()
-
-        # Create candlestick chart with moving averages and volume overlay
-        fig = go.Figure(data=[
-            go.Candlestick(
-                x=symbol_data['timestamp'],
-                open=symbol_data['open'],
-                high=symbol_data['high'],
-                low=symbol_data['low'],
-                close=symbol_data['close'],
-                name='Candlestick'
-            ),
-            go.Scatter(
-                x=symbol_data['timestamp'],
-                y=symbol_data['MA20'],
-                mode='lines',
-                line=dict(color='blue', width=1),
-                name='20-day MA'
-            ),
-            go.Scatter(
-                x=symbol_data['timestamp'],
-                y=symbol_data['MA50'],
-                mode='lines',
-                line=dict(color='red', width=1),
-                name='50-day MA'
-            )
-        ])
-
-        # Add volume as a bar chart
-        fig.add_trace(go.Bar(
-            x=symbol_data['timestamp'],
-            y=symbol_data['volume'],
-            name='Volume',
-            marker_color='lightgray',
-            yaxis='y2'
-        ))
-
-        # Update layout for dual y-axis and interactivity
-        fig.update_layout(
-            title=f'Advanced Candlestick Chart for {symbol}',
-            xaxis_title='Timestamp',
-            yaxis_title='Price',
-            yaxis2=dict(
-                title='Volume',
-                overlaying='y',
-                side='right'
-            ),
-            xaxis_rangeslider_visible=False,
-            dragmode='pan'  # Enable mouse drag and zoom
-        )
-        figures.append(fig.to_html(full_html=False))
+    etag = etag_for(tuple(keys))
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
 
     # Render the HTML template with the candlestick charts
-    return render_template('index.html', figures=figures)
+    page = page_cache.get_or_render(tuple(keys), lambda: render_template(
+        'index.html', figures=figures, plotly_version=plotly_bundle()[2]
+    ))
+    response = Response(page, mimetype='text/html')
+    response.set_etag(etag)
+    return response
+
+@app.route('/plotly.min.js')
+def plotly_js():
+    """plotly.js, served once per browser instead of inlined into every figure."""
+    body, gzipped, etag = plotly_bundle()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    elif 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response = Response(gzipped, mimetype='application/javascript')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(body, mimetype='application/javascript')
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.max_age = 31536000  # The URL carries the plotly version
+    return response
 
 @app.route('/api/available-symbols')
 def available_symbols():
-    ib_client = IBClient()
-    symbols = ib_client.get_available_symbols()
-    return jsonify({'symbols': symbols})
+    """
+    Symbols for the symbol picker from the contract cache, without an IB round trip. `q` searches
+    tickers and company names (prefix, then fuzzy); `limit` caps the result (default 50).
+    """
+    if SYMBOL_UNIVERSE:
+        get_ib_pool()  # The first search starts qualifying the universe
+    query = request.args.get('q', '')
+    limit = min(request.args.get('limit', 50, type=int), 1000)
+    symbols = default_contracts.search(query, limit)
+    return jsonify({'symbols': symbols, 'matches': [default_contracts.describe(symbol) for symbol in symbols]})
 
 @app.route('/live')
 def live_chart():
@@ -103,33 +319,75 @@ def live_chart():
 
 @app.route('/api/spy-data')
 def spy_data():
+    """
+    Bars for the live chart. `format` selects the payload: `json` (default, local time strings and
+    prices), `columnar` (epoch-ms JSON arrays), `msgpack` or `arrow`. `source` reads the history
+    from `ib` or `influx` (default HISTORY_SOURCE) and `timeframe` (e.g. 30m, 1D) aggregates it into
+    candles, on the server for Influx. `max_points` or `width` downsample the closes with LTTB.
+    Responses carry an ETag and are gzipped when the client accepts it.
+    """
     symbol = request.args.get('symbol', 'SPY')  # Default to SPY if no symbol is provided
     duration = request.args.get('duration', '1 D')  # Default to 1 day if no duration is provided
     if(duration != '1 D'):
         duration += ' D'  # Default to 5 days if not 1 day
-    # Use timezone from .env
-    app_timezone = timezone(APP_TIMEZONE)
-    now = datetime.now(app_timezone)  # Current time in the specified timezone
+    fmt = request.args.get('format', 'json')
+    if fmt not in FORMATS:
+        return jsonify({'error': f"Unknown format: {fmt}"}), 400
+    source = request.args.get('source', HISTORY_SOURCE)
+    if source not in ('ib', 'influx'):
+        return jsonify({'error': f"Unknown source: {source}"}), 400
+    timeframe = request.args.get('timeframe')
+    if timeframe is not None and timeframe not in TIMEFRAMES:
+        return jsonify({'error': f"Unknown timeframe: {timeframe}"}), 400
 
-    ib_client = IBClient()
-    data = ib_client.fetch_historical_data(symbol, duration=duration, bar_size='1 min')
+    if source == 'influx':
+        try:
+            timestamps, closes = influx_history(symbol, duration, timeframe)
+        except Exception as e:
+            return jsonify({'error': f"InfluxDB query failed: {e}"}), 502
+    else:
+        timestamps, closes = ib_history(symbol, duration, timeframe)
+    max_points = requested_points(LINE_PIXELS)
+    if max_points:
+        timestamps, closes = lttb(timestamps, closes, max_points)
 
-    if data.empty:
-        return jsonify({'timestamps': [], 'prices': []})  # Return empty data if no bars are fetched
+    # Revalidation is answered before anything is serialized
+    etag = bars_etag(timestamps, closes, symbol, duration, fmt, APP_TIMEZONE, source, timeframe)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    try:
+        body, mimetype = encode_bars(timestamps, closes, fmt, APP_TIMEZONE)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    body, encoding = gzip_body(body, request.headers.get('Accept-Encoding'))
+    response = Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    return response
 
-    # Convert timestamps to the specified timezone
-    app_timezone = timezone(APP_TIMEZONE)
-    def ensure_timezone_aware(ts):
-        if ts.tzinfo is None:
-            return ts.tz_localize('UTC').tz_convert(app_timezone)
-        return ts.tz_convert(app_timezone)
+@app.route('/api/stream')
+def stream():
+    """Server-sent events: a snapshot of the requested window, then each bar update as it happens."""
+    symbol = request.args.get('symbol', 'SPY')
+    duration = request.args.get('duration', '1') + ' D'
+    max_points = requested_points(LINE_PIXELS)
 
-    data['timestamp'] = pd.to_datetime(data['timestamp']).apply(ensure_timezone_aware)
+    def load_snapshot():
+        data = get_ib_pool().run(lambda client: client.fetch_historical_data_async(symbol, duration=duration, bar_size='1 min'))
+        if max_points and not data.empty:
+            data = data.iloc[lttb_indices(to_epoch_ns(data['timestamp']), data['close'].to_numpy(), max_points)]
+        return data
 
-    # Extract timestamps and prices
-    timestamps = data['timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S').tolist()
-    prices = data['close'].tolist()
-    return jsonify({'timestamps': timestamps, 'prices': prices})
+    return Response(
+        get_live_feed().events(symbol, load_snapshot),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 if __name__ == '__main__':
     app.run(host='127.0.0.1', port=5433)
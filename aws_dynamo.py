@@ -1,21 +1,57 @@
 import os
-from tinydb import TinyDB, Query
-import boto3
+import numpy as np
+import pandas as pd
 from botocore.exceptions import ClientError
+from bar_batch import BarBatch
+from bar_store import ColumnarBarStore, PRICE_COLUMNS, to_epoch_ns, to_timestamp_ns
+from metrics import timed
+from dynamo_writer import SESSION_PREFIX, DynamoBatchWriter, decode_items, session_days, session_key, unpack_session
+
+BAR_FIELDS = ['timestamp', 'open', 'high', 'low', 'close', 'volume', 'symbol', 'source']
+
+PAGE_SIZE = 10_000  # Bars per page from iter_bars
+SESSION_BARS = 390  # 1-minute bars in a regular session, for sizing packed Dynamo pages
+DAY_NS = 86_400 * 1_000_000_000
 
 class MarketDataStore:
+    """
+    Bar storage on the STORAGE_BACKEND: 'tinydb' (default), 'columnar' or 'dynamo'. Only the
+    selected backend's library (TinyDB, boto3) is imported, when the store is created.
+    """
+
     def __init__(self, db_path='market_data.json', table_name='market_data'):
         self.backend = os.getenv('STORAGE_BACKEND', 'tinydb')
         self.table_name = table_name
         if self.backend == 'dynamo':
-            self.dynamo_client = boto3.resource('dynamodb')
+            import boto3
+            endpoint_url = os.getenv('DYNAMO_ENDPOINT_URL') or None  # DynamoDB Local / moto for testing
+            self.dynamo_client = boto3.resource('dynamodb', endpoint_url=endpoint_url)
             self.table = self.dynamo_client.Table(self.table_name)
+            # One item per symbol-session instead of one per bar when DYNAMO_PACK_SESSIONS=1
+            self.packed = os.getenv('DYNAMO_PACK_SESSIONS', '0') == '1'
+            # The writer uses its own low-level client: the resource's client re-serializes attribute values
+            self.writer = DynamoBatchWriter(
+                self.table_name, workers=int(os.getenv('DYNAMO_WRITE_WORKERS', '8')), packed=self.packed
+            )
+        elif self.backend == 'columnar':
+            self.bars = ColumnarBarStore(os.getenv('BAR_STORE_PATH', 'bar_store'))
         else:
+            from tinydb import TinyDB
             self.db_path = db_path
             self.db = TinyDB(self.db_path)
+            self._index = None
+            self._sorted = {}  # symbol -> (sorted epoch ns, keys), see _symbol_index
 
     def create_table(self):
         if self.backend == 'dynamo':
+            # DYNAMO_BILLING_MODE=PAY_PER_REQUEST avoids throttling on bursty backfills
+            if os.getenv('DYNAMO_BILLING_MODE', 'PROVISIONED') == 'PAY_PER_REQUEST':
+                capacity = {'BillingMode': 'PAY_PER_REQUEST'}
+            else:
+                capacity = {'ProvisionedThroughput': {
+                    'ReadCapacityUnits': int(os.getenv('DYNAMO_READ_CAPACITY', '5')),
+                    'WriteCapacityUnits': int(os.getenv('DYNAMO_WRITE_CAPACITY', '5'))
+                }}
             try:
                 self.dynamo_client.create_table(
                     TableName=self.table_name,
@@ -27,24 +63,280 @@ class MarketDataStore:
                         {'AttributeName': 'symbol', 'AttributeType': 'S'},
                         {'AttributeName': 'timestamp', 'AttributeType': 'S'}
                     ],
-                    ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}
+                    **capacity
                 )
                 self.table.wait_until_exists()
             except ClientError as e:
                 if e.response['Error']['Code'] != 'ResourceInUseException':
                     raise
+        elif self.backend == 'columnar':
+            self.bars.create()
         else:
             if not os.path.exists(self.db_path):
                 with open(self.db_path, 'w') as f:
                     f.write('')  # Create an empty file if it doesn't exist
 
     def batch_write(self, items):
-        if self.backend == 'dynamo':
-            with self.table.batch_writer() as batch:
-                for item in items:
-                    batch.put_item(Item=item)
+        """Upsert a BarBatch, or a list of row dicts (any mix of symbols)."""
+        with timed('store_write', backend=self.backend):
+            self._batch_write(items)
+
+    def _batch_write(self, items):
+        if isinstance(items, BarBatch):
+            if self.backend == 'dynamo':
+                self.writer.write_batch(items)
+            elif self.backend == 'columnar':
+                self.bars.append(items.symbol, items.timestamps, items.columns(), source=items.source)
+            else:
+                self._tinydb_upsert(items.to_records())
+        elif self.backend == 'dynamo':
+            self.writer.write_records(items)
+        elif self.backend == 'columnar':
+            self.bars.write_records(items)
         else:
-            query = Query()
-            for item in items:
-                if not self.db.search((query.symbol == item['symbol']) & (query.timestamp == item['timestamp'])):
-                    self.db.insert(item)
+            self._tinydb_upsert(items)
+
+    def get_bars(self, symbol, start=None, end=None, columns=None, as_arrays=False):
+        """
+        Read stored bars for a symbol with start <= timestamp <= end, sorted by time.
+
+        `columns` selects what is returned next to the timestamp (default: OHLCV, symbol, source
+        and any stored indicator columns; unknown columns come back as NaN). Returns a DataFrame
+        with tz-aware UTC timestamps, or with `as_arrays=True` a dict of NumPy arrays with int64
+        epoch-ns timestamps (zero-copy views on the columnar backend).
+        """
+        with timed('store_read', backend=self.backend):
+            arrays = self._select(list(self._pages(symbol, start, end, columns, None)), symbol, columns)
+        return arrays if as_arrays else self._arrays_to_frame(arrays)
+
+    def iter_bars(self, symbol, start=None, end=None, columns=None, page_size=PAGE_SIZE, as_arrays=False):
+        """
+        Like get_bars, but yields the range as time-ordered pages of at most about `page_size`
+        bars, so a long history never has to be held in memory at once.
+        """
+        for page in self._pages(symbol, start, end, columns, page_size):
+            if len(page['timestamp']):
+                arrays = self._select([page], symbol, columns)
+                yield arrays if as_arrays else self._arrays_to_frame(arrays)
+
+    def _pages(self, symbol, start, end, columns, page_size):
+        """Raw pages ({'timestamp': ns, column: float64 array, 'source': ...}) from the backend's fast path."""
+        numeric = None if columns is None else [name for name in columns if name not in ('timestamp', 'symbol', 'source')]
+        start, end = to_timestamp_ns(start), to_timestamp_ns(end)
+        if self.backend == 'dynamo':
+            if self.packed:
+                return self._dynamo_session_pages(symbol, start, end, numeric, page_size)
+            return self._dynamo_row_pages(symbol, start, end, columns, numeric, page_size)
+        if self.backend == 'columnar':
+            return self._columnar_pages(symbol, start, end, numeric, page_size)
+        return self._tinydb_pages(symbol, start, end, numeric, page_size)
+
+    def _columnar_pages(self, symbol, start, end, numeric, page_size):
+        names = None
+        if numeric is not None:
+            available = {*PRICE_COLUMNS, *self.bars.extra_columns(symbol)}
+            names = ['timestamp', *(name for name in numeric if name in available)]
+        columns = self.bars.read_range(symbol, start, end, names)
+        source = self.bars.source(symbol)
+        n = len(columns['timestamp'])
+        step = page_size or max(n, 1)
+        for offset in range(0, n, step):
+            page = {name: values[offset:offset + step] for name, values in columns.items()}
+            page['source'] = source
+            yield page
+
+    def _symbol_index(self, symbol):
+        """
+        Sorted epoch-ns timestamps and matching keys of one symbol's TinyDB rows, built from the
+        key index on first use and dropped by batch_write when the symbol gets new rows.
+        """
+        cached = self._sorted.get(symbol)
+        if cached is None:
+            keys = [key for key in self._key_index() if key[0] == symbol]
+            timestamps = to_epoch_ns(np.array([key[1] for key in keys], dtype=object)) if keys else np.empty(0, np.int64)
+            order = np.argsort(timestamps, kind='stable')
+            cached = self._sorted[symbol] = (timestamps[order], [keys[i] for i in order])
+        return cached
+
+    def _tinydb_pages(self, symbol, start, end, numeric, page_size):
+        timestamps, keys = self._symbol_index(symbol)
+        lo = 0 if start is None else int(np.searchsorted(timestamps, start, side='left'))
+        hi = len(keys) if end is None else int(np.searchsorted(timestamps, end, side='right'))
+        index = self._key_index()
+        step = page_size or max(hi - lo, 1)
+        for offset in range(lo, hi, step):
+            rows = [index[key][1] for key in keys[offset:min(offset + step, hi)]]
+            names = numeric
+            if names is None:
+                names = list(dict.fromkeys(name for row in rows for name, value in row.items() if not isinstance(value, str)))
+            page = {
+                'timestamp': timestamps[offset:offset + len(rows)],
+                'source': np.array([row.get('source') for row in rows], dtype=object),
+            }
+            for name in names:
+                page[name] = np.array([row.get(name) for row in rows], dtype=np.float64)  # None becomes NaN
+            yield page
+
+    def _dynamo_query(self, symbol, lower, upper, limit=None, projection=None):
+        """
+        Query one symbol's sort-key range [lower, upper] with the low-level client, yielding the
+        items of each response page.
+        """
+        kwargs = {
+            'TableName': self.table_name,
+            'KeyConditionExpression': '#symbol = :symbol AND #ts BETWEEN :lower AND :upper',
+            'ExpressionAttributeNames': {'#symbol': 'symbol', '#ts': 'timestamp'},
+            'ExpressionAttributeValues': {':symbol': {'S': symbol}, ':lower': {'S': lower}, ':upper': {'S': upper}},
+        }
+        if limit:
+            kwargs['Limit'] = limit
+        if projection is not None:
+            aliases = {f"#c{i}": name for i, name in enumerate(projection)}
+            kwargs['ExpressionAttributeNames'].update(aliases)
+            kwargs['ProjectionExpression'] = ', '.join(['#symbol', '#ts', *aliases])
+        while True:
+            response = self.writer.client.query(**kwargs)
+            yield response['Items']
+            if 'LastEvaluatedKey' not in response:
+                return
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def _dynamo_row_pages(self, symbol, start, end, columns, numeric, page_size):
+        # Sort keys are ISO strings whose UTC offset may vary, so the key range is widened by a
+        # day on each side and the exact bounds are applied to the decoded timestamps
+        lower = '0000' if start is None else pd.Timestamp(start - DAY_NS, tz='UTC').strftime('%Y-%m-%d')
+        upper = SESSION_PREFIX if end is None else pd.Timestamp(end + DAY_NS, tz='UTC').strftime('%Y-%m-%d') + '~'
+        projection = None
+        if columns is not None:
+            projection = [*numeric, 'source'] if 'source' in columns else numeric
+        for items in self._dynamo_query(symbol, lower, upper, page_size, projection):
+            page = decode_items(items, numeric)
+            page['source'] = np.array([item['source']['S'] if 'source' in item else None for item in items], dtype=object)
+            yield self._clip(page, start, end)
+
+    def _dynamo_session_pages(self, symbol, start, end, numeric, page_size):
+        lower = session_key('0000' if start is None else session_days([start])[0])
+        upper = session_key('9999' if end is None else session_days([end])[0])
+        limit = max(1, page_size // SESSION_BARS) if page_size else None
+        for items in self._dynamo_query(symbol, lower, upper, limit):
+            if not items:
+                continue
+            sessions = [unpack_session(item['bars']['B']) for item in items]
+            values = np.concatenate([session[1] for session in sessions])
+            page = {'timestamp': np.concatenate([session[0] for session in sessions])}
+            for position, name in enumerate(PRICE_COLUMNS):
+                if numeric is None or name in numeric:
+                    page[name] = values[:, position]
+            page['source'] = np.concatenate([
+                np.full(len(session[0]), item['source']['S'] if 'source' in item else None, dtype=object)
+                for item, session in zip(items, sessions)
+            ])
+            yield self._clip(page, start, end)
+
+    @staticmethod
+    def _clip(page, start, end):
+        """Restrict a page to start <= timestamp <= end, in time order."""
+        timestamps = page['timestamp']
+        keep = np.ones(len(timestamps), dtype=bool)
+        if start is not None:
+            keep &= timestamps >= start
+        if end is not None:
+            keep &= timestamps <= end
+        rows = np.flatnonzero(keep)
+        rows = rows[np.argsort(timestamps[rows], kind='stable')]
+        return {name: values[rows] if isinstance(values, np.ndarray) else values for name, values in page.items()}
+
+    @staticmethod
+    def _select(pages, symbol, columns):
+        """
+        Join raw pages into the requested columns. Numeric columns a page lacks are NaN, symbol
+        is filled in, and a single page is passed through without copying.
+        """
+        if not pages:
+            pages = [{'timestamp': np.empty(0, dtype=np.int64)}]
+        if columns is None:
+            extras = dict.fromkeys(name for page in pages for name in page if name not in BAR_FIELDS)
+            columns = [*BAR_FIELDS[1:], *extras]
+
+        def join(parts):
+            return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+        arrays = {'timestamp': join([page['timestamp'] for page in pages])}
+        for name in columns:
+            if name == 'timestamp':
+                continue
+            if name == 'symbol':
+                arrays[name] = np.full(len(arrays['timestamp']), symbol, dtype=object)
+            elif name == 'source':
+                arrays[name] = join([
+                    np.broadcast_to(np.asarray(page.get('source'), dtype=object), len(page['timestamp']))
+                    for page in pages
+                ])
+            else:
+                arrays[name] = join([
+                    page[name] if name in page else np.full(len(page['timestamp']), np.nan) for page in pages
+                ])
+        return arrays
+
+    @staticmethod
+    def _arrays_to_frame(arrays):
+        frame = {'timestamp': pd.to_datetime(arrays['timestamp'], utc=True)}
+        frame.update((name, values) for name, values in arrays.items() if name != 'timestamp')
+        return pd.DataFrame(frame)
+
+    @staticmethod
+    def _row_values(item):
+        return {field: value for field, value in item.items() if field not in ('symbol', 'timestamp')}
+
+    def _key_index(self):
+        """
+        Map (symbol, timestamp) -> (doc_id, other fields) for the TinyDB table. Built once per
+        store from a single table scan and kept current by batch_write, so it assumes this
+        store is the only writer of the file while it is open.
+        """
+        if self._index is None:
+            self._index = {
+                (doc['symbol'], doc['timestamp']): (doc.doc_id, self._row_values(doc))
+                for doc in self.db.all()
+            }
+        return self._index
+
+    def _tinydb_upsert(self, items):
+        """
+        Upsert a batch against the key index: new keys are inserted with one insert_multiple,
+        changed rows (e.g. a bar that was still forming when first stored) are rewritten with
+        one update, and unchanged rows are skipped. Each call flushes the JSON file at most twice.
+        """
+        with timed('tinydb_dedup'):
+            inserts, updates = self._tinydb_diff(items)
+        with timed('tinydb_flush'):
+            self._tinydb_apply(inserts, updates)
+
+    def _tinydb_diff(self, items):
+        """Split a batch into new rows and changed rows against the key index."""
+        index = self._key_index()
+        inserts, updates = {}, {}
+        for item in items:
+            key = (item['symbol'], item['timestamp'])
+            existing = index.get(key)
+            if existing is None:
+                inserts[key] = item  # Later duplicates in the batch win
+            elif any(existing[1].get(field) != value for field, value in self._row_values(item).items()):
+                updates[key] = (existing[0], item)
+        return inserts, updates
+
+    def _tinydb_apply(self, inserts, updates):
+        index = self._key_index()
+        if updates:
+            self.db.update(
+                lambda doc: doc.update(updates[(doc['symbol'], doc['timestamp'])][1]),
+                doc_ids=[doc_id for doc_id, _ in updates.values()]
+            )
+            for key, (doc_id, item) in updates.items():
+                index[key] = (doc_id, dict(index[key][1], **self._row_values(item)))
+        if inserts:
+            doc_ids = self.db.insert_multiple(inserts.values())
+            for (key, item), doc_id in zip(inserts.items(), doc_ids):
+                index[key] = (doc_id, self._row_values(item))
+            for symbol, _ in inserts:
+                self._sorted.pop(symbol, None)
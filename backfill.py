@@ -0,0 +1,284 @@
+"""
+Backfill deep history for many symbols into MarketDataStore.
+
+Only the series the store persists (bar_cache.PERSISTED_SERIES: 1-minute TRADES bars in regular
+trading hours) can be backfilled: the store is keyed by (symbol, timestamp) alone, and BarCache
+reads everything in it back as that series.
+
+The (symbol, date range) is split into chunks no longer than IB allows per reqHistoricalData
+call for the bar size. Chunks in the symbol's checkpoint file, or held in full by the store, are
+skipped, and the rest run in a process pool with one IB client ID per worker.
+
+Usage: python backfill.py SPY QQQ --start 2022-01-01 [--end 2024-12-31] [--workers 4]
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import re
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import numpy as np
+import pandas as pd
+from aws_dynamo import MarketDataStore
+from bar_batch import BarBatch
+from bar_cache import PERSISTED_SERIES, SESSION_BARS
+from ib_client import IBClient
+from pacing import PacingScheduler
+
+EXCHANGE_TZ = 'America/New_York'
+
+# Bar size -> (durationStr, chunk span) within IB's historical data limits. A span of None
+# means one trading day per request.
+CHUNK_LIMITS = {
+    '1 secs': ('1800 S', pd.Timedelta(minutes=30)),
+    '5 secs': ('3600 S', pd.Timedelta(hours=1)),
+    '10 secs': ('14400 S', pd.Timedelta(hours=4)),
+    '30 secs': ('28800 S', pd.Timedelta(hours=8)),
+    '1 min': ('1 D', None),
+    '5 mins': ('1 W', pd.Timedelta(weeks=1)),
+    '15 mins': ('2 W', pd.Timedelta(weeks=2)),
+    '30 mins': ('1 M', pd.Timedelta(days=30)),
+    '1 hour': ('1 M', pd.Timedelta(days=30)),
+    '1 day': ('1 Y', pd.Timedelta(days=365)),
+}
+
+# IB allows about 60 historical requests per 10 minutes, shared by all workers
+PACING_BUDGET = 60
+
+SESSION_OPEN = pd.Timedelta(hours=9, minutes=30)
+MINUTE_NS = 60 * 1_000_000_000
+
+
+class Chunk:
+    __slots__ = ('start', 'end', 'duration')
+
+    def __init__(self, start, end, duration):
+        self.start = start  # UTC epoch ns, inclusive
+        self.end = end  # UTC epoch ns, exclusive; also the request's endDateTime
+        self.duration = duration
+
+    @property
+    def end_datetime(self):
+        """endDateTime in the UTC form IB accepts."""
+        return pd.Timestamp(self.end, tz='UTC').strftime('%Y%m%d-%H:%M:%S')
+
+
+def _exchange_time(value):
+    """A timestamp in exchange time; naive values are taken as exchange-local."""
+    ts = pd.Timestamp(value)
+    return ts.tz_localize(EXCHANGE_TZ) if ts.tzinfo is None else ts.tz_convert(EXCHANGE_TZ)
+
+
+def plan_chunks(start, end, bar_size):
+    """Split [start, end) into IB-legal chunks for `bar_size`, skipping weekends."""
+    if bar_size not in CHUNK_LIMITS:
+        raise ValueError(f"Unsupported bar size: {bar_size}. Expected one of {list(CHUNK_LIMITS)}")
+    duration, span = CHUNK_LIMITS[bar_size]
+    start, end = _exchange_time(start), _exchange_time(end)
+    chunks = []
+    if span is None:
+        for day in pd.bdate_range(start.normalize().tz_localize(None), end.tz_localize(None)):
+            day_start = day.tz_localize(EXCHANGE_TZ)
+            day_end = (day + pd.Timedelta(days=1)).tz_localize(EXCHANGE_TZ)
+            if day_start < end:
+                chunks.append(Chunk(day_start.value, day_end.value, duration))
+        return chunks
+    at = start
+    while at < end:
+        chunk_end = at + span
+        if span >= pd.Timedelta(days=1) or at.dayofweek < 5:
+            chunks.append(Chunk(at.as_unit('ns').value, chunk_end.as_unit('ns').value, duration))
+        at = chunk_end
+    return chunks
+
+
+def checkpoint_path(directory, symbol, bar_size, what_to_show, use_rth):
+    series = re.sub(r'[^A-Za-z0-9]+', '_', f"{bar_size}_{what_to_show}_{'rth' if use_rth else 'all'}")
+    return os.path.join(directory, f"{symbol}.{series}.json")
+
+
+def load_checkpoint(path):
+    """Chunk ends (epoch ns) already backfilled according to a checkpoint file."""
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return set(json.load(f)['done'])
+
+
+def save_checkpoint(path, done):
+    """Write the checkpoint atomically, so an interrupt never leaves a truncated file."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'done': sorted(done)}, f)
+    os.replace(path + '.tmp', path)
+
+
+def stored_chunks(store, symbol, chunks, now=None):
+    """
+    Ends of the chunks (trading days of the persisted series) the store holds a whole session
+    for: every minute from the 09:30 open to the 16:00 close, or to 13:00 on half days. Partial
+    days, such as an intraday tail the bar cache stored, are fetched again. Chunks ending after
+    `now` (the still-open session, or a day cut short by the requested end) never count.
+    """
+    if not chunks:
+        return set()
+    timestamps = store.get_bars(symbol, chunks[0].start, chunks[-1].end, columns=[], as_arrays=True)['timestamp']
+    if len(timestamps) == 0:
+        return set()
+    starts = np.array([chunk.start for chunk in chunks], dtype=np.int64)
+    ends = np.array([chunk.end for chunk in chunks], dtype=np.int64)
+    first = np.searchsorted(timestamps, starts, side='left')
+    counts = np.searchsorted(timestamps, ends, side='left') - first
+    now = pd.Timestamp.now(tz='UTC').value if now is None else now
+    done = set()
+    for chunk, index, count in zip(chunks, first, counts):
+        if count not in SESSION_BARS or chunk.end > now:
+            continue
+        session_open = (pd.Timestamp(chunk.start, tz='UTC').tz_convert(EXCHANGE_TZ) + SESSION_OPEN).value
+        # Starting at the open with one bar per minute and no gaps
+        if timestamps[index] == session_open and timestamps[index + count - 1] == session_open + (count - 1) * MINUTE_NS:
+            done.add(chunk.end)
+    return done
+
+
+# Per-process worker state, set up by _init_worker
+_client = None
+_store = None
+
+
+def _init_worker(host, port, client_ids, max_requests, write_in_worker):
+    global _client, _store
+    logging.basicConfig(level=logging.INFO)
+    # Each worker has its own connection, its own client ID and its share of the pacing budget
+    _client = IBClient(host, port, client_id=client_ids.get(), pacing=PacingScheduler(max_requests=max_requests))
+    # Failed requests raise instead of returning [], so they are never checkpointed as empty chunks
+    _client.ib.RaiseRequestErrors = True
+    _store = _client.data_store if write_in_worker else None
+
+
+def _run_task(symbol, chunks, bar_size, what_to_show, use_rth, until):
+    """
+    Fetch a run of chunks for one symbol. Returns (done chunk ends, bar count, batch), where
+    batch is None when the worker already wrote the bars to the store. Chunks ending after
+    `until` (now, or the requested end) are fetched but never reported done, so a partial
+    session is fetched again by the next run.
+    """
+    from ib_insync import RequestError  # Only workers talk to IB; the parent never loads ib_insync
+    done, batches = [], []
+    try:
+        for chunk in chunks:
+            complete = chunk.end <= until
+            try:
+                batch = _client.request_bars(symbol, chunk.duration, bar_size, chunk.end_datetime, what_to_show, use_rth)
+            except RequestError as e:
+                if e.code == 162 and 'no data' in e.message.lower():
+                    if complete:
+                        done.append(chunk.end)  # IB confirmed there are no bars, e.g. an exchange holiday
+                    continue
+                raise
+            if batch.empty:
+                # A timeout (or an error IB didn't tie to the request) also gives an empty reply
+                raise RuntimeError(f"no bars and no error from IB for the chunk ending {chunk.end_datetime}")
+            batches.append(batch)
+            if complete:
+                done.append(chunk.end)
+    except Exception as e:
+        logging.error(f"Backfill of {symbol} stopped at {len(done)}/{len(chunks)} chunks: {e}")
+    batches = [batch for batch in batches if not batch.empty]
+    if not batches:
+        return done, 0, None
+    batch = BarBatch.concat(batches)
+    if _store is not None:
+        _store.batch_write(batch)
+        return done, len(batch), None
+    return done, len(batch), batch  # Pickled back as a few arrays, not one dict per bar
+
+
+def backfill(symbols, start, end=None, bar_size='1 min', what_to_show='TRADES', use_rth=True, workers=4,
+             host='127.0.0.1', port=7497, client_id_base=500, checkpoint_dir='backfill_checkpoints',
+             chunks_per_task=10):
+    """
+    Backfill `symbols` over [start, end). Each symbol's chunks run in order, `chunks_per_task`
+    at a time, so at most one worker writes a symbol at once; different symbols run in parallel.
+    Workers write to the store themselves, except with TinyDB (a single JSON file), where they
+    return the bars and this process writes them. Returns the number of bars fetched.
+
+    Raises ValueError for any series but PERSISTED_SERIES, which would be mixed into it in the store.
+    """
+    if (bar_size, what_to_show, use_rth) != PERSISTED_SERIES:
+        raise ValueError(f"Only {PERSISTED_SERIES} bars can be backfilled into the store, "
+                         f"which keys bars by (symbol, timestamp) alone.")
+    now = pd.Timestamp.now(tz=EXCHANGE_TZ)
+    end = now if end is None else _exchange_time(end)
+    until = min(end, now).value  # Chunks ending later hold a partial session and are never checkpointed
+    store = MarketDataStore()
+    store.create_table()
+    write_in_worker = store.backend in ('columnar', 'dynamo')
+
+    pending, checkpoints, done_sets = {}, {}, {}
+    for symbol in symbols:
+        chunks = plan_chunks(start, end, bar_size)
+        path = checkpoint_path(checkpoint_dir, symbol, bar_size, what_to_show, use_rth)
+        done = load_checkpoint(path) | stored_chunks(store, symbol, chunks, until)
+        todo = [chunk for chunk in chunks if chunk.end not in done]
+        logging.info(f"{symbol}: {len(chunks) - len(todo)}/{len(chunks)} chunks already backfilled.")
+        if todo:
+            pending[symbol] = [todo[i:i + chunks_per_task] for i in range(0, len(todo), chunks_per_task)]
+            checkpoints[symbol], done_sets[symbol] = path, done
+
+    total_bars = 0
+    if not pending:
+        return total_bars
+    client_ids = multiprocessing.Manager().Queue()
+    for client_id in range(client_id_base, client_id_base + workers):
+        client_ids.put(client_id)
+    initargs = (host, port, client_ids, max(1, PACING_BUDGET // workers), write_in_worker)
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=initargs) as executor:
+        running = {}
+
+        def submit_next(symbol):
+            if pending[symbol]:
+                task = pending[symbol].pop(0)
+                running[executor.submit(_run_task, symbol, task, bar_size, what_to_show, use_rth, until)] = symbol
+
+        for symbol in pending:
+            submit_next(symbol)
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                symbol = running.pop(future)
+                done, count, batch = future.result()
+                if batch is not None:
+                    store.batch_write(batch)
+                total_bars += count
+                done_sets[symbol].update(done)
+                save_checkpoint(checkpoints[symbol], done_sets[symbol])
+                logging.info(f"{symbol}: +{count} bars, {len(pending[symbol])} tasks left.")
+                submit_next(symbol)
+    return total_bars
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('symbols', nargs='*')
+    parser.add_argument('--symbols-file', help='File with one symbol per line')
+    parser.add_argument('--start', required=True)
+    parser.add_argument('--end')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--client-id-base', type=int, default=500)
+    parser.add_argument('--chunks-per-task', type=int, default=10)
+    parser.add_argument('--checkpoint-dir', default='backfill_checkpoints')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    symbols = list(args.symbols)
+    if args.symbols_file:
+        with open(args.symbols_file) as f:
+            symbols += [line.strip() for line in f if line.strip()]
+    fetched = backfill(
+        symbols, args.start, args.end, *PERSISTED_SERIES, args.workers,
+        os.getenv('IB_HOST', '127.0.0.1'), int(os.getenv('IB_PORT', '7497')), args.client_id_base,
+        args.checkpoint_dir, args.chunks_per_task
+    )
+    print(f"Backfilled {fetched} bars for {len(symbols)} symbols")
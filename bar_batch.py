@@ -0,0 +1,158 @@
+import sys
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from bar_store import PRICE_COLUMNS, to_epoch_ns
+
+EXCHANGE_TZ = 'America/New_York'
+
+
+def _bar_time_ns(value):
+    """Epoch ns of an ib_insync bar date: tz-aware for intraday bars, a date for daily bars."""
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return round(value.timestamp() * 1_000_000) * 1000  # Exact: whole microseconds fit in a float64
+    return pd.Timestamp(value).tz_localize(EXCHANGE_TZ).value  # Naive values are exchange-local
+
+
+def iso_strings(timestamps, tz=EXCHANGE_TZ):
+    """
+    Format UTC epoch-ns timestamps as 'YYYY-MM-DDTHH:MM:SS+HH:MM' in `tz`, the key format
+    datetime.isoformat() gives IB bar dates, with one timezone conversion for the whole array.
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    if len(timestamps) == 0:
+        return np.array([], dtype='U25')
+    local = pd.DatetimeIndex(pd.to_datetime(timestamps, utc=True)).tz_convert(tz).tz_localize(None).as_unit('ns').asi8
+    wall = np.datetime_as_string(local.astype('datetime64[ns]').astype('datetime64[s]'))
+    offsets, inverse = np.unique((local - timestamps) // 60_000_000_000, return_inverse=True)
+    suffixes = np.array([f"{'-' if m < 0 else '+'}{abs(m) // 60:02d}:{abs(m) % 60:02d}" for m in offsets])
+    return np.char.add(wall, suffixes[inverse])
+
+
+class BarBatch:
+    """
+    One symbol's bars as a struct of arrays: int64 UTC epoch-ns timestamps, float64 OHLCV and
+    optional float64 extra columns (indicators), with the symbol and source strings interned
+    once per batch. This is what flows from IB through the cache into the store, instead of a
+    dict and an ISO string per bar.
+
+    Column access by name (`batch['close']`, `batch['timestamp']`) and `empty` mirror a
+    DataFrame, so frame-oriented helpers (indicators, line protocol) accept a batch as is.
+    """
+
+    __slots__ = ('symbol', 'source', 'timestamps', 'open', 'high', 'low', 'close', 'volume', 'extras')
+
+    def __init__(self, symbol, timestamps, open_, high, low, close, volume, source=None, extras=None):
+        self.symbol = sys.intern(str(symbol))
+        self.source = None if source is None else sys.intern(str(source))
+        self.timestamps = np.asarray(timestamps, dtype=np.int64)
+        self.open = np.asarray(open_, dtype=np.float64)
+        self.high = np.asarray(high, dtype=np.float64)
+        self.low = np.asarray(low, dtype=np.float64)
+        self.close = np.asarray(close, dtype=np.float64)
+        self.volume = np.asarray(volume, dtype=np.float64)
+        self.extras = {name: np.asarray(values, dtype=np.float64) for name, values in (extras or {}).items()}
+
+    @classmethod
+    def empty_batch(cls, symbol, source=None):
+        return cls(symbol, *([np.empty(0)] * 6), source=source)
+
+    @classmethod
+    def from_ib_bars(cls, symbol, bars, source='IBKR'):
+        """Build a batch from ib_insync BarData objects in one pass per column."""
+        n = len(bars)
+        timestamps = np.fromiter((_bar_time_ns(bar.date) for bar in bars), dtype=np.int64, count=n)
+        values = np.fromiter(
+            ((bar.open, bar.high, bar.low, bar.close, bar.volume) for bar in bars),
+            dtype=np.dtype((np.float64, len(PRICE_COLUMNS))), count=n
+        )
+        return cls(symbol, timestamps, *values.T, source=source)
+
+    @classmethod
+    def from_frame(cls, df, symbol=None, source=None):
+        """Build a batch from a one-symbol bar frame; other numeric columns become extras."""
+        if symbol is None:
+            symbol = df['symbol'].iloc[0]
+        if source is None and 'source' in df and len(df):
+            source = df['source'].iloc[0]
+        if df.empty:
+            return cls.empty_batch(symbol, source)
+        extras = {name: df[name].to_numpy(dtype=np.float64) for name in df.columns
+                  if name not in ('timestamp', 'symbol', 'source', *PRICE_COLUMNS) and df[name].dtype.kind in 'fiu'}
+        return cls(symbol, to_epoch_ns(df['timestamp']), *(df[name].to_numpy(dtype=np.float64) for name in PRICE_COLUMNS),
+                   source=source, extras=extras)
+
+    @classmethod
+    def concat(cls, batches):
+        """Concatenate batches of the same symbol."""
+        batches = [batch for batch in batches if len(batch)] or batches[:1]
+        first = batches[0]
+        if len(batches) == 1:
+            return first
+        names = dict.fromkeys(name for batch in batches for name in batch.extras)
+        return cls(
+            first.symbol,
+            np.concatenate([batch.timestamps for batch in batches]),
+            *(np.concatenate([getattr(batch, name) for batch in batches]) for name in PRICE_COLUMNS),
+            source=first.source,
+            extras={name: np.concatenate([batch.extras.get(name, np.full(len(batch), np.nan)) for batch in batches])
+                    for name in names},
+        )
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __getitem__(self, name):
+        if name == 'timestamp':
+            return self.timestamps
+        if name in PRICE_COLUMNS:
+            return getattr(self, name)
+        return self.extras[name]
+
+    def __contains__(self, name):
+        return name == 'timestamp' or name in PRICE_COLUMNS or name in self.extras
+
+    @property
+    def empty(self):
+        return len(self.timestamps) == 0
+
+    @property
+    def nbytes(self):
+        """Bytes held by the column arrays."""
+        return self.timestamps.nbytes + sum(array.nbytes for array in self.columns().values())
+
+    def columns(self):
+        """OHLCV and extra columns by name (the ColumnarBarStore.append shape)."""
+        return {**{name: getattr(self, name) for name in PRICE_COLUMNS}, **self.extras}
+
+    def take(self, rows):
+        return BarBatch(
+            self.symbol, self.timestamps[rows], *(getattr(self, name)[rows] for name in PRICE_COLUMNS),
+            source=self.source, extras={name: values[rows] for name, values in self.extras.items()}
+        )
+
+    def sorted(self):
+        """The batch in time order (itself if it already is)."""
+        if len(self) < 2 or (np.diff(self.timestamps) >= 0).all():
+            return self
+        return self.take(np.argsort(self.timestamps, kind='stable'))
+
+    def to_frame(self, tz=EXCHANGE_TZ):
+        """A bar frame with tz-aware timestamps in `tz`, as BarCache and the charts use."""
+        frame = {'timestamp': pd.to_datetime(self.timestamps, utc=True).tz_convert(tz)}
+        frame.update((name, getattr(self, name)) for name in PRICE_COLUMNS)
+        frame['symbol'] = self.symbol
+        frame['source'] = self.source
+        frame.update(self.extras)
+        return pd.DataFrame(frame, index=pd.RangeIndex(len(self)))
+
+    def to_record_frame(self, tz=EXCHANGE_TZ):
+        """The stored item shape as a frame: exchange-local ISO string timestamps, as IB returns them."""
+        frame = self.to_frame(tz)
+        frame['timestamp'] = iso_strings(self.timestamps, tz)
+        return frame
+
+    def to_records(self, tz=EXCHANGE_TZ):
+        """Row dicts for stores that keep one document per bar; NaN becomes None."""
+        frame = self.to_record_frame(tz)
+        return frame.astype(object).where(frame.notna(), None).to_dict('records')
@@ -0,0 +1,313 @@
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+import pandas as pd
+from pandas.tseries.offsets import BDay
+from bar_batch import BarBatch
+from indicators import DEFAULT_INDICATORS, IndicatorEngine, compute_indicators
+
+EXCHANGE_TZ = 'America/New_York'
+
+# MarketDataStore keys bars by (symbol, timestamp) only, so just one series per symbol can be
+# persisted there without mixing bar sizes. Every other series is cached in-process only.
+PERSISTED_SERIES = ('1 min', 'TRADES', True)
+
+# 1-minute bars in a complete regular session (09:30-16:00) and on half days (09:30-13:00)
+SESSION_BARS = (390, 210)
+
+# Stored bars are read from this far before the window, so indicators are warm at its start
+STORE_WARMUP = BDay(1)
+
+# Missing sessions are requested one trading day each; with more than this many, the whole
+# window is requested once instead
+MAX_SESSION_REQUESTS = 5
+
+BAR_COLUMNS = ['timestamp', 'open', 'high', 'low', 'close', 'volume', 'symbol', 'source']
+
+
+def window_bounds(duration, use_rth=True, now=None):
+    """
+    Approximate the window an IB durationStr covers, ending now.
+
+    Returns (start, must_cover): bars at or after `start` belong to the window, and stored data
+    only covers the window if its first bar is at or before `must_cover`. Day counts are treated
+    as trading days (business days, ignoring exchange holidays), as IB does.
+    """
+    count, unit = duration.split()
+    count, unit = int(count), unit.upper()
+    now = pd.Timestamp.now(tz=EXCHANGE_TZ) if now is None else pd.Timestamp(now).tz_convert(EXCHANGE_TZ)
+    if unit == 'S':
+        start = now - pd.Timedelta(seconds=count)
+        return start, start
+    session_open = pd.Timedelta(hours=9, minutes=30) if use_rth else pd.Timedelta(hours=4)
+    if unit == 'D':
+        last_session = now.normalize()
+        if last_session.dayofweek >= 5 or now - last_session < session_open:
+            last_session = last_session - BDay(1)
+        start = last_session - BDay(count - 1)
+    else:
+        days = {'W': 7, 'M': 30, 'Y': 365}[unit] * count
+        start = now.normalize() - pd.Timedelta(days=days)
+    return start, start + session_open
+
+
+def tail_duration(since, now=None):
+    """Smallest IB durationStr that reaches back to `since`."""
+    now = pd.Timestamp.now(tz='UTC') if now is None else now
+    seconds = max(int((now - since).total_seconds()) + 1, 60)
+    if seconds <= 86400:
+        return f'{seconds} S'
+    return f'{math.ceil(seconds / 86400)} D'
+
+
+def normalize_bars(df):
+    """Parse the timestamp column to exchange-local tz-aware values and sort by it."""
+    if df.empty:
+        return pd.DataFrame(columns=BAR_COLUMNS)
+    df = df.copy()
+    df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True).dt.tz_convert(EXCHANGE_TZ)
+    return df.sort_values('timestamp', kind='stable').reset_index(drop=True)
+
+
+def merge_bars(old, new):
+    """Combine two normalized frames; bars in `new` replace bars in `old` with the same timestamp."""
+    if old.empty:
+        return new
+    if new.empty:
+        return old
+    merged = pd.concat([old, new], ignore_index=True)
+    merged = merged.drop_duplicates(subset='timestamp', keep='last')
+    return merged.sort_values('timestamp', kind='stable').reset_index(drop=True)
+
+
+def trading_days(start, end):
+    """Exchange-local business days (naive midnights) from the day of `start` up to, not including, the day of `end`."""
+    return pd.bdate_range(start.tz_localize(None).normalize(), end.tz_localize(None).normalize(), inclusive='left')
+
+
+def session_end_datetime(day):
+    """The endDateTime (UTC, in the form IB accepts) of a request for the session on `day`."""
+    return (day + pd.Timedelta(days=1)).tz_localize(EXCHANGE_TZ).tz_convert('UTC').strftime('%Y%m%d-%H:%M:%S')
+
+
+class _Entry:
+    __slots__ = ('frame', 'covered_from', 'fetched_at', 'read_from', 'checked')
+
+    def __init__(self, frame, covered_from, fetched_at, read_from=None, checked=frozenset()):
+        self.frame = frame
+        self.covered_from = covered_from  # Every session from here on is held or was requested; None if unverified
+        self.fetched_at = fetched_at
+        self.read_from = read_from  # Start of the store read the frame began with, if any
+        self.checked = checked  # Days already requested from IB, so holidays and short sessions are asked once
+
+
+class _Plan:
+    __slots__ = ('key', 'persisted', 'start', 'now', 'entry', 'requests', 'covered_from', 'checked', 'result')
+
+    def __init__(self, key, persisted):
+        self.key = key
+        self.persisted = persisted
+        self.entry = None
+        self.requests = None  # (durationStr, endDateTime) of each IB request
+        self.result = None
+
+
+class BarCache:
+    """
+    Read-through cache of historical bars keyed by (symbol, bar_size, whatToShow, useRTH).
+
+    Lookups are served from an in-process LRU hot set first, then from MarketDataStore for the
+    persisted 1-minute TRADES/RTH series. Only the part of the window that is not held locally
+    is requested from IB: the tail since the last known bar (re-requested once the entry is older
+    than `ttl`, since that bar may still be forming) and one request per missing trading session
+    in the window (for the persisted series also per incomplete one), or the whole window once
+    when nothing or more than MAX_SESSION_REQUESTS sessions are missing.
+
+    Indicator columns (see indicators.py) are maintained for the persisted series: fetched bars
+    are fed through a per-symbol IndicatorEngine and stored with their indicator values.
+
+    With an IngestBus, fetched bars are published on its 'bars' topic and written to the store by
+    a 'store' sink on the bus's worker (policy INGEST_STORE_POLICY, default spill), so lookups
+    return without waiting for the store. Without one they are written before returning.
+    """
+
+    def __init__(self, store=None, max_entries=32, ttl=30, bus=None):
+        self.store = store
+        self.bus = bus
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._engines = {}  # symbol -> IndicatorEngine of the persisted series
+        self._lock = threading.Lock()
+        self._store_lock = threading.Lock()  # TinyDB is not safe to share between request threads
+        self._engine_lock = threading.Lock()
+        if bus is not None and store is not None:
+            bus.subscribe('store', self._write, topics=('bars',), max_queue=int(os.getenv('INGEST_QUEUE_SIZE', '256')),
+                          policy=os.getenv('INGEST_STORE_POLICY', 'spill'))
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, symbol=None):
+        """Drop hot-set entries, for one symbol or all of them."""
+        with self._lock:
+            for key in [key for key in self._entries if symbol is None or key[0] == symbol]:
+                del self._entries[key]
+
+    def get(self, fetch, symbol, duration='1 D', bar_size='1 min', what_to_show='TRADES', use_rth=True):
+        """
+        Return the bars for `duration` ending now as a DataFrame with exchange-local timestamps.
+
+        `fetch(symbol, duration, bar_size, end_datetime, what_to_show, use_rth)` performs the
+        actual IB request and returns a BarBatch (a DataFrame of raw bar rows also works).
+        """
+        plan = self._plan(symbol, duration, bar_size, what_to_show, use_rth)
+        if plan.requests is None:
+            return plan.result
+        return self._apply(plan, [fetch(symbol, request, bar_size, end, what_to_show, use_rth) for request, end in plan.requests])
+
+    async def get_async(self, fetch, symbol, duration='1 D', bar_size='1 min', what_to_show='TRADES', use_rth=True):
+        """
+        Same as `get`, with `fetch` being a coroutine function. The store reads and writes and the
+        indicator work run in a worker thread, so only the IB request runs on the event loop.
+        """
+        plan = await asyncio.to_thread(self._plan, symbol, duration, bar_size, what_to_show, use_rth)
+        if plan.requests is None:
+            return plan.result
+        fetched = [await fetch(symbol, request, bar_size, end, what_to_show, use_rth) for request, end in plan.requests]
+        return await asyncio.to_thread(self._apply, plan, fetched)
+
+    def _plan(self, symbol, duration, bar_size, what_to_show, use_rth):
+        """Work out whether a lookup is a hit, or which requests have to be made to IB."""
+        key = (symbol, bar_size, what_to_show, use_rth)
+        plan = _Plan(key, key[1:] == PERSISTED_SERIES and self.store is not None)
+        plan.start, must_cover = window_bounds(duration, use_rth)
+        plan.now = time.monotonic()
+
+        entry = self._lookup(key)
+        if (entry is not None and entry.covered_from is not None and entry.covered_from <= must_cover
+                and plan.now - entry.fetched_at < self.ttl):
+            self.hits += 1
+            plan.result = self._slice(entry.frame, plan.start)
+            return plan
+        self.misses += 1
+
+        read_from = plan.start - STORE_WARMUP
+        if (entry is not None and entry.read_from is not None and entry.covered_from > must_cover
+                and entry.read_from > read_from):
+            entry = None  # A longer window than the store read covered: read the store again from earlier
+        if entry is None:
+            if plan.persisted:
+                if self.bus is not None:
+                    self.bus.flush('store', symbol=symbol)  # Its bars still queued for the store would be missed otherwise
+                with self._store_lock:
+                    frame = normalize_bars(self.store.get_bars(symbol, start=read_from))
+                frame = self._fill_indicators(frame)
+            else:
+                frame = pd.DataFrame(columns=BAR_COLUMNS)
+                read_from = None
+            entry = _Entry(frame, None, plan.now, read_from)
+        plan.entry = entry
+
+        frame = entry.frame
+        missing = None
+        if not frame.empty and frame['timestamp'].iloc[-1] >= plan.start:
+            missing = self._missing_sessions(plan, entry, must_cover, bar_size)
+        if missing is None or len(missing) > MAX_SESSION_REQUESTS:
+            plan.requests = [(duration, '')]
+            plan.checked = entry.checked | frozenset(trading_days(plan.start, pd.Timestamp.now(tz=EXCHANGE_TZ)))
+        else:
+            since = frame['timestamp'].iloc[-1]
+            if missing:
+                logging.info(f"Bar cache: fetching {len(missing)} missing {symbol} sessions and the tail since {since}.")
+            else:
+                logging.info(f"Bar cache: fetching {symbol} tail since {since}.")
+            plan.requests = [('1 D', session_end_datetime(day)) for day in missing] + [(tail_duration(since), '')]
+            plan.checked = entry.checked | frozenset(missing)
+        plan.covered_from = plan.start if entry.covered_from is None else min(plan.start, entry.covered_from)
+        return plan
+
+    def _missing_sessions(self, plan, entry, must_cover, bar_size):
+        """
+        Trading days in the window before the last held bar's day that have no bars (for the
+        persisted series: not a complete session) and were not requested before. None when the
+        start of the window is missing for a bar size that can't be requested a day at a time.
+        """
+        frame = entry.frame
+        if bar_size.endswith('secs'):  # IB limits second bars to a few hours per request
+            return None if frame['timestamp'].iloc[0] > must_cover else []
+        days = frame['timestamp'].dt.tz_localize(None).dt.normalize()
+        counts = days.value_counts()
+        held = counts.index[counts.isin(SESSION_BARS)] if plan.persisted else counts.index
+        expected = trading_days(plan.start, frame['timestamp'].iloc[-1])
+        return [day for day in expected.difference(held) if day not in entry.checked]
+
+    def _apply(self, plan, fetched):
+        """Persist and merge the bars fetched for a plan's requests and return the requested window."""
+        fetched = BarBatch.concat([batch if isinstance(batch, BarBatch) else BarBatch.from_frame(batch, plan.key[0])
+                                   for batch in fetched]).sorted()
+        if plan.persisted and not fetched.empty:
+            with self._engine_lock:
+                fetched.extras.update(self._add_indicators(plan.key[0], plan.entry.frame, fetched))
+                if self.bus is not None:
+                    self.bus.publish('bars', fetched)  # Under the lock, so batches reach the store in order
+            if self.bus is None:
+                self._write(fetched)
+        frame = merge_bars(plan.entry.frame, fetched.to_frame(EXCHANGE_TZ))
+        self._remember(plan.key, _Entry(frame, plan.covered_from, plan.now, plan.entry.read_from, plan.checked))
+        return self._slice(frame, plan.start)
+
+    def _write(self, batch):
+        with self._store_lock:
+            self.store.batch_write(batch)
+
+    def _add_indicators(self, symbol, old, fetched):
+        """
+        Indicator columns for a time-ordered batch of fetched bars. Bars that continue the series
+        are applied to the symbol's engine in O(1) each; a fetch that reaches back before the last
+        applied bar recomputes the merged history in one vectorized pass and re-warms the engine.
+        """
+        engine = self._engines.get(symbol)
+        if engine is None:
+            engine = self._engines[symbol] = IndicatorEngine().warm(old)
+        if engine.last_timestamp is None or int(fetched.timestamps[0]) >= engine.last_timestamp:
+            return engine.update_frame(fetched)
+        merged = merge_bars(old, fetched.to_frame(EXCHANGE_TZ))
+        everything = compute_indicators(merged)
+        rows = merged['timestamp'].searchsorted(pd.to_datetime(fetched.timestamps, utc=True))
+        engine.warm(merged)
+        return {name: column[rows] for name, column in everything.items()}
+
+    @staticmethod
+    def _fill_indicators(frame):
+        """Compute indicators in memory for stored bars that were written without them."""
+        if frame.empty or all(name in frame and pd.notna(frame[name].iloc[-1]) for name in DEFAULT_INDICATORS):
+            return frame
+        frame = frame.copy()
+        for name, column in compute_indicators(frame).items():
+            frame[name] = column
+        return frame
+
+    @staticmethod
+    def _slice(frame, start):
+        if frame.empty:
+            return frame.copy()
+        lo = frame['timestamp'].searchsorted(start, side='left')
+        return frame.iloc[lo:].reset_index(drop=True)
@@ -0,0 +1,325 @@
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# Fixed-width column layout shared by every symbol; timestamps are UTC epoch nanoseconds
+COLUMNS = (
+    ('timestamp', np.int64),
+    ('open', np.float64),
+    ('high', np.float64),
+    ('low', np.float64),
+    ('close', np.float64),
+    ('volume', np.float64),
+)
+COLUMN_DTYPES = dict(COLUMNS)
+PRICE_COLUMNS = tuple(name for name, _ in COLUMNS if name != 'timestamp')
+
+
+def _parse_isoformat_offsets(values):
+    """
+    Fast path for uniform 'YYYY-MM-DDTHH:MM:SS+HH:MM' strings, the shape datetime.isoformat()
+    gives IB bar dates. The local part is parsed by NumPy and the few distinct UTC offsets are
+    resolved once each. Returns None if the strings do not all have that shape.
+    """
+    try:
+        strings = values.astype('U')
+    except (TypeError, ValueError):
+        return None
+    if strings.dtype.itemsize != 25 * 4 or not (np.char.str_len(strings) == 25).all():
+        return None
+    chars = strings.view(np.uint32).reshape(len(strings), 25)
+    if not ((chars[:, 19] == ord('+')) | (chars[:, 19] == ord('-'))).all():
+        return None
+    try:
+        local = strings.astype('U19').astype('datetime64[s]').astype(np.int64)
+    except ValueError:
+        return None
+    offsets, inverse = np.unique(np.ascontiguousarray(chars[:, 19:]).view('U6').ravel(), return_inverse=True)
+    seconds = np.array([(-1 if o[0] == '-' else 1) * (int(o[1:3]) * 3600 + int(o[4:6]) * 60) for o in offsets])
+    return (local - seconds[inverse]) * 1_000_000_000
+
+
+def to_epoch_ns(values):
+    """
+    Convert ISO strings, datetimes or epoch nanoseconds to a UTC int64 nanosecond array.
+    Pandas datetime columns (tz-aware or not) should be passed as is rather than via to_numpy(),
+    which boxes tz-aware values into an object array of Timestamps.
+    """
+    if isinstance(values, (pd.Series, pd.Index)) and values.dtype.kind == 'M':
+        index = pd.DatetimeIndex(values)
+        if index.tz is not None:
+            index = index.tz_convert('UTC').tz_localize(None)
+        return index.as_unit('ns').asi8
+    values = np.asarray(values)
+    if values.dtype.kind in 'iu':
+        return values.astype(np.int64, copy=False)
+    if values.dtype.kind == 'M':
+        return values.astype('datetime64[ns]').view(np.int64)
+    if values.dtype.kind in 'OU' and len(values):
+        parsed = _parse_isoformat_offsets(values)
+        if parsed is not None:
+            return parsed
+    return pd.DatetimeIndex(pd.to_datetime(values, utc=True)).as_unit('ns').asi8
+
+
+def to_timestamp_ns(value):
+    """
+    Convert a single range bound (ISO string, datetime, pandas Timestamp or int ns) to epoch ns.
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    ts = pd.Timestamp(value)
+    if ts.tzinfo is None:
+        ts = ts.tz_localize('UTC')
+    return int(ts.as_unit('ns').value)
+
+
+class ColumnarBarStore:
+    """
+    Append-only columnar bar storage, one directory per symbol and one raw file per column.
+
+    Column files are read through NumPy memory maps, so a symbol/time range read is a
+    binary search on the timestamp column followed by zero-copy slices of the others.
+    """
+
+    def __init__(self, root='bar_store'):
+        self.root = root
+        self._maps = {}  # (symbol, column) -> (file size, memmap)
+
+    def _symbol_dir(self, symbol):
+        return os.path.join(self.root, symbol)
+
+    def _column_path(self, symbol, column):
+        dtype = COLUMN_DTYPES.get(column, np.float64)
+        return os.path.join(self._symbol_dir(symbol), f"{column}.{np.dtype(dtype).str[1:]}")
+
+    def create(self):
+        os.makedirs(self.root, exist_ok=True)
+
+    def symbols(self):
+        """Return the symbols that have stored bars."""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(
+            name for name in os.listdir(self.root)
+            if os.path.exists(self._column_path(name, 'timestamp'))
+        )
+
+    def source(self, symbol):
+        meta_path = os.path.join(self._symbol_dir(symbol), 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            return json.load(f).get('source')
+
+    def __len__(self):
+        return sum(self.length(symbol) for symbol in self.symbols())
+
+    def length(self, symbol):
+        """
+        Number of complete rows for a symbol. Columns are appended one after another, so the
+        shortest column wins if a write was interrupted part way through.
+        """
+        sizes = []
+        for column, dtype in COLUMNS:
+            path = self._column_path(symbol, column)
+            if not os.path.exists(path):
+                return 0
+            sizes.append(os.path.getsize(path) // np.dtype(dtype).itemsize)
+        return min(sizes)
+
+    def extra_columns(self, symbol):
+        """
+        Names of the optional float64 columns (e.g. indicator values) stored next to the bars.
+        """
+        directory = self._symbol_dir(symbol)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(
+            name[:-3] for name in os.listdir(directory)
+            if name.endswith('.f8') and name[:-3] not in COLUMN_DTYPES
+        )
+
+    def column(self, symbol, column):
+        """Return a read-only memory map over one column of a symbol."""
+        path = self._column_path(symbol, column)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        cached = self._maps.get((symbol, column))
+        if cached is not None and cached[0] == size:
+            return cached[1]
+        dtype = COLUMN_DTYPES.get(column, np.float64)
+        if size == 0:
+            mapped = np.empty(0, dtype=dtype)
+        else:
+            mapped = np.memmap(path, dtype=dtype, mode='r')
+        self._maps[(symbol, column)] = (size, mapped)
+        return mapped
+
+    def _invalidate(self, symbol):
+        for key in [key for key in self._maps if key[0] == symbol]:
+            del self._maps[key]
+
+    def _column_rows(self, symbol, column, n):
+        """First n rows of a column; extra columns added after some bars were stored are NaN-padded."""
+        values = self.column(symbol, column)[:n]
+        if len(values) < n:
+            values = np.concatenate([values, np.full(n - len(values), np.nan)])
+        return values
+
+    def read_range(self, symbol, start=None, end=None, columns=None):
+        """
+        Return a dict of zero-copy column views for bars with start <= timestamp <= end.
+        Extra columns are included by default.
+        """
+        columns = columns or [name for name, _ in COLUMNS] + self.extra_columns(symbol)
+        n = self.length(symbol)
+        timestamps = self.column(symbol, 'timestamp')[:n]
+        lo = 0 if start is None else int(np.searchsorted(timestamps, to_timestamp_ns(start), side='left'))
+        hi = n if end is None else int(np.searchsorted(timestamps, to_timestamp_ns(end), side='right'))
+        return {column: self._column_rows(symbol, column, n)[lo:hi] for column in columns}
+
+    def append(self, symbol, timestamps, columns, source=None):
+        """
+        Upsert bars for one symbol. Bars newer than the last stored bar are appended, bars that
+        match an existing timestamp are overwritten in place, and anything else (an older bar
+        that fills a hole) triggers a sorted rewrite of the symbol's files.
+
+        `columns` must hold the OHLCV arrays and may hold extra float columns; extra columns
+        that a write does not provide are left unchanged, or NaN for new bars.
+        """
+        timestamps = to_epoch_ns(timestamps)
+        if len(timestamps) == 0:
+            return 0
+        order = np.argsort(timestamps, kind='stable')
+        timestamps = timestamps[order]
+        values = {name: np.asarray(array, dtype=COLUMN_DTYPES.get(name, np.float64))[order]
+                  for name, array in columns.items() if name != 'timestamp'}
+
+        # Collapse duplicates inside the batch, keeping the last occurrence
+        keep = np.append(timestamps[1:] != timestamps[:-1], True)
+        if not keep.all():
+            timestamps = timestamps[keep]
+            values = {name: array[keep] for name, array in values.items()}
+
+        os.makedirs(self._symbol_dir(symbol), exist_ok=True)
+        if source is not None and self.source(symbol) is None:
+            with open(os.path.join(self._symbol_dir(symbol), 'meta.json'), 'w') as f:
+                json.dump({'source': source}, f)
+
+        n = self.length(symbol)
+        extras = sorted(set(self.extra_columns(symbol)) | (set(values) - set(PRICE_COLUMNS)))
+        self._pad_extras(symbol, n, extras)
+        existing = self.column(symbol, 'timestamp')[:n]
+        tail = timestamps > existing[-1] if n else np.ones(len(timestamps), dtype=bool)
+        head_ts = timestamps[~tail]
+        if len(head_ts):
+            positions = np.searchsorted(existing, head_ts)
+            matched = (positions < n) & (existing[np.minimum(positions, n - 1)] == head_ts)
+            if not matched.all():
+                self._rewrite(symbol, n, timestamps, values, extras)
+                return len(timestamps)
+            self._overwrite(symbol, positions, {name: array[~tail] for name, array in values.items()})
+        if tail.any():
+            tail_values = {name: values[name][tail] if name in values else np.full(tail.sum(), np.nan)
+                           for name in (*PRICE_COLUMNS, *extras)}
+            self._append_rows(symbol, n, timestamps[tail], tail_values)
+        self._invalidate(symbol)
+        return len(timestamps)
+
+    def _pad_extras(self, symbol, n, extras):
+        for column in extras:
+            path = self._column_path(symbol, column)
+            size = os.path.getsize(path) // 8 if os.path.exists(path) else 0
+            if size < n:
+                with open(path, 'ab') as f:
+                    np.full(n - size, np.nan).tofile(f)
+        self._invalidate(symbol)
+
+    def _append_rows(self, symbol, n, timestamps, values):
+        arrays = dict(values, timestamp=timestamps)
+        for column, array in arrays.items():
+            dtype = COLUMN_DTYPES.get(column, np.float64)
+            with open(self._column_path(symbol, column), 'ab') as f:
+                # Drop any partially written rows left behind by an interrupted append
+                f.truncate(n * np.dtype(dtype).itemsize)
+                array.astype(dtype, copy=False).tofile(f)
+
+    def _overwrite(self, symbol, positions, values):
+        for column, array in values.items():
+            mapped = np.memmap(self._column_path(symbol, column), dtype=COLUMN_DTYPES.get(column, np.float64), mode='r+')
+            mapped[positions] = array
+            mapped.flush()
+            del mapped
+
+    def _rewrite(self, symbol, n, timestamps, values, extras):
+        names = [name for name, _ in COLUMNS] + list(extras)
+        existing = {column: np.array(self._column_rows(symbol, column, n)) for column in names}
+        merged_ts = np.concatenate([existing['timestamp'], timestamps])
+        # Incoming rows come second, so keeping the last duplicate lets them win
+        order = np.argsort(merged_ts, kind='stable')
+        merged_ts = merged_ts[order]
+        duplicate = merged_ts[1:] == merged_ts[:-1]
+        keep = np.append(~duplicate, True)
+        merged = {'timestamp': merged_ts[keep]}
+        for column in names[1:]:
+            if column in values:
+                merged[column] = np.concatenate([existing[column], values[column]])[order][keep]
+                continue
+            # A column the batch doesn't carry keeps the stored value of rows it overwrites
+            column_values = np.concatenate([existing[column], np.full(len(timestamps), np.nan)])[order]
+            column_values[1:][duplicate] = column_values[:-1][duplicate]
+            merged[column] = column_values[keep]
+        self._invalidate(symbol)
+        for column in names:
+            path = self._column_path(symbol, column)
+            merged[column].astype(COLUMN_DTYPES.get(column, np.float64), copy=False).tofile(path + '.tmp')
+            os.replace(path + '.tmp', path)
+
+    def write_records(self, records):
+        """
+        Upsert row dicts (the TinyDB/DynamoDB item shape) grouped by symbol. Numeric fields
+        beyond OHLCV are stored as extra columns.
+        """
+        if not records:
+            return 0
+        df = pd.DataFrame.from_records(records)
+        extras = [name for name in df.columns
+                  if name not in COLUMN_DTYPES and name not in ('symbol', 'source') and df[name].dtype.kind in 'fiu']
+        written = 0
+        for symbol, group in df.groupby('symbol', sort=False):
+            source = group['source'].iloc[0] if 'source' in group else None
+            written += self.append(
+                symbol,
+                group['timestamp'].to_numpy(),
+                {name: group[name].to_numpy() for name in (*PRICE_COLUMNS, *extras)},
+                source=source,
+            )
+        return written
+
+
+def migrate_tinydb(db_path='market_data.json', root='bar_store'):
+    """
+    One-shot migration of a TinyDB market data file into a ColumnarBarStore.
+    Returns the number of bars written per symbol.
+    """
+    with open(db_path) as f:
+        content = f.read()
+    tables = json.loads(content) if content.strip() else {}
+    records = [row for table in tables.values() for row in table.values()]
+    store = ColumnarBarStore(root)
+    store.create()
+    store.write_records(records)
+    return {symbol: store.length(symbol) for symbol in store.symbols()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate a TinyDB market data file to the columnar bar store.')
+    parser.add_argument('--db', default='market_data.json', help='TinyDB JSON file to read')
+    parser.add_argument('--root', default=os.getenv('BAR_STORE_PATH', 'bar_store'), help='Columnar store directory')
+    args = parser.parse_args()
+    for symbol, count in migrate_tinydb(args.db, args.root).items():
+        print(f"Migrated {count} bars for {symbol}")
@@ -0,0 +1,243 @@
+import logging
+import numpy as np
+import pandas as pd
+from bar_store import PRICE_COLUMNS, to_timestamp_ns
+
+
+class BarRingBuffer:
+    """
+    Fixed-capacity ring buffer of OHLCV bars. Updating the latest bar or appending a new one is
+    O(1); once full, the oldest bar is overwritten.
+    """
+
+    def __init__(self, capacity=2048):
+        self.capacity = capacity
+        self.timestamps = np.zeros(capacity, dtype=np.int64)
+        self.values = np.zeros((capacity, len(PRICE_COLUMNS)), dtype=np.float64)
+        self.count = 0
+        self.version = 0  # Incremented on every change, so readers can skip unchanged buffers
+        self._next = 0
+
+    def __len__(self):
+        return self.count
+
+    def _last_index(self):
+        return (self._next - 1) % self.capacity
+
+    def last_timestamp(self):
+        return int(self.timestamps[self._last_index()]) if self.count else None
+
+    def upsert(self, timestamp, values):
+        """
+        Store a bar. Returns True if it was appended as a new bar, False if it replaced the latest
+        bar, and None if it is older than the latest bar and was ignored.
+        """
+        last = self.last_timestamp()
+        if last is not None and timestamp < last:
+            return None
+        if timestamp == last:
+            self.values[self._last_index()] = values
+            self.version += 1
+            return False
+        self.timestamps[self._next] = timestamp
+        self.values[self._next] = values
+        self._next = (self._next + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self.version += 1
+        return True
+
+    def merge(self, timestamp, values):
+        """
+        Fold a finer bar (e.g. a 5-second real-time bar) into the bar starting at `timestamp`.
+        Returns the same flags as `upsert`.
+        """
+        if timestamp != self.last_timestamp():
+            return self.upsert(timestamp, values)
+        current = self.values[self._last_index()]
+        open_, high, low, close, volume = values
+        self.upsert(timestamp, (current[0], max(current[1], high), min(current[2], low), close, current[4] + volume))
+        return False
+
+    def latest(self):
+        """Return the latest bar as (timestamp ns, values)."""
+        index = self._last_index()
+        return int(self.timestamps[index]), self.values[index].copy()
+
+    def snapshot(self):
+        """Return the buffered bars in time order as a DataFrame with UTC timestamps."""
+        start = (self._next - self.count) % self.capacity
+        order = (np.arange(self.count) + start) % self.capacity
+        df = pd.DataFrame(self.values[order], columns=list(PRICE_COLUMNS))
+        df.insert(0, 'timestamp', pd.to_datetime(self.timestamps[order], utc=True))
+        return df
+
+
+class _Subscription:
+    __slots__ = ('symbol', 'bars', 'buffer', 'callbacks')
+
+    def __init__(self, symbol, buffer):
+        self.symbol = symbol
+        self.bars = None
+        self.buffer = buffer
+        self.callbacks = []
+
+
+class BarStream:
+    """
+    Streams bars for many symbols over one IBClient connection.
+
+    Each symbol is subscribed upstream once, either with reqHistoricalData(keepUpToDate=True)
+    (mode 'keep_up_to_date', 1-minute bars with an initial history snapshot) or with
+    reqRealTimeBars (mode 'realtime', 5-second bars folded into 1-minute bars). Bars land in a
+    per-symbol BarRingBuffer and only the new or updated bar is passed to each callback as
+    callback(symbol, bar, is_new). Callbacks run on the IB event loop, so the owning thread has
+    to keep that loop running (e.g. with ib.sleep()).
+    """
+
+    def __init__(self, client, mode='keep_up_to_date', duration='1 D', use_rth=True, capacity=2048):
+        if mode not in ('keep_up_to_date', 'realtime'):
+            raise ValueError(f"Unknown stream mode: {mode}")
+        self.client = client
+        self.mode = mode
+        self.duration = duration
+        self.use_rth = use_rth
+        self.capacity = capacity
+        self._subscriptions = {}
+
+    def buffer(self, symbol):
+        subscription = self._subscriptions.get(symbol)
+        return subscription.buffer if subscription else None
+
+    def subscribe(self, symbol, callback=None):
+        """Subscribe to a symbol (once upstream) and return its ring buffer."""
+        subscription = self._subscriptions.get(symbol)
+        if subscription is None:
+            subscription = _Subscription(symbol, BarRingBuffer(self.capacity))
+            self._start(subscription)
+            self._subscriptions[symbol] = subscription
+        if callback is not None:
+            subscription.callbacks.append(callback)
+        return subscription.buffer
+
+    async def subscribe_async(self, symbol, callback=None):
+        """Async counterpart of `subscribe`, for use on the client's running event loop."""
+        subscription = self._subscriptions.get(symbol)
+        if subscription is None:
+            subscription = _Subscription(symbol, BarRingBuffer(self.capacity))
+            await self._start_async(subscription)
+            self._subscriptions[symbol] = subscription
+        if callback is not None:
+            subscription.callbacks.append(callback)
+        return subscription.buffer
+
+    async def resubscribe_async(self):
+        """
+        Request every subscription again after the connection was re-established. Buffers and
+        callbacks are kept; bars missed while disconnected are filled in from the new history.
+        """
+        for symbol, subscription in list(self._subscriptions.items()):
+            await self._start_async(subscription)
+            if self._subscriptions.get(symbol) is not subscription:  # Unsubscribed meanwhile
+                self._cancel(subscription)
+
+    def unsubscribe(self, symbol, callback=None):
+        """Remove a callback; the upstream subscription is cancelled when none are left."""
+        subscription = self._subscriptions.get(symbol)
+        if subscription is None:
+            return
+        if callback is not None and callback in subscription.callbacks:
+            subscription.callbacks.remove(callback)
+        if callback is None or not subscription.callbacks:
+            self._cancel(subscription)
+            del self._subscriptions[symbol]
+            logging.info(f"Unsubscribed from {symbol} bars.")
+
+    def _cancel(self, subscription):
+        if not self.client.is_connected():
+            return  # The subscription ended with the connection
+        if self.mode == 'realtime':
+            self.client.ib.cancelRealTimeBars(subscription.bars)
+        else:
+            self.client.ib.cancelHistoricalData(subscription.bars)
+
+    def close(self):
+        for symbol in list(self._subscriptions):
+            self.unsubscribe(symbol)
+
+    def _start(self, subscription):
+        self.client.connect()
+        contract = self._contract(subscription.symbol, self.client.qualify(subscription.symbol))
+        if self.mode == 'realtime':
+            bars = self.client.ib.reqRealTimeBars(contract, 5, 'TRADES', self.use_rth)
+        else:
+            bars = self.client.ib.reqHistoricalData(contract, **self._history_request())
+        self._attach(subscription, bars)
+
+    async def _start_async(self, subscription):
+        await self.client.connect_async()
+        contract = self._contract(subscription.symbol, await self.client.qualify_async(subscription.symbol))
+        if self.mode == 'realtime':
+            bars = self.client.ib.reqRealTimeBars(contract, 5, 'TRADES', self.use_rth)
+        else:
+            bars = await self.client.ib.reqHistoricalDataAsync(contract, **self._history_request())
+        self._attach(subscription, bars)
+
+    @staticmethod
+    def _contract(symbol, contract):
+        if contract is None:
+            raise ValueError(f"No contract found for {symbol}.")
+        return contract
+
+    def _history_request(self):
+        return dict(
+            endDateTime='',
+            durationStr=self.duration,
+            barSizeSetting='1 min',
+            whatToShow='TRADES',
+            useRTH=self.use_rth,
+            keepUpToDate=True
+        )
+
+    def _attach(self, subscription, bars):
+        if self.mode != 'realtime':
+            for bar in bars:
+                subscription.buffer.upsert(to_timestamp_ns(bar.date), self._values(bar))
+        subscription.bars = bars
+        bars.updateEvent += lambda bars, has_new_bar: self._on_update(subscription, bars, has_new_bar)
+        logging.info(f"Subscribed to {subscription.symbol} bars ({self.mode}).")
+
+    @staticmethod
+    def _values(bar):
+        open_ = bar.open_ if hasattr(bar, 'open_') else bar.open  # RealTimeBar uses open_
+        return (open_, bar.high, bar.low, bar.close, bar.volume)
+
+    def _on_update(self, subscription, bars, has_new_bar):
+        if not bars:
+            return
+        if self.mode == 'realtime':
+            bar = bars[-1]
+            minute = bar.time.replace(second=0, microsecond=0)
+            is_new = subscription.buffer.merge(to_timestamp_ns(minute), self._values(bar))
+            if is_new is not None:
+                self._emit(subscription, minute, is_new)
+            return
+        if has_new_bar and len(bars) > 1:
+            # The previous bar has just closed; publish its final values before the new one
+            closed = bars[-2]
+            is_new = subscription.buffer.upsert(to_timestamp_ns(closed.date), self._values(closed))
+            if is_new is not None:
+                self._emit(subscription, closed.date, is_new)  # New if its forming updates were never seen
+        bar = bars[-1]
+        is_new = subscription.buffer.upsert(to_timestamp_ns(bar.date), self._values(bar))
+        if is_new is not None:
+            self._emit(subscription, bar.date, is_new)
+
+    def _emit(self, subscription, date, is_new):
+        _, values = subscription.buffer.latest()
+        bar = dict(zip(PRICE_COLUMNS, values.tolist()))
+        bar = {'timestamp': date.isoformat(), **bar, 'symbol': subscription.symbol, 'source': 'IBKR'}
+        for callback in list(subscription.callbacks):
+            try:
+                callback(subscription.symbol, bar, is_new)
+            except Exception as e:
+                logging.error(f"Bar stream callback failed for {subscription.symbol}: {e}")
@@ -0,0 +1,69 @@
+"""
+Measure memory per million bars on the ingest path: the previous dict-per-bar conversion
+(ISO string timestamps -> DataFrame -> to_dict('records') for the store) against BarBatch.
+
+Usage: python benchmarks/bench_bar_memory.py [--bars 1000000]
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+from ib_insync import BarData
+from bar_batch import BarBatch
+
+
+def synthetic_ib_bars(count):
+    start = datetime(2024, 1, 2, 9, 30, tzinfo=timezone(timedelta(hours=-5)))
+    return [BarData(date=start + timedelta(minutes=i), open=100.0 + i % 7, high=101.0 + i % 7,
+                    low=99.0 + i % 7, close=100.5 + i % 7, volume=float(1000 + i % 500)) for i in range(count)]
+
+
+def legacy_ingest(symbol, bars):
+    """The previous IBClient._bars_to_frame plus the records handed to MarketDataStore.batch_write."""
+    df = pd.DataFrame([{
+        'timestamp': bar.date.isoformat(),
+        'open': bar.open,
+        'high': bar.high,
+        'low': bar.low,
+        'close': bar.close,
+        'volume': bar.volume,
+        'symbol': symbol,
+        'source': 'IBKR'
+    } for bar in bars])
+    return df, df.to_dict('records')
+
+
+def measure(label, build, count):
+    gc.collect()
+    t0 = time.perf_counter()
+    build()
+    elapsed = time.perf_counter() - t0  # Timed untraced: tracemalloc slows allocation-heavy code down
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    scale = 1_000_000 / count
+    print(f"{label:<28} retained {retained * scale / 2**20:8.1f} MiB/M bars | "
+          f"peak {peak * scale / 2**20:8.1f} MiB/M bars | {elapsed / count * 1e9:7.0f} ns/bar")
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--bars', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    bars = synthetic_ib_bars(args.bars)
+    print(f"{args.bars} bars")
+    legacy = measure('dicts + DataFrame + records', lambda: legacy_ingest('SPY', bars), args.bars)
+    del legacy
+    batch = measure('BarBatch', lambda: BarBatch.from_ib_bars('SPY', bars), args.bars)
+    print(f"BarBatch.nbytes: {batch.nbytes / len(batch):.0f} bytes/bar")
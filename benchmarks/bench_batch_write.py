@@ -0,0 +1,88 @@
+"""
+Benchmark MarketDataStore.batch_write on the TinyDB backend against the previous
+per-row search/insert loop, at several existing table sizes.
+
+Usage: python benchmarks/bench_batch_write.py [--sizes 10000 100000 1000000] [--storage memory|json]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tinydb import TinyDB, Query
+from tinydb.storages import MemoryStorage
+from aws_dynamo import MarketDataStore
+
+
+def make_bars(symbol, count, start):
+    return [{
+        'timestamp': (start + timedelta(minutes=i)).isoformat(),
+        'open': 100.0 + i % 7,
+        'high': 101.0 + i % 7,
+        'low': 99.0 + i % 7,
+        'close': 100.5 + i % 7,
+        'volume': float(1000 + i),
+        'symbol': symbol,
+        'source': 'IBKR'
+    } for i in range(count)]
+
+
+def open_store(storage, path):
+    os.environ['STORAGE_BACKEND'] = 'tinydb'
+    store = MarketDataStore(db_path=path)
+    if storage == 'memory':
+        store.db.close()
+        store.db = TinyDB(storage=MemoryStorage)
+    return store
+
+
+def legacy_batch_write(db, items):
+    query = Query()
+    for item in items:
+        if not db.search((query.symbol == item['symbol']) & (query.timestamp == item['timestamp'])):
+            db.insert(item)
+
+
+def run(size, batch_size, legacy_sample, storage):
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    existing = make_bars('SPY', size, start)
+    # Half of the batch overlaps the stored tail, half is new, as with a repeated 5-day fetch
+    batch = make_bars('SPY', batch_size, start + timedelta(minutes=size - batch_size // 2))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = open_store(storage, os.path.join(tmp, 'bench.json'))
+        store.db.insert_multiple(existing)
+
+        t0 = time.perf_counter()
+        store._key_index()
+        index_time = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        store.batch_write(batch)
+        upsert_time = time.perf_counter() - t0
+
+        legacy_store = open_store(storage, os.path.join(tmp, 'legacy.json'))
+        legacy_store.db.insert_multiple(existing)
+        sample = batch[:legacy_sample]
+        t0 = time.perf_counter()
+        legacy_batch_write(legacy_store.db, sample)
+        legacy_time = time.perf_counter() - t0
+
+    print(f"{size:>9} rows | index build {index_time:8.3f}s | "
+          f"upsert {upsert_time / batch_size * 1e6:10.1f} us/bar | "
+          f"legacy {legacy_time / len(sample) * 1e6:12.1f} us/bar (sampled {len(sample)} bars)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--batch-size', type=int, default=3900, help='Bars per batch_write call (2 symbols x 5 days)')
+    parser.add_argument('--legacy-sample', type=int, default=20, help='Bars timed through the legacy loop')
+    parser.add_argument('--storage', choices=['memory', 'json'], default='memory')
+    args = parser.parse_args()
+    for size in args.sizes:
+        run(size, args.batch_size, args.legacy_sample, args.storage)
@@ -0,0 +1,98 @@
+"""
+Benchmark DynamoDB writes: the previous single-threaded resource batch_writer (with the Decimal
+conversion it needs) against DynamoBatchWriter, per-bar and with packed session items.
+
+Runs against DYNAMO_ENDPOINT_URL (e.g. DynamoDB Local) when it is set, otherwise in-process
+against moto. Absolute numbers from moto only show client-side cost; use DynamoDB Local or a real
+table to see the effect of parallel batches.
+
+Usage: python benchmarks/bench_dynamo_write.py [--days 5] [--symbols 4] [--workers 8]
+"""
+import argparse
+import os
+import sys
+import time
+import uuid
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import boto3
+import numpy as np
+import pandas as pd
+from dynamo_writer import DynamoBatchWriter
+
+
+def synthetic_records(symbols, days):
+    """One RTH session of 1-minute bars per symbol and business day, as batch_write rows."""
+    sessions = pd.bdate_range('2024-01-02', periods=days)
+    minutes = pd.timedelta_range('09:30:00', periods=390, freq='1min')
+    times = (sessions.values[:, None] + minutes.values[None, :]).ravel()
+    stamps = pd.DatetimeIndex(times).tz_localize('America/New_York').tz_convert('UTC')
+    rng = np.random.default_rng(1)
+    records = []
+    for s in range(symbols):
+        close = 100 + np.cumsum(rng.normal(0, 0.05, len(stamps)))
+        records += [{
+            'timestamp': ts.isoformat(), 'open': round(c, 2), 'high': round(c + 0.05, 2),
+            'low': round(c - 0.05, 2), 'close': round(c, 2), 'volume': float(1000 + i % 500),
+            'symbol': f"SYM{s}", 'source': 'IBKR'
+        } for i, (ts, c) in enumerate(zip(stamps, close))]
+    return records
+
+
+def create_table(client, name):
+    client.create_table(
+        TableName=name,
+        KeySchema=[{'AttributeName': 'symbol', 'KeyType': 'HASH'}, {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}],
+        AttributeDefinitions=[{'AttributeName': 'symbol', 'AttributeType': 'S'}, {'AttributeName': 'timestamp', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    client.get_waiter('table_exists').wait(TableName=name)
+
+
+def legacy_write(resource, name, records):
+    with resource.Table(name).batch_writer() as batch:
+        for record in records:
+            batch.put_item(Item={key: Decimal(str(value)) if isinstance(value, float) else value for key, value in record.items()})
+
+
+def run(records, workers):
+    endpoint_url = os.getenv('DYNAMO_ENDPOINT_URL') or None
+    client = boto3.client('dynamodb', endpoint_url=endpoint_url)
+    resource = boto3.resource('dynamodb', endpoint_url=endpoint_url)
+    cases = [
+        ('legacy batch_writer', lambda name: legacy_write(resource, name, records)),
+        (f"parallel x{workers}", lambda name: DynamoBatchWriter(name, client, workers=workers).write_records(records)),
+        (f"packed sessions x{workers}", lambda name: DynamoBatchWriter(name, client, workers=workers, packed=True).write_records(records)),
+    ]
+    for label, write in cases:
+        name = f"bench_{uuid.uuid4().hex[:8]}"
+        create_table(client, name)
+        try:
+            t0 = time.perf_counter()
+            write(name)
+            elapsed = time.perf_counter() - t0
+            items = client.scan(TableName=name, Select='COUNT')['Count']
+        finally:
+            client.delete_table(TableName=name)
+        print(f"{label:<22} {elapsed:8.3f}s  {len(records) / elapsed:10.0f} bars/s  {items:>7} items")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--days', type=int, default=5)
+    parser.add_argument('--symbols', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    records = synthetic_records(args.symbols, args.days)
+    print(f"{len(records)} bars ({args.symbols} symbols x {args.days} sessions)")
+    if os.getenv('DYNAMO_ENDPOINT_URL'):
+        run(records, args.workers)
+    else:
+        from moto import mock_aws
+        for name, value in (('AWS_DEFAULT_REGION', 'us-east-1'), ('AWS_ACCESS_KEY_ID', 'bench'), ('AWS_SECRET_ACCESS_KEY', 'bench')):
+            os.environ.setdefault(name, value)
+        with mock_aws():
+            run(records, args.workers)
@@ -0,0 +1,108 @@
+"""
+Benchmark cold-start import cost with `python -X importtime`: the CLI (main.py), the Flask app,
+backfill workers and the InfluxDB scripts, each imported in a fresh interpreter.
+
+For every entry point it reports the import time and the process wall time (median of
+`--repeat` runs), the packages that cost the most, and which of the heavy libraries that are
+meant to load on first use (plotly, boto3, TinyDB, the InfluxDB client, requests, ib_insync)
+were imported anyway. `--json` and `--baseline` work as in bench_suite.py.
+
+Usage: python benchmarks/bench_import.py [--only main app backfill] [--repeat 5] [--top 5]
+                                         [--json imports.json] [--baseline imports.json] [--tolerance 0.25]
+"""
+import argparse
+import collections
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Entry point -> the module its process imports first
+TARGETS = {
+    'main': 'main',  # python main.py
+    'app': 'app',  # Flask app: container start
+    'backfill': 'backfill',  # backfill.py and its process-pool workers
+    'ib_client': 'ib_client',
+    'influxdb_handler': 'influxdb_handler',
+    'print_influx_data': 'print_influx_data',
+}
+
+DEFERRED = ('plotly', 'boto3', 'tinydb', 'influxdb_client_3', 'requests', 'ib_insync')
+
+
+def run(module, directory):
+    """Import `module` in a new interpreter; returns (wall seconds, importtime lines)."""
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    t0 = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+                            cwd=directory, env=env, capture_output=True, text=True)
+    wall = time.perf_counter() - t0
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        rows.append((int(self_us), int(cumulative_us), name[1:].rstrip()))
+    return wall, rows
+
+
+def measure(module, repeat):
+    """Median import ms and wall ms over `repeat` runs, plus the rows of the median run."""
+    with tempfile.TemporaryDirectory() as directory:  # Stores and caches created at import land here
+        run(module, directory)  # Writes the .pyc files, so every measured run is alike
+        runs = []
+        for _ in range(repeat):
+            wall, rows = run(module, directory)
+            total = next(cumulative for _, cumulative, name in rows if name == module)
+            runs.append((total / 1000, wall * 1000, rows))
+    runs.sort(key=lambda r: r[0])
+    median = runs[len(runs) // 2]
+    return median[0], statistics.median(r[1] for r in runs), median[2]
+
+
+def heaviest(rows, top):
+    """Self time per top-level package, most expensive first."""
+    packages = collections.Counter()
+    for self_us, _, name in rows:
+        packages[name.strip().split('.')[0]] += self_us
+    return packages.most_common(top)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--only', nargs='+', choices=list(TARGETS), default=list(TARGETS))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=5, help='Most expensive packages to list per entry point')
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--baseline', help='Compare against results saved with --json')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    results = []
+    interpreter = statistics.median(run('sys', ROOT)[0] for _ in range(args.repeat)) * 1000
+    print(f"{'interpreter':<18} {'':>10} {interpreter:9.1f} ms wall (python -c 'import sys')")
+    for target in args.only:
+        module = TARGETS[target]
+        import_ms, wall_ms, rows = measure(module, args.repeat)
+        imported = {name.strip().split('.')[0] for _, _, name in rows}
+        eager = [package for package in DEFERRED if package in imported]
+        results.append(('import', target, 'ms', import_ms, 'lower'))
+        results.append(('import', f"{target}/wall", 'ms', wall_ms, 'lower'))
+        print(f"{target:<18} {import_ms:7.1f} ms {wall_ms:9.1f} ms wall  "
+              + '  '.join(f"{package} {us / 1000:.0f}" for package, us in heaviest(rows, args.top))
+              + (f"  [eager: {', '.join(eager)}]" if eager else ''))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump([dict(zip(('case', 'variant', 'unit', 'value', 'better'), row)) for row in results], f, indent=1)
+    if args.baseline:
+        from bench_suite import compare
+        if compare(results, args.baseline, args.tolerance):
+            sys.exit(1)
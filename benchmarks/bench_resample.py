@@ -0,0 +1,85 @@
+"""
+Benchmark the vectorized resampling engine against the previous pure-Python
+influxdb_handler.aggregate_to_daily loop on the bundled market_data.json.
+
+Usage: python benchmarks/bench_resample.py [--db market_data.json] [--repeat 5]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+from pytz import timezone
+from bar_store import to_epoch_ns
+from resample import IncrementalResampler, resample_arrays, resample_frame
+
+
+def legacy_aggregate_to_daily(data):
+    eastern = timezone('America/New_York')
+    daily_data = {}
+    for point in data:
+        date = datetime.fromisoformat(point["timestamp"]).astimezone(eastern).date()
+        if date not in daily_data:
+            daily_data[date] = {
+                "open": point["open"],
+                "high": point["high"],
+                "low": point["low"],
+                "close": point["close"],
+                "volume": point["volume"],
+            }
+        else:
+            daily_data[date]["high"] = max(daily_data[date]["high"], point["high"])
+            daily_data[date]["low"] = min(daily_data[date]["low"], point["low"])
+            daily_data[date]["close"] = point["close"]
+            daily_data[date]["volume"] += point["volume"]
+    return daily_data
+
+
+def best_of(repeat, fn):
+    timings = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - t0)
+    return min(timings)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--db', default='market_data.json')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with open(args.db) as f:
+        rows = [row for table in json.load(f).values() for row in table.values()]
+    print(f"{len(rows)} minute bars")
+
+    legacy = best_of(args.repeat, lambda: legacy_aggregate_to_daily(rows))
+    print(f"legacy aggregate_to_daily      {legacy * 1e3:9.2f} ms")
+    for timeframe in ['5m', '15m', '1h', '1D']:
+        elapsed = best_of(args.repeat, lambda: resample_frame(pd.DataFrame(rows), timeframe))
+        print(f"resample_frame {timeframe:<4} (all symbols) {elapsed * 1e3:9.2f} ms  ({legacy / elapsed:5.1f}x)")
+
+    df = pd.DataFrame(rows)
+    df = df[df['symbol'] == df['symbol'].iloc[0]].copy()
+    df['timestamp'] = to_epoch_ns(df['timestamp'].to_numpy())
+    df = df.sort_values('timestamp')
+    arrays = [df[name].to_numpy() for name in ['timestamp', 'open', 'high', 'low', 'close', 'volume']]
+    for timeframe in ['5m', '1D']:
+        elapsed = best_of(args.repeat, lambda: resample_arrays(*arrays, timeframe=timeframe))
+        print(f"resample_arrays {timeframe:<3} (int64 epoch, {len(df)} bars) {elapsed * 1e3:6.2f} ms")
+
+    bars = list(zip(*arrays))
+
+    def stream():
+        resampler = IncrementalResampler('15m')
+        for bar in bars:
+            resampler.update(*bar)
+
+    elapsed = best_of(args.repeat, stream)
+    print(f"IncrementalResampler 15m        {elapsed / len(bars) * 1e6:9.2f} us/bar")
@@ -0,0 +1,78 @@
+"""
+Benchmark the /api/spy-data response path: the previous per-row timezone conversion and
+strftime against the vectorized encoder and the compact payload formats.
+
+Usage: python benchmarks/bench_spy_data.py [--days 30] [--tz America/New_York] [--repeat 5]
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+from pytz import timezone
+from bar_store import to_epoch_ns
+from payloads import bars_etag, encode_bars, msgpack, pa
+
+
+def synthetic_bars(days):
+    """`days` sessions of 390 minute bars with exchange-local timestamps, as the bar cache returns them."""
+    sessions = pd.bdate_range(end=pd.Timestamp.today().normalize(), periods=days)
+    minutes = pd.timedelta_range('09:30:00', periods=390, freq='1min')
+    index = pd.DatetimeIndex([day + minute for day in sessions for minute in minutes]).tz_localize('America/New_York')
+    close = 500 + np.cumsum(np.random.default_rng(0).normal(0, 0.1, len(index)))
+    return pd.DataFrame({'timestamp': index, 'close': close})
+
+
+def legacy_payload(data, tz):
+    app_timezone = timezone(tz)
+
+    def ensure_timezone_aware(ts):
+        if ts.tzinfo is None:
+            return ts.tz_localize('UTC').tz_convert(app_timezone)
+        return ts.tz_convert(app_timezone)
+
+    data = data.copy()
+    data['timestamp'] = pd.to_datetime(data['timestamp']).apply(ensure_timezone_aware)
+    timestamps = data['timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S').tolist()
+    prices = data['close'].tolist()
+    return json.dumps({'timestamps': timestamps, 'prices': prices}).encode()
+
+
+def fast_payload(data, fmt, tz):
+    timestamps = to_epoch_ns(data['timestamp'])
+    closes = data['close'].to_numpy(dtype=np.float64)
+    bars_etag(timestamps, closes, 'SPY', fmt, tz)
+    return encode_bars(timestamps, closes, fmt, tz)[0]
+
+
+def best_of(repeat, fn):
+    timings = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - t0)
+    return min(timings), result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--tz', default='America/New_York')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    data = synthetic_bars(args.days)
+    print(f"{len(data)} minute bars, tz {args.tz}")
+
+    legacy, body = best_of(args.repeat, lambda: legacy_payload(data, args.tz))
+    print(f"legacy (apply + strftime)  {legacy * 1e3:8.2f} ms  {len(body):>8} B  {len(gzip.compress(body, 5)):>7} B gzip")
+    formats = ['json', 'columnar'] + (['msgpack'] if msgpack else []) + (['arrow'] if pa else [])
+    for fmt in formats:
+        elapsed, body = best_of(args.repeat, lambda: fast_payload(data, fmt, args.tz))
+        print(f"{fmt:<26} {elapsed * 1e3:8.2f} ms  {len(body):>8} B  {len(gzip.compress(body, 5)):>7} B gzip  ({legacy / elapsed:5.1f}x)")
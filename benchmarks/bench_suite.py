@@ -0,0 +1,214 @@
+"""
+End-to-end benchmark suite on the offline IB stand-in (fake_ib.FakeIB), runnable without TWS:
+ingest throughput through IBClient, the bar cache and the store, MarketDataStore.batch_write,
+/api/spy-data latency and the /api/stream live-chart path.
+
+Every result has a direction (higher or lower is better). `--json` saves them, and `--baseline`
+compares against a saved run and exits with status 1 when a result is more than `--tolerance`
+worse, so the suite can gate changes in CI.
+
+Usage: python benchmarks/bench_suite.py [--only ingest batch_write spy_data live] [--speed 1000]
+                                        [--json results.json] [--baseline results.json] [--tolerance 0.25]
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from aws_dynamo import MarketDataStore
+from bar_batch import BarBatch
+from bar_cache import BarCache
+from contracts import ContractCache, default_contracts
+from fake_ib import FakeIB, SyntheticBars
+from ib_client import IBClient
+from ingest_bus import IngestBus
+from pacing import PacingScheduler
+
+CASES = ('ingest', 'batch_write', 'spy_data', 'live')
+BACKENDS = ('tinydb', 'columnar')
+
+
+def open_store(backend, directory):
+    os.environ['STORAGE_BACKEND'] = backend
+    os.environ['BAR_STORE_PATH'] = os.path.join(directory, 'bar_store')
+    return MarketDataStore(db_path=os.path.join(directory, 'market_data.json'))
+
+
+def unpaced():
+    """A scheduler that never delays: the fake gateway has no pacing limits to respect."""
+    return PacingScheduler(max_requests=10**9, identical_interval=0, contract_requests=10**9)
+
+
+def percentiles(seconds):
+    ms = np.asarray(seconds) * 1000
+    return {f"p{q}": float(np.percentile(ms, q)) for q in (50, 95, 99)}
+
+
+def bench_ingest(args, results):
+    """
+    Historical bars for many symbols: FakeIB -> IBClient -> BarCache (indicators) -> store, with
+    the store written before each fetch returns, and through an IngestBus sink (fetch returned,
+    then flushed to the store).
+    """
+    symbols = [f"SYM{i}" for i in range(args.symbols)]
+    for backend in BACKENDS:
+        for through_bus in (False, True):
+            with tempfile.TemporaryDirectory() as directory:
+                store = open_store(backend, directory)
+                bus = IngestBus(spill_dir=os.path.join(directory, 'spill')) if through_bus else None
+                contracts = ContractCache(os.path.join(directory, 'contracts.json'))
+                client = IBClient(bar_cache=BarCache(store, bus=bus), pacing=unpaced(),
+                                  ib=FakeIB(SyntheticBars(), args.speed), contracts=contracts)
+                t0 = time.perf_counter()
+                data = client.fetch_multiple_symbols(symbols, duration=f"{args.days} D")
+                elapsed = time.perf_counter() - t0
+                variants = [(f"{backend}/bus" if bus else backend, elapsed)]
+                if bus is not None:
+                    bus.close()
+                    variants.append((f"{backend}/bus+flush", time.perf_counter() - t0))
+                client.close()
+            for variant, seconds in variants:
+                results.append(('ingest', variant, 'bars/s', len(data) / seconds, 'higher'))
+                print(f"ingest       {variant:<18} {len(data):>8} bars in {seconds:7.3f}s  {len(data) / seconds:10.0f} bars/s")
+
+
+def bench_batch_write(args, results):
+    """batch_write of BarBatches into an empty store, then the same bars again (all upserts)."""
+    source = SyntheticBars()
+    now = time.time_ns()
+    batches = []
+    for i in range(args.symbols):
+        timestamps, values = source.bars(f"SYM{i}", now - args.days * 7 // 5 * 86400 * 10**9, now)
+        batches.append(BarBatch(f"SYM{i}", timestamps, *values.T, source='IBKR'))
+    count = sum(len(batch) for batch in batches)
+    for backend in BACKENDS:
+        with tempfile.TemporaryDirectory() as directory:
+            store = open_store(backend, directory)
+            for label in ('insert', 'upsert'):
+                t0 = time.perf_counter()
+                for batch in batches:
+                    store.batch_write(batch)
+                elapsed = time.perf_counter() - t0
+                results.append(('batch_write', f"{backend}/{label}", 'bars/s', count / elapsed, 'higher'))
+                print(f"batch_write  {backend + '/' + label:<18} {count:>8} bars in {elapsed:7.3f}s  {count / elapsed:10.0f} bars/s")
+
+
+def load_app(args, directory):
+    """Import app.py against FakeIB, a throwaway columnar store and an empty contract cache."""
+    default_contracts.path = os.path.join(directory, 'contracts.json')
+    os.environ.update({
+        'IB_FAKE': 'synthetic', 'IB_FAKE_SPEED': str(args.speed),
+        'STORAGE_BACKEND': 'columnar', 'BAR_STORE_PATH': os.path.join(directory, 'bar_store'),
+    })
+    import app
+    return app
+
+
+def bench_spy_data(args, results, app):
+    """/api/spy-data: the cold request (IB fetch and store write), then warm requests per format."""
+    client = app.app.test_client()
+    t0 = time.perf_counter()
+    response = client.get(f"/api/spy-data?symbol=SPY&duration={args.days}")
+    cold = time.perf_counter() - t0
+    assert response.status_code == 200, response.data
+    results.append(('spy_data', 'cold', 'ms', cold * 1000, 'lower'))
+    print(f"spy_data     cold               {cold * 1000:9.2f} ms")
+    for fmt in ('json', 'columnar', 'arrow'):
+        timings = []
+        for _ in range(args.requests):
+            t0 = time.perf_counter()
+            response = client.get(f"/api/spy-data?symbol=SPY&duration={args.days}&format={fmt}&max_points=2000")
+            timings.append(time.perf_counter() - t0)
+        if response.status_code != 200:
+            print(f"spy_data     {fmt:<18} skipped ({response.status_code})")
+            continue
+        stats = percentiles(timings)
+        for name, value in stats.items():
+            results.append(('spy_data', f"{fmt}/{name}", 'ms', value, 'lower'))
+        print(f"spy_data     {fmt:<18} " + '  '.join(f"{name} {value:7.2f} ms" for name, value in stats.items()))
+
+
+def bench_live(args, results, app):
+    """/api/stream: the snapshot, then bar updates as FakeIB streams them at `--speed`."""
+    client = app.app.test_client()
+    t0 = time.perf_counter()
+    response = client.get('/api/stream?symbol=QQQ&duration=2', buffered=False)
+    chunks = iter(response.response)
+    first = next(chunks)
+    snapshot = time.perf_counter() - t0
+    assert b'event: snapshot' in (first if isinstance(first, bytes) else first.encode())
+    arrivals = []
+    for chunk in chunks:
+        if (chunk if isinstance(chunk, str) else chunk.decode()).startswith('event: bar'):
+            arrivals.append(time.perf_counter())
+            if len(arrivals) > args.messages:
+                break
+    response.close()
+    rate = (len(arrivals) - 1) / (arrivals[-1] - arrivals[0])
+    gaps = np.diff(arrivals)
+    expected = args.speed / 5  # FakeIB updates the forming bar every 5 s of virtual time
+    results.append(('live', 'snapshot', 'ms', snapshot * 1000, 'lower'))
+    results.append(('live', 'updates', 'msg/s', rate, 'higher'))
+    results.append(('live', 'gap/p99', 'ms', percentiles(gaps)['p99'], 'lower'))
+    print(f"live         snapshot           {snapshot * 1000:9.2f} ms")
+    print(f"live         updates            {rate:9.1f} msg/s (~{expected:.0f} expected)  "
+          + '  '.join(f"gap {name} {value:6.2f} ms" for name, value in percentiles(gaps).items()))
+
+
+def compare(results, baseline_path, tolerance):
+    """Print the change against a saved run; returns the results that regressed beyond `tolerance`."""
+    with open(baseline_path) as f:
+        baseline = {(row['case'], row['variant'], row['unit']): row['value'] for row in json.load(f)}
+    regressions = []
+    for case, variant, unit, value, better in results:
+        previous = baseline.get((case, variant, unit))
+        if not previous:
+            continue
+        change = value / previous - 1
+        worse = -change if better == 'higher' else change
+        flag = 'REGRESSION' if worse > tolerance else ''
+        print(f"{case:<12} {variant:<18} {previous:12.2f} -> {value:12.2f} {unit:<6} {change:+7.1%} {flag}")
+        if flag:
+            regressions.append((case, variant))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--only', nargs='+', choices=CASES, default=list(CASES))
+    parser.add_argument('--speed', type=float, default=1000, help='FakeIB replay speed')
+    parser.add_argument('--symbols', type=int, default=8)
+    parser.add_argument('--days', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=50, help='Warm /api/spy-data requests per format')
+    parser.add_argument('--messages', type=int, default=200, help='Live bar updates to receive')
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--baseline', help='Compare against results saved with --json')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = []
+    if 'ingest' in args.only:
+        bench_ingest(args, results)
+    if 'batch_write' in args.only:
+        bench_batch_write(args, results)
+    if 'spy_data' in args.only or 'live' in args.only:
+        with tempfile.TemporaryDirectory() as directory:
+            app = load_app(args, directory)
+            if 'spy_data' in args.only:
+                bench_spy_data(args, results, app)
+            if 'live' in args.only:
+                bench_live(args, results, app)
+            app.get_ib_pool().close()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump([dict(zip(('case', 'variant', 'unit', 'value', 'better'), row)) for row in results], f, indent=1)
+    if args.baseline and compare(results, args.baseline, args.tolerance):
+        sys.exit(1)
@@ -0,0 +1,62 @@
+import functools
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def frame_key(df):
+    """
+    Identify a bar frame by what changes when bars land: its length and its last bar. A new bar
+    changes the last timestamp, and a forming bar that was updated changes its values.
+    """
+    if df.empty:
+        return (0,)
+    last = df.iloc[-1]
+    return (len(df), str(last['timestamp']), float(last['close']), float(last['volume']))
+
+
+def etag_for(key):
+    return hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+
+
+class RenderCache:
+    """
+    LRU cache of rendered output (figure HTML, whole pages) keyed by the inputs it was rendered
+    from, so unchanged charts are served without rebuilding or re-serializing the figure.
+    """
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_render(self, key, render):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        value = render()  # Rendered outside the lock; a concurrent miss just renders twice
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+@functools.lru_cache(maxsize=1)
+def plotly_bundle():
+    """The plotly.js bundle of the installed plotly version as (bytes, gzipped bytes, etag), built once."""
+    import plotly
+    from plotly.offline import get_plotlyjs
+    body = get_plotlyjs().encode()
+    return body, gzip.compress(body, compresslevel=9), f"plotly-{plotly.__version__}"
@@ -0,0 +1,349 @@
+"""
+Contract details cache and symbol search.
+
+Qualifying a contract costs an IB round trip, but a stock's conId never changes. ContractCache
+keeps what IB returns for each symbol (conId, primary exchange, long name, trading and liquid
+hours) in a JSON file, loads the whole file on first use and builds qualified contracts from
+memory, so requests only go to IB for symbols it has never seen. `hydrate` qualifies a whole
+universe of symbols concurrently, e.g. at startup.
+
+SymbolIndex answers symbol-picker searches over the cached universe: the exact ticker, then
+ticker prefixes, then prefixes of words in the company name, then close (typo) matches.
+
+Usage: python contracts.py hydrate SPY QQQ [--file universe.txt]
+       python contracts.py search apple [--limit 20]
+"""
+import argparse
+import asyncio
+import atexit
+import bisect
+import contextlib
+import difflib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from metrics import timed
+
+# Offered before anything has been qualified, so the symbol picker is never empty
+DEFAULT_SYMBOLS = ('SPY', 'QQQ', 'AAPL', 'MSFT', 'GOOGL')
+
+DETAIL_FIELDS = ('longName', 'timeZoneId', 'tradingHours', 'liquidHours')
+
+# IB's error code for a contract it has no definition for; only this answer is cached as unknown
+NO_SECURITY_DEFINITION = 200
+
+
+def _words(name):
+    return re.findall(r'[A-Z0-9]+', (name or '').upper())
+
+
+@contextlib.contextmanager
+def _undefined_symbols(ib):
+    """Collect the symbols IB answers with 'no security definition' while the block runs."""
+    symbols = set()
+
+    def on_error(req_id, code, message, contract):
+        if code == NO_SECURITY_DEFINITION and contract is not None:
+            symbols.add(contract.symbol)
+
+    ib.errorEvent += on_error
+    try:
+        yield symbols
+    finally:
+        ib.errorEvent -= on_error
+
+
+def _stock(symbol, exchange='SMART', currency='USD', **fields):
+    from ib_insync import Stock  # Imported on the first contract, so searching the cache doesn't load ib_insync
+    return Stock(symbol, exchange, currency, **fields)
+
+
+def load_universe(value):
+    """Symbols from a comma/space separated list, or from a file with one or more per line."""
+    if value and os.path.exists(value):
+        with open(value) as f:
+            value = f.read()
+    return list(dict.fromkeys(symbol.upper() for symbol in re.split(r'[\s,]+', value or '') if symbol))
+
+
+class SymbolIndex:
+    """Sorted ticker and name-word lists searched with bisect, plus difflib for near misses."""
+
+    def __init__(self, records):
+        self.names = {symbol: record.get('longName') or '' for symbol, record in records.items()}
+        self._symbols = sorted(self.names)
+        words = sorted((word, symbol) for symbol, name in self.names.items() for word in _words(name))
+        self._words = [word for word, _ in words]
+        self._word_symbols = [symbol for _, symbol in words]
+
+    def __len__(self):
+        return len(self._symbols)
+
+    @staticmethod
+    def _prefix_range(keys, prefix):
+        """Slice bounds of the sorted `keys` that start with `prefix`."""
+        start = bisect.bisect_left(keys, prefix)
+        return start, bisect.bisect_left(keys, prefix + '\uffff', start)
+
+    def search(self, query, limit=20):
+        """Best matches for `query` (a ticker or company name fragment), best first."""
+        query = query.strip().upper()
+        if not query:
+            return self._symbols[:limit]
+        matches = {}
+        if query in self.names:
+            matches[query] = None
+        start, end = self._prefix_range(self._symbols, query)
+        tickers = sorted(self._symbols[start:end], key=lambda symbol: (len(symbol), symbol))
+        matches.update(dict.fromkeys(tickers))
+        terms = _words(query)
+        if terms:
+            # Every query word has to start a word of the name; the last one may be partial
+            candidates = None
+            for term in terms:
+                start, end = self._prefix_range(self._words, term)
+                found = set(self._word_symbols[start:end])
+                candidates = found if candidates is None else candidates & found
+            matches.update(dict.fromkeys(sorted(candidates, key=lambda symbol: (len(self.names[symbol]), symbol))))
+        if len(matches) < limit:
+            matches.update(dict.fromkeys(difflib.get_close_matches(query, self._symbols, n=limit, cutoff=0.6)))
+        return list(matches)[:limit]
+
+
+class ContractCache:
+    """
+    Persistent symbol -> contract details map (see the module docstring). Entries older than
+    `max_age` seconds keep serving contracts (conIds don't change) and are refreshed by the next
+    `hydrate`, which also renews their trading hours. Symbols IB has no security definition for
+    are not asked again for `unknown_ttl` seconds. Contracts learned one at a time are written
+    at most every `save_delay` seconds (and at exit). Thread-safe.
+    """
+
+    def __init__(self, path=None, max_age=7 * 86400, unknown_ttl=3600, save_delay=5):
+        self.path = path or os.getenv('CONTRACT_CACHE_PATH', 'contracts.json')
+        self.max_age = max_age
+        self.unknown_ttl = unknown_ttl
+        self.save_delay = save_delay
+        self.hits = 0
+        self.misses = 0
+        self._details = None
+        self._unknown = {}  # Symbols IB had no definition for -> monotonic time to ask again
+        self._index = None
+        self._save_timer = None
+        self._dirty = False
+        self._lock = threading.Lock()
+        atexit.register(self._save_pending)
+
+    def _loaded(self):
+        if self._details is None:
+            with self._lock:
+                if self._details is None:
+                    self._details = self._read()
+        return self._details
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            details = json.load(f)
+        logging.info(f"Loaded {len(details)} contracts from {self.path}.")
+        return details
+
+    def save(self):
+        """
+        Write the cache atomically, so an interrupt never leaves a truncated file. Writes are
+        serialised under the cache lock and each goes through its own temporary file.
+        """
+        details = self._loaded()
+        directory = os.path.dirname(self.path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+            self._dirty = False
+            with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.tmp', delete=False) as f:
+                json.dump(details, f, indent=1, sort_keys=True)
+            os.replace(f.name, self.path)
+
+    def _save_soon(self):
+        """Save within `save_delay` seconds, so a burst of lookups costs one write."""
+        with self._lock:
+            self._dirty = True
+            if self._save_timer is None:
+                self._save_timer = threading.Timer(self.save_delay, self.save)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+
+    def _save_pending(self):
+        if self._dirty:
+            self.save()
+
+    def __len__(self):
+        return len(self._loaded())
+
+    def __contains__(self, symbol):
+        return symbol in self._loaded()
+
+    def get(self, symbol):
+        """The stored details of `symbol` as a dict, or None."""
+        return self._loaded().get(symbol)
+
+    def symbols(self):
+        return sorted(self._loaded())
+
+    def stale(self, symbols):
+        """The symbols that are missing or older than `max_age`."""
+        details = self._loaded()
+        cutoff = time.time() - self.max_age
+        return [symbol for symbol in symbols if symbol not in details or details[symbol]['updated'] < cutoff]
+
+    def contract(self, symbol):
+        """A qualified Stock built from the cache, or None when `symbol` isn't cached."""
+        record = self._loaded().get(symbol)
+        if record is None:
+            return None
+        return _stock(symbol, record['exchange'], record['currency'], conId=record['conId'],
+                      primaryExchange=record['primaryExchange'])
+
+    def qualify(self, ib, symbol):
+        """A qualified Stock for `symbol`, asking IB only on a cache miss. None if IB doesn't know it."""
+        contract = self._hit(symbol)
+        if contract is not None or self._known_unknown(symbol):
+            return contract
+        with timed('ib_qualify'), _undefined_symbols(ib) as undefined:
+            details = ib.reqContractDetails(_stock(symbol))
+        return self._learn(symbol, details, symbol in undefined)
+
+    async def qualify_async(self, ib, symbol):
+        """Async counterpart of `qualify`."""
+        contract = self._hit(symbol)
+        if contract is not None or self._known_unknown(symbol):
+            return contract
+        with timed('ib_qualify'), _undefined_symbols(ib) as undefined:
+            details = await ib.reqContractDetailsAsync(_stock(symbol))
+        return self._learn(symbol, details, symbol in undefined)
+
+    def _known_unknown(self, symbol):
+        """True while IB's 'no security definition' answer for `symbol` is cached."""
+        retry_at = self._unknown.get(symbol)
+        if retry_at is None:
+            return False
+        if time.monotonic() < retry_at:
+            return True
+        self._unknown.pop(symbol, None)
+        return False
+
+    def _hit(self, symbol):
+        contract = self.contract(symbol)
+        if contract is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return contract
+
+    def _learn(self, symbol, details, undefined=False, save=True):
+        if not details:
+            if undefined:
+                logging.warning(f"No contract found for {symbol}.")
+                self._unknown[symbol] = time.monotonic() + self.unknown_ttl
+            else:
+                logging.warning(f"Contract details request for {symbol} returned nothing; not caching.")
+            return None
+        self._unknown.pop(symbol, None)
+        self._remember(symbol, details[0])
+        if save:
+            self._save_soon()
+        return self.contract(symbol)
+
+    def _remember(self, symbol, details):
+        contract = details.contract
+        record = {
+            'conId': contract.conId,
+            'exchange': 'SMART',
+            'primaryExchange': contract.primaryExchange,
+            'currency': contract.currency or 'USD',
+            'updated': time.time(),
+        }
+        record.update((field, getattr(details, field, '') or '') for field in DETAIL_FIELDS)
+        self._loaded()
+        with self._lock:
+            self._details[symbol] = record
+            self._index = None
+
+    def hydrate(self, ib, symbols, max_in_flight=16, refresh=False):
+        """Qualify every missing (or, with `refresh`, stale) symbol in one concurrent batch."""
+        return ib.run(self.hydrate_async(ib, symbols, max_in_flight, refresh))
+
+    async def hydrate_async(self, ib, symbols, max_in_flight=16, refresh=False):
+        """Async counterpart of `hydrate`. Returns the number of contracts qualified."""
+        todo = self.stale(symbols) if refresh else [symbol for symbol in symbols if symbol not in self]
+        if not todo:
+            return 0
+        semaphore = asyncio.Semaphore(max_in_flight)
+
+        async def request(symbol):
+            async with semaphore:
+                try:
+                    return symbol, await ib.reqContractDetailsAsync(_stock(symbol))
+                except Exception as e:
+                    logging.error(f"Contract details request for {symbol} failed: {e}")
+                    return symbol, None
+
+        with timed('ib_qualify_bulk'), _undefined_symbols(ib) as undefined:
+            results = await asyncio.gather(*(request(symbol) for symbol in todo))
+        qualified = sum(self._learn(symbol, details, symbol in undefined, save=False) is not None
+                        for symbol, details in results if details is not None)
+        self.save()
+        logging.info(f"Qualified {qualified} of {len(todo)} contracts.")
+        return qualified
+
+    def index(self):
+        """The SymbolIndex over the cached contracts and DEFAULT_SYMBOLS, rebuilt after changes."""
+        index = self._index
+        if index is None:
+            details = self._loaded()
+            with self._lock:
+                index = self._index = SymbolIndex({**{symbol: {} for symbol in DEFAULT_SYMBOLS}, **details})
+        return index
+
+    def search(self, query='', limit=50):
+        return self.index().search(query, limit)
+
+    def describe(self, symbol):
+        """What the symbol picker shows for a symbol."""
+        record = self.get(symbol) or {}
+        return {'symbol': symbol, 'name': record.get('longName', ''), 'primaryExchange': record.get('primaryExchange', '')}
+
+
+# conIds are the same for every connection, so clients in one process share one cache by default
+default_contracts = ContractCache()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Qualify and search the persisted contract cache.')
+    parser.add_argument('command', choices=('hydrate', 'search'))
+    parser.add_argument('terms', nargs='*', help='Symbols to hydrate, or the search query')
+    parser.add_argument('--file', help='File with the symbols to hydrate')
+    parser.add_argument('--refresh', action='store_true', help='Also re-qualify entries older than a week')
+    parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.command == 'search':
+        for symbol in default_contracts.search(' '.join(args.terms), args.limit):
+            match = default_contracts.describe(symbol)
+            print(f"{symbol:<8} {match['primaryExchange']:<8} {match['name']}")
+    else:
+        from ib_client import IBClient
+        client = IBClient()
+        client.connect()
+        try:
+            symbols = load_universe(' '.join(args.terms)) + (load_universe(args.file) if args.file else [])
+            count = default_contracts.hydrate(client.ib, symbols, refresh=args.refresh)
+            print(f"Qualified {count} contracts; {len(default_contracts)} cached in {default_contracts.path}")
+        finally:
+            client.close()
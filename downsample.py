@@ -0,0 +1,101 @@
+import math
+import numpy as np
+import pandas as pd
+from bar_store import to_epoch_ns
+from resample import bucket_starts
+
+# Coarser candle sizes tried in order until the bars fit; all stay aligned to the session open
+CANDLE_LADDER = ('5m', '15m', '30m', '1h', '1D')
+
+# Screen pixels per plotted point: a candle needs a few pixels, a line vertex about one
+CANDLE_PIXELS = 3
+LINE_PIXELS = 1
+
+
+def points_for_width(width, pixels_per_point):
+    """How many points a chart `width` pixels wide can show."""
+    return max(int(width) // pixels_per_point, 3)
+
+
+def lttb_indices(x, y, threshold):
+    """
+    Indices of the points Largest-Triangle-Three-Buckets keeps out of (x, y). The first and last
+    points are always kept; every bucket in between contributes the point that forms the largest
+    triangle with the previously kept point and the next bucket's average, so peaks and troughs
+    survive. Returns all indices when there are no more than `threshold` points.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64) - float(x[0])  # Relative x keeps epoch-ns precision in float64
+    y = np.asarray(y, dtype=np.float64)
+
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)  # threshold - 2 buckets over x[1:n-1]
+    counts = np.diff(edges)
+    avg_x = np.add.reduceat(x[:n - 1], edges[:-1]) / counts
+    avg_y = np.add.reduceat(y[:n - 1], edges[:-1]) / counts
+    avg_x = np.append(avg_x, x[-1])  # The last bucket looks ahead to the last point
+    avg_y = np.append(avg_y, y[-1])
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for bucket in range(threshold - 2):
+        lo, hi = edges[bucket], edges[bucket + 1]
+        next_x, next_y = avg_x[bucket + 1], avg_y[bucket + 1]
+        area = np.abs((x[a] - next_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (next_y - y[a]))
+        a = lo + int(np.argmax(area))
+        selected[bucket + 1] = a
+    return selected
+
+
+def lttb(timestamps, values, threshold):
+    """Downsample a line series with LTTB; returns (timestamps, values)."""
+    indices = lttb_indices(timestamps, values, threshold)
+    return np.asarray(timestamps)[indices], np.asarray(values)[indices]
+
+
+def _bucket_bounds(timestamps, max_points):
+    """(starts, bucket start timestamps) of the finest ladder step that fits within max_points."""
+    for timeframe in CANDLE_LADDER:
+        buckets = bucket_starts(timestamps, timeframe)
+        starts = np.flatnonzero(np.diff(buckets, prepend=buckets[0] - 1))
+        if len(starts) <= max_points:
+            return starts, buckets[starts]
+    # Even daily candles are too many: merge equal runs of days
+    starts = starts[::math.ceil(len(starts) / max_points)]
+    return starts, buckets[starts]
+
+
+def ohlc_downsample(df, max_points):
+    """
+    Re-bucket one symbol's time-ordered bars into at most `max_points` candles, using the finest
+    session-aligned size from CANDLE_LADDER that fits. Other numeric columns (e.g. moving
+    averages) take their value at each candle's last bar. Frames that already fit are returned as is.
+    """
+    if len(df) <= max_points:
+        return df
+    timestamps = to_epoch_ns(df['timestamp'])
+    starts, bucket_times = _bucket_bounds(timestamps, max_points)
+    ends = np.append(starts[1:], len(df)) - 1
+
+    result = {}
+    tz = getattr(df['timestamp'].dt, 'tz', None) if df['timestamp'].dtype.kind == 'M' else None
+    result['timestamp'] = pd.to_datetime(bucket_times, utc=True)
+    if tz is not None:
+        result['timestamp'] = result['timestamp'].tz_convert(tz)
+    for column in df.columns:
+        if column == 'timestamp':
+            continue
+        values = df[column].to_numpy()
+        if column == 'open':
+            result[column] = values[starts]
+        elif column == 'high':
+            result[column] = np.maximum.reduceat(values.astype(np.float64), starts)
+        elif column == 'low':
+            result[column] = np.minimum.reduceat(values.astype(np.float64), starts)
+        elif column == 'volume':
+            result[column] = np.add.reduceat(values.astype(np.float64), starts)
+        else:
+            result[column] = values[ends]  # close, indicators, symbol, source
+    return pd.DataFrame(result, columns=df.columns)
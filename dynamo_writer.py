@@ -0,0 +1,314 @@
+import os
+import random
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from botocore.exceptions import ClientError
+from bar_store import PRICE_COLUMNS, to_epoch_ns
+
+EXCHANGE_TZ = 'America/New_York'
+
+BATCH_LIMIT = 25  # Items per BatchWriteItem call
+THROTTLE_CODES = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded')
+
+# Sort-key prefix of packed session items, so they never interleave with per-minute ISO keys
+SESSION_PREFIX = 'S#'
+
+
+def dynamo_client():
+    """Low-level DynamoDB client; DYNAMO_ENDPOINT_URL points it at DynamoDB Local or moto."""
+    import boto3  # Imported here so only the dynamo backend pays for it
+    return boto3.client('dynamodb', endpoint_url=os.getenv('DYNAMO_ENDPOINT_URL') or None)
+
+
+def encode_items(df):
+    """
+    Encode a frame of bars as low-level DynamoDB items ({'N': '...'} / {'S': '...'} attribute
+    values). Numbers are formatted column by column with NumPy, so no Decimal objects are built;
+    NaN, ±inf and None fields are left out of the item (DynamoDB numbers must be finite).
+    """
+    if df.empty:
+        return []
+    encoded = {}
+    for column in df.columns:
+        values = df[column]
+        if values.dtype.kind in 'fiu':
+            numbers = values.to_numpy()
+            strings = numbers.astype(str).astype(object)
+            strings[~np.isfinite(numbers)] = None
+            encoded[column] = [None if value is None else {'N': value} for value in strings]
+        else:
+            encoded[column] = [None if value is None or value != value else {'S': str(value)} for value in values.to_numpy()]
+    columns = list(encoded)
+    return [
+        {column: value for column, value in zip(columns, row) if value is not None}
+        for row in zip(*encoded.values())
+    ]
+
+
+def pack_session(timestamps, values):
+    """Pack one symbol-day of bars into a compressed binary blob (int64 ns + float64 OHLCV)."""
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    payload = timestamps.tobytes() + np.ascontiguousarray(values, dtype=np.float64).tobytes()
+    return zlib.compress(payload, 1)
+
+
+def unpack_session(blob):
+    """Inverse of `pack_session`: returns (timestamps, values of shape (n, 5))."""
+    payload = zlib.decompress(blob)
+    n = len(payload) // (8 * (1 + len(PRICE_COLUMNS)))
+    timestamps = np.frombuffer(payload, dtype=np.int64, count=n)
+    values = np.frombuffer(payload, dtype=np.float64, offset=8 * n).reshape(n, len(PRICE_COLUMNS))
+    return timestamps, values
+
+
+def session_key(day):
+    return f"{SESSION_PREFIX}{day}"
+
+
+def session_days(timestamps, tz=EXCHANGE_TZ):
+    """Exchange-local session date ('YYYY-MM-DD') of each UTC epoch-ns timestamp."""
+    local = pd.DatetimeIndex(pd.to_datetime(timestamps, utc=True)).tz_convert(tz)
+    return np.asarray(local.strftime('%Y-%m-%d'))
+
+
+class _AdaptiveThrottle:
+    """
+    Shared AIMD pacing for all writer threads: every throttled call doubles the delay before
+    each send, and every clean call halves it again.
+    """
+
+    def __init__(self, base_delay=0.05, max_delay=5.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.delay = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        delay = self.delay
+        if delay > 0:
+            time.sleep(delay * (1 + random.random() * 0.2))
+
+    def throttled(self):
+        with self._lock:
+            self.delay = min(max(self.delay * 2, self.base_delay), self.max_delay)
+
+    def succeeded(self):
+        with self._lock:
+            self.delay = self.delay / 2 if self.delay > self.base_delay / 4 else 0.0
+
+
+class DynamoBatchWriter:
+    """
+    Parallel BatchWriteItem writer for the market data table.
+
+    Items are deduplicated by key (a BatchWriteItem call may not hold the same key twice), split
+    into batches of 25 and sent from `workers` threads. UnprocessedItems are resent with
+    exponential backoff, and throughput exceptions slow every thread down through a shared
+    adaptive throttle instead of failing the write.
+
+    With `packed=True` a whole session of one symbol is stored as one item (sort key
+    'S#YYYY-MM-DD', bars in a compressed binary attribute), merged with what is already stored
+    for that day. Each session item carries a `version` that is checked when the merged item is
+    put back, so concurrent writers to one session never lose each other's bars: on a conflict
+    the session is read again, re-merged and retried.
+    """
+
+    def __init__(self, table_name, client=None, workers=8, packed=False, max_retries=10, base_delay=0.05, max_delay=5.0):
+        self.table_name = table_name
+        self.client = client or dynamo_client()
+        self.workers = workers
+        self.packed = packed
+        self.max_retries = max_retries
+        self.throttle = _AdaptiveThrottle(base_delay, max_delay)
+        self.items_written = 0
+        self.retries = 0
+        self.throttled = 0
+        self.conflicts = 0  # Packed session puts retried because another writer got there first
+        self._lock = threading.Lock()
+
+    def write_records(self, records):
+        """Upsert row dicts (the TinyDB item shape). Returns the number of items written."""
+        if not records:
+            return 0
+        df = pd.DataFrame.from_records(records)
+        if self.packed:
+            return self.write_sessions(df)
+        return self.write_items(encode_items(df))
+
+    def write_batch(self, batch):
+        """Upsert a BarBatch. Returns the number of items written."""
+        if batch.empty:
+            return 0
+        df = batch.to_record_frame()
+        if self.packed:
+            return self.write_sessions(df)
+        return self.write_items(encode_items(df))
+
+    def write_items(self, items):
+        """Write encoded items in parallel batches; raises if any batch is still unprocessed after retries."""
+        unique = {}
+        for item in items:
+            unique[(item['symbol']['S'], item['timestamp']['S'])] = item  # Later duplicates win
+        items = list(unique.values())
+        batches = [items[i:i + BATCH_LIMIT] for i in range(0, len(items), BATCH_LIMIT)]
+        if len(batches) == 1 or self.workers == 1:
+            for batch in batches:
+                self._write_batch(batch)
+        else:
+            with ThreadPoolExecutor(min(self.workers, len(batches))) as executor:
+                list(executor.map(self._write_batch, batches))  # Re-raises the first failure
+        return len(items)
+
+    def write_sessions(self, df):
+        """
+        Merge a frame of bars into the packed session items of their symbol-days, one conditional
+        PutItem per session (BatchWriteItem takes no conditions). Returns the number of sessions written.
+        """
+        sessions = self._sessions(df)
+        existing = self._get_sessions(list(sessions))
+        tasks = [(key, *bars, existing.get(key)) for key, bars in sessions.items()]
+        if len(tasks) == 1 or self.workers == 1:
+            for task in tasks:
+                self._put_session(*task)
+        else:
+            with ThreadPoolExecutor(min(self.workers, len(tasks))) as executor:
+                list(executor.map(lambda task: self._put_session(*task), tasks))
+        return len(tasks)
+
+    def _write_batch(self, batch):
+        requests = [{'PutRequest': {'Item': item}} for item in batch]
+        delay = self.throttle.base_delay
+        for attempt in range(self.max_retries + 1):
+            self.throttle.wait()
+            try:
+                response = self.client.batch_write_item(RequestItems={self.table_name: requests})
+            except ClientError as e:
+                if e.response['Error']['Code'] not in THROTTLE_CODES:
+                    raise
+                self._count(throttled=1)
+                self.throttle.throttled()
+            else:
+                written = len(requests)
+                requests = response.get('UnprocessedItems', {}).get(self.table_name, [])
+                self._count(written=written - len(requests))
+                if not requests:
+                    self.throttle.succeeded()
+                    return
+                self.throttle.throttled()  # Unprocessed items mean the table is at capacity
+            if attempt < self.max_retries:
+                self._count(retries=1)
+                time.sleep(delay * (1 + random.random()))
+                delay = min(delay * 2, self.throttle.max_delay)
+        raise RuntimeError(f"{len(requests)} DynamoDB items still unprocessed after {self.max_retries} retries.")
+
+    def _count(self, written=0, retries=0, throttled=0, conflicts=0):
+        with self._lock:
+            self.items_written += written
+            self.retries += retries
+            self.throttled += throttled
+            self.conflicts += conflicts
+
+    def _sessions(self, df):
+        """The new bars of each (symbol, day): {key: (timestamps, values, source)}."""
+        timestamps = to_epoch_ns(df['timestamp'])
+        days = session_days(timestamps)
+        symbols = df['symbol'].to_numpy()
+        values = df[list(PRICE_COLUMNS)].to_numpy(dtype=np.float64)
+        sources = df['source'].to_numpy() if 'source' in df else np.full(len(df), None, dtype=object)
+        groups = pd.DataFrame({'symbol': symbols, 'day': days}).groupby(['symbol', 'day'], sort=False).indices
+        return {key: (timestamps[rows], values[rows], sources[rows[0]]) for key, rows in groups.items()}
+
+    def _put_session(self, key, ts, vals, source, stored):
+        """Put one merged session item, conditional on the version read; re-read and retry on a conflict."""
+        symbol, day = key
+        delay = self.throttle.base_delay
+        for attempt in range(self.max_retries + 1):
+            item, condition = self._session_item(symbol, day, ts, vals, source, stored)
+            self.throttle.wait()
+            try:
+                self.client.put_item(TableName=self.table_name, Item=item, **condition)
+            except ClientError as e:
+                code = e.response['Error']['Code']
+                if code == 'ConditionalCheckFailedException':
+                    self._count(conflicts=1)
+                    stored = self._get_sessions([key]).get(key)  # Merge into what the other writer stored
+                    continue
+                if code not in THROTTLE_CODES:
+                    raise
+                self._count(throttled=1)
+                self.throttle.throttled()
+            else:
+                self._count(written=1)
+                self.throttle.succeeded()
+                return
+            if attempt < self.max_retries:
+                self._count(retries=1)
+                time.sleep(delay * (1 + random.random()))
+                delay = min(delay * 2, self.throttle.max_delay)
+        raise RuntimeError(f"Session {symbol} {day} still not written after {self.max_retries} retries.")
+
+    @staticmethod
+    def _session_item(symbol, day, ts, vals, source, stored):
+        """The merged session item and the put condition that the stored version is unchanged."""
+        version = None
+        if stored is not None:
+            stored_ts, stored_vals, version = stored
+            ts = np.concatenate([stored_ts, ts])
+            vals = np.concatenate([stored_vals, vals])
+        # Sort by time and keep the last version of each bar (new bars win over stored ones)
+        order = np.argsort(ts, kind='stable')
+        ts, vals = ts[order], vals[order]
+        keep = np.append(ts[1:] != ts[:-1], True)
+        item = {
+            'symbol': {'S': symbol},
+            'timestamp': {'S': session_key(day)},
+            'bars': {'B': pack_session(ts[keep], vals[keep])},
+            'count': {'N': str(int(keep.sum()))},
+            'version': {'N': str((version or 0) + 1)},
+        }
+        if source is not None:
+            item['source'] = {'S': str(source)}
+        if version is None:  # No item yet, or one written before versions existed
+            condition = {'ConditionExpression': 'attribute_not_exists(#v)'}
+        else:
+            condition = {'ConditionExpression': '#v = :v', 'ExpressionAttributeValues': {':v': {'N': str(version)}}}
+        condition['ExpressionAttributeNames'] = {'#v': 'version'}
+        return item, condition
+
+    def _get_sessions(self, keys):
+        """Fetch stored sessions for (symbol, day) keys with BatchGetItem: {key: (timestamps, values, version)}."""
+        stored = {}
+        for offset in range(0, len(keys), 100):
+            request = {self.table_name: {'Keys': [
+                {'symbol': {'S': symbol}, 'timestamp': {'S': session_key(day)}} for symbol, day in keys[offset:offset + 100]
+            ]}}
+            while request:
+                response = self.client.batch_get_item(RequestItems=request)
+                for item in response['Responses'].get(self.table_name, []):
+                    day = item['timestamp']['S'][len(SESSION_PREFIX):]
+                    version = int(item['version']['N']) if 'version' in item else None
+                    stored[(item['symbol']['S'], day)] = (*unpack_session(item['bars']['B']), version)
+                request = response.get('UnprocessedKeys') or None
+                if request:
+                    time.sleep(self.throttle.base_delay)
+        return stored
+
+
+def decode_items(items, columns=None):
+    """
+    Decode low-level per-bar items into {'timestamp': epoch ns, column: float64 array, ...}.
+    `columns` limits the numeric columns; by default every numeric attribute is decoded.
+    Missing values become NaN. String attributes other than the keys (e.g. source) are skipped.
+    """
+    if columns is None:
+        columns = list(dict.fromkeys(name for item in items for name, value in item.items() if 'N' in value))
+    arrays = {'timestamp': to_epoch_ns(np.array([item['timestamp']['S'] for item in items], dtype=object))}
+    for column in columns:
+        # NumPy parses the decimal strings in one pass, without Decimal objects
+        arrays[column] = np.array([item[column]['N'] if column in item else 'nan' for item in items]).astype(np.float64)
+    return arrays
+
@@ -0,0 +1,473 @@
+"""
+Offline stand-in for the ib_insync IB object, so the app, the backfill and the benchmarks can run
+without TWS or IB Gateway. It implements the subset of the API this project uses: connecting,
+contract qualification, historical bars (with keepUpToDate streaming), 5-second real-time bars and
+the current time.
+
+Bars come from `market_data.json` (replayed) or from a seeded random walk (synthetic), mapped
+onto a virtual clock that starts at the current time and runs `speed` times faster than the wall
+clock. Overnight and weekend gaps are skipped while bars are being streamed, so a replay at 1000x
+delivers a minute bar every 60 ms.
+
+IBClient uses it when given `ib=FakeIB(...)`, or for every client when IB_FAKE is set:
+    IB_FAKE=replay (or synthetic), IB_FAKE_DATA=market_data.json, IB_FAKE_SPEED=1000
+"""
+import asyncio
+import functools
+import logging
+import os
+import time
+import zlib
+import numpy as np
+import pandas as pd
+from eventkit import Event
+from ib_insync import BarData, BarDataList, ContractDetails, RealTimeBar, RealTimeBarList
+from bar_cache import window_bounds
+from bar_store import PRICE_COLUMNS, to_epoch_ns
+from resample import resample_arrays
+
+EXCHANGE_TZ = 'America/New_York'
+NS_PER_SECOND = 1_000_000_000
+BAR_NS = 60 * NS_PER_SECOND
+WEEK_NS = 7 * 86400 * NS_PER_SECOND
+SESSION_OPEN = pd.Timedelta(hours=9, minutes=30)
+SESSION_BARS = 390
+
+# Long names for contract details; other symbols get a generated one
+NAMES = {'SPY': 'SPDR S&P 500 ETF TRUST', 'QQQ': 'INVESCO QQQ TRUST SERIES 1', 'AAPL': 'APPLE INC',
+         'MSFT': 'MICROSOFT CORP', 'GOOGL': 'ALPHABET INC-CL A'}
+
+# IB barSizeSetting -> resample timeframe; minute bars are served as they are
+BAR_SIZES = {'1 min': None, '5 mins': '5m', '15 mins': '15m', '30 mins': '30m', '1 hour': '1h', '1 day': '1D'}
+
+
+def _wall_ns(utc_ns):
+    """Exchange-local wall time of a UTC epoch-ns instant, as naive epoch ns."""
+    return pd.Timestamp(utc_ns, tz='UTC').tz_convert(EXCHANGE_TZ).tz_localize(None).value
+
+
+def _utc_ns(wall):
+    """Inverse of `_wall_ns` for an array; sessions never fall in a DST transition hour."""
+    return pd.DatetimeIndex(np.asarray(wall, dtype='datetime64[ns]')).tz_localize(EXCHANGE_TZ).as_unit('ns').asi8
+
+
+class ReplayBars:
+    """
+    Minute bars recorded in a TinyDB file such as market_data.json. The recording is repeated
+    every whole number of weeks it spans, shifted in exchange-local time, so any window of the
+    virtual clock finds bars on the same weekdays and times of day as the original sessions.
+    """
+
+    def __init__(self, path='market_data.json'):
+        from tinydb import TinyDB
+        db = TinyDB(path, access_mode='r')
+        try:
+            frame = pd.DataFrame(db.all())
+        finally:
+            db.close()
+        if frame.empty:
+            raise ValueError(f"No bars to replay in {path}")
+        frame['timestamp'] = to_epoch_ns(frame['timestamp'].to_numpy(dtype=object))
+        frame = frame.sort_values('timestamp', kind='stable').drop_duplicates(['symbol', 'timestamp'], keep='last')
+        wall = pd.to_datetime(frame['timestamp'], utc=True).dt.tz_convert(EXCHANGE_TZ).dt.tz_localize(None)
+        frame['wall'] = wall.astype('datetime64[ns]').to_numpy().astype(np.int64)
+        first_monday = (wall.min().normalize() - pd.Timedelta(days=wall.min().dayofweek)).value
+        self.anchor = first_monday
+        self.period = -(-(int(frame['wall'].max()) + 1 - first_monday) // WEEK_NS) * WEEK_NS
+        self._series = {
+            symbol: (group['wall'].to_numpy(), group[list(PRICE_COLUMNS)].to_numpy(dtype=np.float64))
+            for symbol, group in frame.groupby('symbol', sort=False)
+        }
+        logging.info(f"FakeIB: replaying {len(frame)} bars of {len(self._series)} symbols from {path} "
+                     f"every {self.period // WEEK_NS} weeks.")
+
+    def symbols(self):
+        return list(self._series)
+
+    def has_symbol(self, symbol):
+        return symbol in self._series
+
+    def bars(self, symbol, start, end):
+        """Bars of `symbol` starting in [start, end) (UTC epoch ns): (timestamps, values of shape (n, 5))."""
+        series = self._series.get(symbol)
+        if series is None or end <= start:
+            return np.empty(0, dtype=np.int64), np.empty((0, len(PRICE_COLUMNS)))
+        wall, values = series
+        lo, hi = _wall_ns(start), _wall_ns(end)
+        first = (lo - self.anchor) // self.period
+        last = (hi - self.anchor) // self.period
+        walls, rows = [], []
+        for repeat in range(first, last + 1):
+            shift = repeat * self.period
+            i, j = np.searchsorted(wall, [lo - shift, hi - shift])
+            walls.append(wall[i:j] + shift)
+            rows.append(values[i:j])
+        return _utc_ns(np.concatenate(walls)), np.concatenate(rows)
+
+
+@functools.lru_cache(maxsize=4096)
+def _synthetic_session(seed, symbol, day):
+    """One regular session of minute bars for a symbol: (wall-clock ns, values), fixed per seed."""
+    rng = np.random.default_rng([seed, zlib.crc32(symbol.encode()), day])
+    level = (20 + zlib.crc32(symbol.encode()) % 480) * np.exp(rng.normal(0, 0.02))
+    close = level * np.exp(np.cumsum(rng.normal(0, 0.0008, SESSION_BARS)))
+    open_ = np.concatenate([[level], close[:-1]])
+    spread = np.abs(rng.normal(0, 0.0004, (2, SESSION_BARS)))
+    values = np.column_stack([
+        open_,
+        np.maximum(open_, close) * (1 + spread[0]),
+        np.minimum(open_, close) * (1 - spread[1]),
+        close,
+        rng.integers(1, 50, SESSION_BARS) * 100.0,
+    ]).round(2)
+    wall = pd.Timestamp(day, unit='D').value + SESSION_OPEN.value + np.arange(SESSION_BARS, dtype=np.int64) * BAR_NS
+    values.setflags(write=False)
+    return wall, values
+
+
+class SyntheticBars:
+    """Random-walk minute bars for any symbol on every weekday session, reproducible per seed."""
+
+    def __init__(self, seed=0):
+        self.seed = seed
+
+    def symbols(self):
+        return []
+
+    def has_symbol(self, symbol):
+        return True
+
+    def bars(self, symbol, start, end):
+        if end <= start:
+            return np.empty(0, dtype=np.int64), np.empty((0, len(PRICE_COLUMNS)))
+        lo, hi = _wall_ns(start), _wall_ns(end)
+        days = pd.bdate_range(pd.Timestamp(lo).normalize(), pd.Timestamp(hi).normalize())
+        walls, rows = [], []
+        for day in days.asi8 // (86400 * NS_PER_SECOND):
+            wall, values = _synthetic_session(self.seed, symbol, int(day))
+            i, j = np.searchsorted(wall, [lo, hi])
+            walls.append(wall[i:j])
+            rows.append(values[i:j])
+        if not walls:
+            return np.empty(0, dtype=np.int64), np.empty((0, len(PRICE_COLUMNS)))
+        return _utc_ns(np.concatenate(walls)), np.concatenate(rows)
+
+
+class ReplayClock:
+    """
+    Virtual time in UTC epoch ns: starts at `start` (default: now) and advances `speed` times
+    faster than the wall clock. `skip` jumps ahead, e.g. over a night without bars.
+    """
+
+    def __init__(self, speed=1.0, start=None):
+        if speed <= 0:
+            raise ValueError("Replay speed must be positive.")
+        self.speed = float(speed)
+        self.origin = time.time_ns() if start is None else int(start)
+        self._started = time.monotonic_ns()
+
+    def now(self):
+        return self.origin + int((time.monotonic_ns() - self._started) * self.speed)
+
+    def skip(self, ns):
+        self.origin += max(int(ns), 0)
+
+    def real_seconds(self, ns):
+        """Wall-clock seconds that `ns` of virtual time take."""
+        return ns / NS_PER_SECOND / self.speed
+
+
+def _price_path(values, fraction):
+    """
+    Where a bar stands `fraction` (0..1] of the way through: its open -> low -> high -> close
+    path (high first on down bars) up to that point, as (open, high, low, close, volume).
+    """
+    open_, high, low, close, volume = values
+    turns = (open_, low, high, close) if close >= open_ else (open_, high, low, close)
+    position = min(fraction, 1.0) * 3
+    reached = int(position)
+    price = turns[3] if reached >= 3 else turns[reached] + (turns[reached + 1] - turns[reached]) * (position - reached)
+    seen = (*turns[:reached + 1], price)
+    return open_, max(seen), min(seen), price, volume * min(fraction, 1.0)
+
+
+class _Feed:
+    __slots__ = ('symbol', 'bars', 'realtime', 'last_start')
+
+    def __init__(self, symbol, bars, realtime):
+        self.symbol = symbol
+        self.bars = bars
+        self.realtime = realtime
+        self.last_start = None
+
+
+class FakeIB:
+    """
+    Drop-in for ib_insync.IB backed by a bar source (`ReplayBars` or `SyntheticBars`).
+
+    keepUpToDate historical bars and real-time bars are driven by one task on the event loop of
+    the first subscription: every `tick_seconds` of virtual time it updates the forming minute bar
+    (bars.updateEvent(bars, False)), appends the next one (bars.updateEvent(bars, True)) or emits a
+    5-second RealTimeBar, as IB does. `emitted` counts the updates sent.
+    """
+
+    def __init__(self, source=None, speed=1.0, clock=None, tick_seconds=5):
+        self.source = source if source is not None else SyntheticBars()
+        self.clock = clock if clock is not None else ReplayClock(speed)
+        self.tick_ns = int(tick_seconds * NS_PER_SECOND)
+        if BAR_NS % self.tick_ns:
+            raise ValueError("tick_seconds must divide a minute.")
+        self.emitted = 0
+        self.disconnectedEvent = Event('disconnectedEvent')
+        self.errorEvent = Event('errorEvent')
+        self._connected = False
+        self._feeds = []
+        self._task = None
+
+    # Connection
+
+    def connect(self, host='127.0.0.1', port=7497, clientId=1, timeout=4, readonly=False, account=''):
+        self._connected = True
+        return self
+
+    async def connectAsync(self, host='127.0.0.1', port=7497, clientId=1, timeout=4, readonly=False, account=''):
+        return self.connect(host, port, clientId)
+
+    def isConnected(self):
+        return self._connected
+
+    def disconnect(self):
+        connected, self._connected = self._connected, False
+        for feed in list(self._feeds):
+            self._cancel(feed.bars)
+        if connected:
+            self.disconnectedEvent.emit()
+
+    def reqCurrentTime(self):
+        return pd.Timestamp(self.clock.now(), tz='UTC').to_pydatetime()
+
+    async def reqCurrentTimeAsync(self):
+        return self.reqCurrentTime()
+
+    # Event loop helpers, as on IB
+
+    @staticmethod
+    def _loop():
+        try:
+            return asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.get_event_loop()
+
+    def run(self, *awaitables, timeout=None):
+        loop = self._loop()
+        if not awaitables:
+            loop.run_forever()
+            return None
+        future = asyncio.gather(*awaitables) if len(awaitables) > 1 else awaitables[0]
+        return loop.run_until_complete(asyncio.wait_for(future, timeout) if timeout else future)
+
+    def sleep(self, secs=0.02):
+        self._loop().run_until_complete(asyncio.sleep(secs))
+        return True
+
+    # Contracts
+
+    def qualifyContracts(self, *contracts):
+        qualified = []
+        for contract in contracts:
+            if not self.source.has_symbol(contract.symbol):
+                logging.warning(f"FakeIB: unknown contract {contract.symbol}.")
+                continue
+            contract.conId = zlib.crc32(contract.symbol.encode()) & 0x7FFFFFFF
+            contract.localSymbol = contract.tradingClass = contract.symbol
+            contract.primaryExchange = contract.primaryExchange or 'ARCA'
+            qualified.append(contract)
+        return qualified
+
+    async def qualifyContractsAsync(self, *contracts):
+        return self.qualifyContracts(*contracts)
+
+    def reqContractDetails(self, contract):
+        if not self.qualifyContracts(contract):
+            self.errorEvent.emit(-1, 200, 'No security definition has been found for the request', contract)
+            return []
+        return [ContractDetails(
+            contract=contract, longName=NAMES.get(contract.symbol, f"{contract.symbol} INC"), timeZoneId='US/Eastern',
+            tradingHours=self._session_hours('0400', '2000'), liquidHours=self._session_hours('0930', '1600'),
+        )]
+
+    async def reqContractDetailsAsync(self, contract):
+        return self.reqContractDetails(contract)
+
+    def _session_hours(self, open_, close):
+        """IB's tradingHours format for the coming week: 'YYYYMMDD:HHMM-YYYYMMDD:HHMM;YYYYMMDD:CLOSED;...'."""
+        today = pd.Timestamp(self.clock.now(), tz='UTC').tz_convert(EXCHANGE_TZ).normalize()
+        days = [(today + pd.Timedelta(days=i)) for i in range(7)]
+        return ';'.join(f"{day:%Y%m%d}:{open_}-{day:%Y%m%d}:{close}" if day.dayofweek < 5 else f"{day:%Y%m%d}:CLOSED"
+                        for day in days)
+
+    # Historical and streaming bars
+
+    def reqHistoricalData(self, contract, endDateTime, durationStr, barSizeSetting, whatToShow, useRTH,
+                          formatDate=1, keepUpToDate=False, chartOptions=(), timeout=60):
+        if not self._connected:
+            raise ConnectionError("FakeIB is not connected.")
+        if barSizeSetting not in BAR_SIZES:
+            raise ValueError(f"FakeIB does not serve {barSizeSetting!r} bars.")
+        if keepUpToDate and (barSizeSetting != '1 min' or endDateTime):
+            raise ValueError("FakeIB streams 1-minute bars ending now only.")
+        end = self.clock.now() if not endDateTime else self._parse_end(endDateTime)
+        start = int(window_bounds(durationStr, useRTH, now=pd.Timestamp(end, tz='UTC'))[0].value)
+        # Only bars that have closed by `end`; a stream adds the forming bar on its next tick
+        timestamps, values = self.source.bars(contract.symbol, start, end - BAR_NS + 1)
+        bars = BarDataList()
+        bars.extend(self._bar_data(timestamps, values, BAR_SIZES[barSizeSetting]))
+        bars.reqId = len(self._feeds) + 1
+        bars.contract = contract
+        bars.endDateTime = endDateTime
+        bars.durationStr = durationStr
+        bars.barSizeSetting = barSizeSetting
+        bars.whatToShow = whatToShow
+        bars.useRTH = useRTH
+        bars.keepUpToDate = keepUpToDate
+        if keepUpToDate:
+            self._subscribe(_Feed(contract.symbol, bars, realtime=False))
+        return bars
+
+    async def reqHistoricalDataAsync(self, contract, endDateTime, durationStr, barSizeSetting, whatToShow, useRTH,
+                                     formatDate=1, keepUpToDate=False, chartOptions=(), timeout=60):
+        return self.reqHistoricalData(contract, endDateTime, durationStr, barSizeSetting, whatToShow, useRTH,
+                                      formatDate, keepUpToDate)
+
+    def cancelHistoricalData(self, bars):
+        self._cancel(bars)
+
+    def reqRealTimeBars(self, contract, barSize, whatToShow, useRTH, realTimeBarsOptions=()):
+        if not self._connected:
+            raise ConnectionError("FakeIB is not connected.")
+        bars = RealTimeBarList()
+        bars.reqId = len(self._feeds) + 1
+        bars.contract = contract
+        bars.barSize = barSize
+        bars.whatToShow = whatToShow
+        bars.useRTH = useRTH
+        self._subscribe(_Feed(contract.symbol, bars, realtime=True))
+        return bars
+
+    def cancelRealTimeBars(self, bars):
+        self._cancel(bars)
+
+    @staticmethod
+    def _parse_end(value):
+        """IB endDateTime: 'YYYYMMDD-HH:MM:SS' (UTC), 'YYYYMMDD HH:MM:SS [tz]' or a datetime."""
+        if isinstance(value, str) and len(value) >= 17 and value[8] == '-':
+            return pd.Timestamp(value[:8] + ' ' + value[9:], tz='UTC').value
+        if isinstance(value, str) and len(value.split()) == 3:
+            day, clock, tz = value.split()
+            return pd.Timestamp(f"{day} {clock}", tz=tz).tz_convert('UTC').value
+        ts = pd.Timestamp(value)
+        return (ts.tz_localize(EXCHANGE_TZ) if ts.tzinfo is None else ts).value
+
+    @staticmethod
+    def _bar_data(timestamps, values, timeframe):
+        if timeframe is not None and len(timestamps):
+            candles = resample_arrays(timestamps, *values.T, timeframe)
+            timestamps = candles['timestamp']
+            values = np.column_stack([candles[name] for name in PRICE_COLUMNS])
+        dates = pd.to_datetime(timestamps, utc=True).tz_convert(EXCHANGE_TZ)
+        dates = dates.date if timeframe == '1D' else dates.to_pydatetime()
+        return [BarData(date=date, open=o, high=h, low=l, close=c, volume=v, average=(h + l + c) / 3, barCount=1)
+                for date, (o, h, l, c, v) in zip(dates, values.tolist())]
+
+    def _subscribe(self, feed):
+        self._feeds.append(feed)
+        if self._task is None or self._task.done():
+            self._task = self._loop().create_task(self._stream())
+
+    def _cancel(self, bars):
+        self._feeds = [feed for feed in self._feeds if feed.bars is not bars]
+        if not self._feeds and self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _stream(self):
+        """Advance the subscribed feeds one tick of virtual time at a time."""
+        now = self.clock.now()
+        tick = now - now % self.tick_ns
+        while self._feeds:
+            tick += self.tick_ns
+            tick = self._skip_gap(tick)
+            delay = self.clock.real_seconds(tick - self.clock.now())
+            await asyncio.sleep(max(delay, 0))
+            for feed in list(self._feeds):
+                self._advance(feed, tick)
+
+    def _skip_gap(self, tick):
+        """Jump the clock to the next bar when no subscribed symbol has one in the coming minute."""
+        bar_start = (tick - 1) - (tick - 1) % BAR_NS
+        if any(len(self.source.bars(feed.symbol, bar_start, bar_start + 1)[0]) for feed in self._feeds):
+            return tick
+        upcoming = [self.source.bars(feed.symbol, bar_start, bar_start + 8 * 86400 * NS_PER_SECOND)[0][:1]
+                    for feed in self._feeds]
+        upcoming = [int(found[0]) for found in upcoming if len(found)]
+        if not upcoming:
+            return tick
+        target = min(upcoming) + self.tick_ns
+        if target > tick:
+            self.clock.skip(target - tick)
+        return max(target, tick)
+
+    def _advance(self, feed, tick):
+        bar_start = (tick - 1) - (tick - 1) % BAR_NS
+        timestamps, values = self.source.bars(feed.symbol, bar_start, bar_start + 1)
+        if not len(timestamps):
+            return
+        fraction = (tick - bar_start) / BAR_NS
+        bars = feed.bars
+        if feed.realtime:
+            previous = _price_path(values[0], fraction - self.tick_ns / BAR_NS)
+            current = _price_path(values[0], fraction)
+            bar = RealTimeBar(
+                time=pd.Timestamp(tick - self.tick_ns, tz='UTC').to_pydatetime(), endTime=-1, open_=previous[3],
+                high=max(previous[3], current[3]), low=min(previous[3], current[3]), close=current[3],
+                volume=current[4] - previous[4], wap=current[3], count=1
+            )
+            bars.append(bar)
+            del bars[:-1024]  # Only the newest bars are kept, as IB does for real-time bars
+            self._emit(bars, True)
+            return
+        o, h, l, c, v = _price_path(values[0], fraction)
+        date = pd.Timestamp(bar_start, tz='UTC').tz_convert(EXCHANGE_TZ).to_pydatetime()
+        bar = BarData(date=date, open=o, high=h, low=l, close=c, volume=v, average=(h + l + c) / 3, barCount=1)
+        is_new = feed.last_start != bar_start and not (bars and bars[-1].date == date)
+        feed.last_start = bar_start
+        if is_new:
+            bars.append(bar)
+        else:
+            bars[-1] = bar
+        self._emit(bars, is_new)
+
+    def _emit(self, bars, has_new_bar):
+        self.emitted += 1
+        bars.updateEvent.emit(bars, has_new_bar)
+
+
+@functools.lru_cache(maxsize=None)
+def _shared(kind, path, speed, seed):
+    """Source and clock shared by every FakeIB built from the same settings in this process."""
+    source = ReplayBars(path) if kind == 'replay' else SyntheticBars(seed)
+    return source, ReplayClock(speed)
+
+
+def fake_ib_from_env():
+    """A FakeIB configured by IB_FAKE (replay or synthetic), IB_FAKE_DATA, IB_FAKE_SPEED and IB_FAKE_SEED."""
+    kind = os.getenv('IB_FAKE', 'synthetic').lower()
+    if kind not in ('replay', 'synthetic'):
+        raise ValueError(f"Unknown IB_FAKE source: {kind} (expected replay or synthetic)")
+    source, clock = _shared(
+        kind,
+        os.getenv('IB_FAKE_DATA', 'market_data.json'),
+        float(os.getenv('IB_FAKE_SPEED', '1')),
+        int(os.getenv('IB_FAKE_SEED', '0')),
+    )
+    return FakeIB(source, clock=clock)
@@ -1,26 +1,82 @@
-from ib_insync import IB, Stock
 import pandas as pd
+import os
 import time
 import logging
 from aws_dynamo import MarketDataStore
-from plotly.subplots import make_subplots
-import plotly.graph_objects as go
-from threading import Thread
-import random
+from bar_batch import BarBatch
+from bar_cache import BarCache
+from bar_stream import BarStream
+from contracts import default_contracts
+from metrics import BARS_INGESTED, timed
+from pacing import default_scheduler
+from threading import Lock, Thread
 import asyncio  # Add this import
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
+
+class ClientIdAllocator:
+    """
+    Hands out IB client IDs round-robin from [first, last], skipping IDs held by live clients in
+    this process, so concurrent clients never collide with each other.
+    """
+
+    def __init__(self, first=2, last=999):
+        self.first = first
+        self.last = last
+        self._next = first
+        self._held = set()
+        self._lock = Lock()
+
+    def acquire(self):
+        with self._lock:
+            for _ in range(self.last - self.first + 1):
+                client_id = self._next
+                self._next = self.first if client_id == self.last else client_id + 1
+                if client_id not in self._held:
+                    self._held.add(client_id)
+                    return client_id
+        raise RuntimeError(f"All IB client IDs {self.first}-{self.last} are in use.")
+
+    def release(self, client_id):
+        with self._lock:
+            self._held.discard(client_id)
+
+
+client_ids = ClientIdAllocator()
+
+
+def new_ib():
+    """An ib_insync IB, or the offline FakeIB (fake_ib.py) when IB_FAKE is set."""
+    if os.getenv('IB_FAKE'):
+        from fake_ib import fake_ib_from_env
+        return fake_ib_from_env()
+    from ib_insync import IB  # Imported by the first client, not by importing the app
+    return IB()
+
+
 class IBClient:
-    def __init__(self, host='127.0.0.1', port=7497, client_id=1):  # Default port updated to 7496
-        if client_id <= 1:
-            client_id = random.randint(2, 1000)  # Ensure client_id is greater than 1
+    def __init__(self, host='127.0.0.1', port=7497, client_id=1, bar_cache=None, pacing=None, ib=None, contracts=None,
+                 bus=None):  # Default port updated to 7496
+        self._owns_client_id = client_id <= 1
+        if self._owns_client_id:
+            client_id = client_ids.acquire()  # Ensure client_id is greater than 1 and unique in this process
         self.host = host
         self.port = port
         self.client_id = client_id
-        self.ib = IB()
-        self.data_store = MarketDataStore()
+        self.ib = ib if ib is not None else new_ib()
+        self.pacing = pacing or default_scheduler
+        self.contracts = contracts if contracts is not None else default_contracts
+        self._stream = None
+        if bar_cache is not None:
+            self.data_store = bar_cache.store
+            self.bar_cache = bar_cache
+        else:
+            self.data_store = MarketDataStore()
+            self.bar_cache = BarCache(self.data_store)
+        # Live bars go to InfluxDB through the bus's 'live' topic when there is one, otherwise inline
+        self.bus = bus if bus is not None else self.bar_cache.bus
 
     def connect(self, retries=3, delay=5):
         # Ensure an asyncio event loop is set for the current thread
@@ -35,7 +91,8 @@ class IBClient:
         for attempt in range(retries):
             try:
                 logging.info(f"Attempting to connect to IB API at {self.host}:{self.port} with client ID {self.client_id} (Attempt {attempt + 1}/{retries})...")
-                self.ib.connect(self.host, self.port, self.client_id)
+                with timed('ib_connect'):
+                    self.ib.connect(self.host, self.port, self.client_id)
                 logging.info("Connection successful.")
                 return
             except ConnectionRefusedError as e:
@@ -50,11 +107,46 @@ class IBClient:
                     ) from e
             except Exception as e:
                 if "client id is already in use" in str(e).lower():
-                    logging.warning(f"Client ID {self.client_id} is already in use. Incrementing client ID and retrying...")
-                    self.client_id += 1
+                    logging.warning(f"Client ID {self.client_id} is already in use. Picking another client ID and retrying...")
+                    self._next_client_id()
+                else:
+                    raise
+
+    async def connect_async(self, retries=3, delay=5):
+        """Async counterpart of `connect`, for use from a running event loop."""
+        if self.is_connected():
+            return
+        for attempt in range(retries):
+            try:
+                logging.info(f"Attempting to connect to IB API at {self.host}:{self.port} with client ID {self.client_id} (Attempt {attempt + 1}/{retries})...")
+                with timed('ib_connect'):
+                    await self.ib.connectAsync(self.host, self.port, self.client_id)
+                logging.info("Connection successful.")
+                return
+            except ConnectionRefusedError as e:
+                logging.error(f"Connection failed: {e}")
+                if attempt < retries - 1:
+                    await asyncio.sleep(delay)
+                else:
+                    raise RuntimeError(
+                        f"Failed to connect to IB API at {self.host}:{self.port} after {retries} attempts. "
+                        f"Ensure TWS/IB Gateway is running and API access is enabled."
+                    ) from e
+            except Exception as e:
+                if "client id is already in use" in str(e).lower():
+                    logging.warning(f"Client ID {self.client_id} is already in use. Picking another client ID and retrying...")
+                    self._next_client_id()
                 else:
                     raise
 
+    def _next_client_id(self):
+        """Move to another client ID after IB reported this one in use (e.g. by another process)."""
+        if self._owns_client_id:
+            client_ids.release(self.client_id)
+            self.client_id = client_ids.acquire()
+        else:
+            self.client_id += 1
+
     def disconnect(self):
         """Disconnect from the IB API."""
         if self.is_connected():
@@ -64,50 +156,132 @@ class IBClient:
         else:
             logging.info("Already disconnected from IB API.")
 
+    def close(self):
+        """Disconnect and give the client ID back to the allocator."""
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        self.disconnect()
+        if self._owns_client_id:
+            client_ids.release(self.client_id)
+            self._owns_client_id = False
+
     def is_connected(self):
         """Check if the client is connected to the IB API."""
         return self.ib.isConnected()
 
-    def fetch_historical_data(self, symbol, duration='1 D', bar_size='1 min'):
+    def qualify(self, symbol):
+        """The qualified Stock for a symbol from the contract cache; IB is only asked on a miss. None if unknown."""
+        return self.contracts.qualify(self.ib, symbol)
+
+    async def qualify_async(self, symbol):
+        """Async counterpart of `qualify`."""
+        return await self.contracts.qualify_async(self.ib, symbol)
+
+    def fetch_historical_data(self, symbol, duration='1 D', bar_size='1 min', what_to_show='TRADES', use_rth=True):
+        """
+        Fetch historical bars through the read-through bar cache. Bars already held in memory or
+        in MarketDataStore are served locally and only the missing part is requested from IB.
+        """
+        return self.bar_cache.get(self.request_bars, symbol, duration, bar_size, what_to_show, use_rth)
+
+    async def fetch_historical_data_async(self, symbol, duration='1 D', bar_size='1 min', what_to_show='TRADES', use_rth=True):
+        """Async counterpart of `fetch_historical_data`."""
+        return await self.bar_cache.get_async(self.request_bars_async, symbol, duration, bar_size, what_to_show, use_rth)
+
+    def request_bars(self, symbol, duration='1 D', bar_size='1 min', end_datetime='', what_to_show='TRADES', use_rth=True):
+        """
+        Request historical bars straight from IB, bypassing the cache and the store. Returns a BarBatch.
+        """
         self.connect()
-        contract = Stock(symbol, 'SMART', 'USD')
-        self.ib.qualifyContracts(contract)
-        data = self.ib.reqHistoricalData(
-            contract,
-            endDateTime='',
-            durationStr=duration,
-            barSizeSetting=bar_size,
-            whatToShow='TRADES',
-            useRTH=True
-        )
+        contract = self.qualify(symbol)
+        if contract is None:
+            return BarBatch.empty_batch(symbol, 'IBKR')
+        self.pacing.wait((symbol, end_datetime, duration, bar_size, what_to_show, use_rth), symbol)
+        with timed('ib_historical'):
+            data = self.ib.reqHistoricalData(
+                contract,
+                endDateTime=end_datetime,
+                durationStr=duration,
+                barSizeSetting=bar_size,
+                whatToShow=what_to_show,
+                useRTH=use_rth
+            )
+        return self._bars_to_batch(symbol, data, duration, bar_size)
+
+    async def request_bars_async(self, symbol, duration='1 D', bar_size='1 min', end_datetime='', what_to_show='TRADES', use_rth=True):
+        """Async counterpart of `request_bars`."""
+        await self.connect_async()
+        contract = await self.qualify_async(symbol)
+        if contract is None:
+            return BarBatch.empty_batch(symbol, 'IBKR')
+        await self.pacing.acquire((symbol, end_datetime, duration, bar_size, what_to_show, use_rth), symbol)
+        with timed('ib_historical'):
+            data = await self.ib.reqHistoricalDataAsync(
+                contract,
+                endDateTime=end_datetime,
+                durationStr=duration,
+                barSizeSetting=bar_size,
+                whatToShow=what_to_show,
+                useRTH=use_rth
+            )
+        return self._bars_to_batch(symbol, data, duration, bar_size)
 
+    @staticmethod
+    def _bars_to_batch(symbol, data, duration, bar_size):
         if not data:
             logging.warning(f"No data returned for {symbol} with duration {duration} and bar size {bar_size}.")
-            return pd.DataFrame()  # Return an empty DataFrame if no data is fetched
+            return BarBatch.empty_batch(symbol, 'IBKR')
 
         logging.info(f"Fetched {len(data)} bars for {symbol} with duration {duration} and bar size {bar_size}.")
-        time.sleep(1)  # Handle pacing limits
-        df = pd.DataFrame([{
-            'timestamp': bar.date.isoformat(),
-            'open': bar.open,
-            'high': bar.high,
-            'low': bar.low,
-            'close': bar.close,
-            'volume': bar.volume,
-            'symbol': symbol,
-            'source': 'IBKR'
-        } for bar in data])
-        self.data_store.batch_write(df.to_dict('records'))
-        return df
-
-    def fetch_multiple_symbols(self, symbols, duration='1 D', bar_size='1 min'):
-        """
-        Fetch historical data for multiple symbols and combine into a single DataFrame.
+        BARS_INGESTED.inc(len(data), kind='historical')
+        return BarBatch.from_ib_bars(symbol, data, source='IBKR')
+
+    async def stream_multiple_symbols(self, symbols, duration='1 D', bar_size='1 min', max_in_flight=8):
         """
+        Fetch many symbols concurrently and yield (symbol, DataFrame) pairs as each one completes.
+        At most `max_in_flight` requests are outstanding; the pacing scheduler spaces them out.
+        A symbol that fails is logged and yielded with an empty DataFrame.
+        """
+        await self.connect_async()
+        semaphore = asyncio.Semaphore(max_in_flight)
+
+        async def fetch_one(symbol):
+            async with semaphore:
+                try:
+                    return symbol, await self.fetch_historical_data_async(symbol, duration, bar_size)
+                except Exception as e:
+                    logging.error(f"Failed to fetch data for {symbol}: {e}")
+                    return symbol, pd.DataFrame()
+
+        tasks = [asyncio.ensure_future(fetch_one(symbol)) for symbol in symbols]
+        try:
+            for completed, task in enumerate(asyncio.as_completed(tasks), start=1):
+                symbol, data = await task
+                logging.info(f"[{completed}/{len(tasks)}] Fetched {len(data)} bars for {symbol}")
+                yield symbol, data
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def fetch_multiple_symbols(self, symbols, duration='1 D', bar_size='1 min', max_in_flight=8, on_result=None):
+        """
+        Fetch historical data for multiple symbols concurrently and combine into a single DataFrame.
+        `on_result(symbol, data, completed, total)` is called as each symbol arrives.
+        """
+        self.connect()
+        return self.ib.run(self.fetch_multiple_symbols_async(symbols, duration, bar_size, max_in_flight, on_result))
+
+    async def fetch_multiple_symbols_async(self, symbols, duration='1 D', bar_size='1 min', max_in_flight=8, on_result=None):
+        """Async counterpart of `fetch_multiple_symbols`."""
+        results = {}
+        async for symbol, data in self.stream_multiple_symbols(symbols, duration, bar_size, max_in_flight):
+            results[symbol] = data
+            if on_result is not None:
+                on_result(symbol, data, len(results), len(symbols))
         all_data = []
         for symbol in symbols:
-            logging.info(f"Fetching data for {symbol}")
-            data = self.fetch_historical_data(symbol, duration, bar_size)
+            data = results[symbol]
             data['symbol'] = symbol  # Add symbol column to identify data
             all_data.append(data)
         return pd.concat(all_data, ignore_index=True)
@@ -117,8 +291,9 @@ class IBClient:
         Fetch live minute-level data for a symbol and write it to InfluxDB.
         """
         self.connect()
-        contract = Stock(symbol, 'SMART', 'USD')
-        self.ib.qualifyContracts(contract)
+        contract = self.qualify(symbol)
+        if contract is None:
+            return pd.DataFrame()
         data = self.ib.reqHistoricalData(
             contract,
             endDateTime='',
@@ -127,59 +302,68 @@ class IBClient:
             whatToShow='TRADES',
             useRTH=True
         )
-        df = pd.DataFrame([{
-            'timestamp': bar.date.isoformat(),
-            'open': bar.open,
-            'high': bar.high,
-            'low': bar.low,
-            'close': bar.close,
-            'volume': bar.volume
-        } for bar in data])
-
-        # Write data to InfluxDB
-        from influxdb_client_3 import Point
-        from influxdb_handler import client, database  # Ensure influxdb_handler is imported
-
-        for _, row in df.iterrows():
-            point = (
-                Point("ohlcv")
-                .tag("symbol", symbol)
-                .field("open", row['open'])
-                .field("high", row['high'])
-                .field("low", row['low'])
-                .field("close", row['close'])
-                .field("volume", row['volume'])
-                .time(row['timestamp'])
-            )
-            client.write(database=database, record=point)
+        batch = BarBatch.from_ib_bars(symbol, data, source='IBKR')
+        BARS_INGESTED.inc(len(batch), kind='live')
+
+        if self.bus is not None:
+            self.bus.publish('live', batch)
+        else:
+            # Queue the whole batch on the background InfluxDB write pipeline
+            from influxdb_handler import get_write_pipeline  # Ensure influxdb_handler is imported
+            get_write_pipeline().write_frame(batch, measurement="ohlcv", tags={"symbol": symbol})
+
+        return batch.to_frame()
 
-        return df
+    def stream_live_data(self, symbol='SPY', callback=None, mode='keep_up_to_date', write_influx=True):
+        """
+        Subscribe once to streaming 1-minute bars for a symbol instead of re-requesting the day.
+        Only new or updated bars are passed to `callback(symbol, bar, is_new)` and written to
+        InfluxDB. Returns the symbol's BarRingBuffer.
+        """
+        if self._stream is None:
+            self._stream = BarStream(self, mode=mode)
+        if write_influx:
+            self._stream.subscribe(symbol, self._write_bar_to_influx)
+        return self._stream.subscribe(symbol, callback)
+
+    def _write_bar_to_influx(self, symbol, bar, is_new):
+        if self.bus is not None:
+            self.bus.publish('live', BarBatch.from_frame(pd.DataFrame([bar]), symbol))
+            return
+        from influxdb_handler import get_write_pipeline  # Ensure influxdb_handler is imported
+        # Runs in the IB event loop's callback: drop the bar (counted) rather than stall the loop
+        get_write_pipeline().write_frame(pd.DataFrame([bar]), measurement="ohlcv", tags={"symbol": symbol}, block=False)
 
     def render_live_chart(self, symbol='SPY', update_interval=5):
         """
-        Render a live chart for the given symbol.
+        Render a live chart for the given symbol from a single streaming subscription.
         """
+        from plotly.subplots import make_subplots  # Only needed here, so not imported with the module
+        import plotly.graph_objects as go
         def update_chart():
             fig = make_subplots(rows=1, cols=1)
             fig.add_trace(go.Candlestick(name=symbol, x=[], open=[], high=[], low=[], close=[]))
+            buffer = self.stream_live_data(symbol)
+            rendered_version = None
 
             while True:
-                df = self.fetch_live_data(symbol, duration='1 D', bar_size='1 min')
-                fig.data[0].x = df['timestamp']
-                fig.data[0].open = df['open']
-                fig.data[0].high = df['high']
-                fig.data[0].low = df['low']
-                fig.data[0].close = df['close']
-                fig.update_layout(title=f"Live Chart for {symbol}")
-                fig.show()
-                time.sleep(update_interval)
+                if buffer.version != rendered_version:
+                    rendered_version = buffer.version
+                    df = buffer.snapshot()
+                    fig.data[0].x = df['timestamp']
+                    fig.data[0].open = df['open']
+                    fig.data[0].high = df['high']
+                    fig.data[0].low = df['low']
+                    fig.data[0].close = df['close']
+                    fig.update_layout(title=f"Live Chart for {symbol}")
+                    fig.show()
+                self.ib.sleep(update_interval)  # Keeps the IB event loop, and so the stream, running
 
         thread = Thread(target=update_chart, daemon=True)
         thread.start()
 
-    def get_available_symbols(self):
+    def get_available_symbols(self, query='', limit=50):
         """
-        Return a list of available stock symbols.
+        Return known stock symbols from the contract cache, or the best matches for `query`.
         """
-        # Example: Replace this with actual logic to fetch symbols from IBKR or a predefined list
-        return ['SPY', 'QQQ', 'AAPL', 'MSFT', 'GOOGL']
+        return self.contracts.search(query, limit)
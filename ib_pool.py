@@ -0,0 +1,152 @@
+import asyncio
+import inspect
+import logging
+import os
+import threading
+from ib_client import IBClient
+from metrics import timed
+
+
+class IBConnectionPool:
+    """
+    A small pool of long-lived IBClient connections for the web app.
+
+    All clients live on one dedicated asyncio loop thread, since ib_insync connections are bound
+    to the loop they were opened on. Request threads hand work to that loop with `run`, which
+    borrows an idle client, makes sure it is connected and returns the result. A background task
+    health-checks idle clients every `health_interval` seconds (reqCurrentTime with a timeout)
+    and reconnects the ones that dropped, so requests don't pay for a TCP handshake.
+    """
+
+    def __init__(self, host='127.0.0.1', port=7497, size=2, bar_cache=None, pacing=None,
+                 health_interval=30, health_timeout=5):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.bar_cache = bar_cache
+        self.pacing = pacing
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.connects = 0  # Connection (re)opens, including the first one per client
+        self.clients = []
+        self._idle = None
+        self._loop = None
+        self._thread = None
+        self._health_task = None
+        self._started = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the loop thread. Connections are opened on first use and then kept open."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run_loop, name='ib-pool', daemon=True)
+                self._thread.start()
+                self._started.wait()
+        return self
+
+    def _run_loop(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._idle = asyncio.Queue()
+        # The clients (and their IB objects) are created on the loop thread they will run on
+        self.clients = [
+            IBClient(self.host, self.port, bar_cache=self.bar_cache, pacing=self.pacing)
+            for _ in range(self.size)
+        ]
+        for client in self.clients:
+            self._idle.put_nowait(client)
+        self._health_task = self._loop.create_task(self._health_loop())
+        self._started.set()
+        self._loop.run_forever()
+
+    def run(self, func, timeout=None, connect=True):
+        """
+        Call `func(client)` on the pool loop with a borrowed client and return its result.
+        The client is connected first unless `connect` is False. `func` may return a coroutine
+        (e.g. from an `*_async` method), which is awaited. Blocks the calling thread for at most
+        `timeout` seconds.
+        """
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(self._borrow(func, connect), self._loop)
+        return future.result(timeout)
+
+    def call(self, func, timeout=None):
+        """
+        Call `func()` on the pool loop without borrowing a client, for work on connections the
+        pool does not manage (e.g. LiveFeed's streaming connection). Coroutines are awaited.
+        """
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(self._call(func), self._loop)
+        return future.result(timeout)
+
+    @staticmethod
+    async def _call(func):
+        result = func()
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    async def _borrow(self, func, connect):
+        with timed('ib_pool_borrow'):
+            client = await self._idle.get()
+        try:
+            if connect:
+                await self._ensure_connected(client)
+            result = func(client)
+            if inspect.isawaitable(result):
+                result = await result
+            return result
+        finally:
+            self._idle.put_nowait(client)
+
+    async def _ensure_connected(self, client):
+        if not client.is_connected():
+            self.connects += 1
+            await client.connect_async(retries=1)
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            for _ in range(self._idle.qsize()):
+                client = self._idle.get_nowait()
+                try:
+                    await self._check(client)
+                finally:
+                    self._idle.put_nowait(client)
+
+    async def _check(self, client):
+        try:
+            if client.is_connected():
+                await asyncio.wait_for(client.ib.reqCurrentTimeAsync(), self.health_timeout)
+            else:
+                await self._ensure_connected(client)
+        except Exception as e:
+            # A connection that stopped answering is dropped; the next borrow reconnects it
+            logging.warning(f"IB pool: client {client.client_id} failed its health check ({e}).")
+            client.disconnect()
+
+    def close(self):
+        """Disconnect every client and stop the loop thread."""
+        if self._thread is None:
+            return
+
+        async def shutdown():
+            self._health_task.cancel()
+            for client in self.clients:
+                client.close()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._thread = None
+
+
+def pool_from_env(bar_cache=None):
+    """Build a pool configured by IB_HOST, IB_PORT and IB_POOL_SIZE."""
+    return IBConnectionPool(
+        host=os.getenv('IB_HOST', '127.0.0.1'),
+        port=int(os.getenv('IB_PORT', '7497')),
+        size=int(os.getenv('IB_POOL_SIZE', '2')),
+        bar_cache=bar_cache,
+    )
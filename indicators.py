@@ -0,0 +1,285 @@
+import argparse
+import logging
+import math
+from collections import deque
+import numpy as np
+import pandas as pd
+from bar_batch import BarBatch
+from bar_store import PRICE_COLUMNS, to_epoch_ns
+
+try:
+    import talib  # Built by the Dockerfile; the pandas path below gives the same values without it
+except ImportError:
+    talib = None
+
+EXCHANGE_TZ = 'America/New_York'
+
+
+def _local_days(timestamps, tz=EXCHANGE_TZ):
+    """Exchange-local calendar day of each UTC epoch-ns timestamp, as int64 day numbers."""
+    local = pd.DatetimeIndex(pd.to_datetime(np.asarray(timestamps, dtype=np.int64), utc=True)).tz_convert(tz)
+    return local.tz_localize(None).as_unit('ns').asi8 // (86400 * 1_000_000_000)
+
+
+class _RollingWindow:
+    """
+    Running sum and sum of squares over the last `size` values, taken about a shift (a recent
+    window mean) so the variance does not cancel catastrophically for large, tightly spread
+    values. Both are recomputed from the window every `size` pushes, so rounding error from the
+    add/subtract updates cannot build up over a long stream (amortized O(1) per push).
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.values = deque()
+        self.shift = 0.0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self._pushes = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def push(self, value, replace=False):
+        if replace and self.values:
+            self._remove(self.values.pop())
+        elif len(self.values) == self.size:
+            self._remove(self.values.popleft())
+        self.values.append(value)
+        self._pushes += 1
+        if self._pushes >= self.size:
+            self._recompute()
+        else:
+            value -= self.shift
+            self.total += value
+            self.total_sq += value * value
+
+    def _remove(self, value):
+        value -= self.shift
+        self.total -= value
+        self.total_sq -= value * value
+
+    def _recompute(self):
+        self._pushes = 0
+        self.shift = math.fsum(self.values) / len(self.values)
+        deviations = [value - self.shift for value in self.values]
+        self.total = math.fsum(deviations)
+        self.total_sq = math.fsum(d * d for d in deviations)
+
+    def mean(self):
+        return self.shift + self.total / len(self.values)
+
+    def std(self):
+        n = len(self.values)
+        return math.sqrt(max(self.total_sq - self.total * self.total / n, 0.0) / (n - 1))
+
+
+class SMA:
+    """Simple moving average of the close."""
+
+    def __init__(self, window):
+        self.window = self.warmup = window
+        self._values = _RollingWindow(window)
+
+    def update(self, timestamp, open_, high, low, close, volume, replace=False):
+        self._values.push(float(close), replace)
+        return self._values.mean() if len(self._values) == self.window else math.nan
+
+    def compute(self, timestamps, open_, high, low, close, volume):
+        if talib is not None:
+            return talib.SMA(close, timeperiod=self.window)
+        return pd.Series(close).rolling(self.window).mean().to_numpy()
+
+
+class EMA:
+    """Exponential moving average of the close, seeded with the SMA of the first `window` bars (as TA-Lib does)."""
+
+    def __init__(self, window):
+        self.window = window
+        self.warmup = 10 * window  # The seed's weight has decayed below 1e-8 after this many bars
+        self.alpha = 2.0 / (window + 1)
+        self._state = (0, 0.0, math.nan)  # (bars seen, sum of the seed bars, ema)
+        self._previous = self._state
+
+    def update(self, timestamp, open_, high, low, close, volume, replace=False):
+        if replace:
+            self._state = self._previous
+        self._previous = self._state
+        count, seed, ema = self._state
+        count += 1
+        if count < self.window:
+            seed += close
+        elif count == self.window:
+            ema = (seed + close) / self.window
+        else:
+            ema += self.alpha * (close - ema)
+        self._state = (count, seed, ema)
+        return ema
+
+    def compute(self, timestamps, open_, high, low, close, volume):
+        if talib is not None:
+            return talib.EMA(close, timeperiod=self.window)
+        result = np.full(len(close), np.nan)
+        if len(close) >= self.window:
+            tail = np.array(close[self.window - 1:], dtype=np.float64)
+            tail[0] = close[:self.window].mean()
+            result[self.window - 1:] = pd.Series(tail).ewm(alpha=self.alpha, adjust=False).mean().to_numpy()
+        return result
+
+
+class VWAP:
+    """Volume-weighted average of the typical price (high + low + close) / 3, reset every local session day."""
+
+    warmup = 1  # IndicatorEngine.warm always replays the whole current session day
+
+    def __init__(self, tz=EXCHANGE_TZ):
+        self.tz = tz
+        self._day = None  # (day start, next day start) in UTC epoch ns
+        self._state = (0.0, 0.0)  # (cumulative price * volume, cumulative volume)
+        self._previous = self._state
+
+    def update(self, timestamp, open_, high, low, close, volume, replace=False):
+        if replace:
+            self._state = self._previous
+        elif self._day is None or not self._day[0] <= timestamp < self._day[1]:
+            start = pd.Timestamp(timestamp, tz='UTC').tz_convert(self.tz).normalize()
+            self._day = (start.as_unit('ns').value, (start + pd.DateOffset(days=1)).as_unit('ns').value)
+            self._state = (0.0, 0.0)
+        self._previous = self._state
+        price_volume, total_volume = self._state
+        price_volume += (high + low + close) / 3 * volume
+        total_volume += volume
+        self._state = (price_volume, total_volume)
+        return price_volume / total_volume if total_volume else math.nan
+
+    def compute(self, timestamps, open_, high, low, close, volume):
+        days = _local_days(timestamps, self.tz)
+        price_volume = pd.Series((high + low + close) / 3 * volume).groupby(days).cumsum().to_numpy()
+        total_volume = pd.Series(volume).groupby(days).cumsum().to_numpy()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(total_volume != 0, price_volume / total_volume, np.nan)
+
+
+class RollingVolatility:
+    """Sample standard deviation of one-bar log returns over the last `window` returns."""
+
+    def __init__(self, window):
+        self.window = window
+        self.warmup = window + 1
+        self._returns = _RollingWindow(window)
+        self._closes = (None, None)  # (close before the latest bar, latest close)
+
+    def update(self, timestamp, open_, high, low, close, volume, replace=False):
+        previous, latest = self._closes
+        if not replace:
+            previous = latest
+        self._closes = (previous, close)
+        if previous is None:
+            return math.nan
+        self._returns.push(math.log(close / previous), replace)
+        return self._returns.std() if len(self._returns) == self.window else math.nan
+
+    def compute(self, timestamps, open_, high, low, close, volume):
+        return pd.Series(np.log(close)).diff().rolling(self.window).std().to_numpy()
+
+
+# Column name -> factory; the columns are stored next to the bars under these names
+DEFAULT_INDICATORS = {
+    'sma20': lambda: SMA(20),
+    'sma50': lambda: SMA(50),
+    'ema20': lambda: EMA(20),
+    'vwap': lambda: VWAP(),
+    'volatility20': lambda: RollingVolatility(20),
+}
+
+
+def _arrays(df):
+    timestamps = to_epoch_ns(df['timestamp'])
+    return (timestamps, *(np.asarray(df[name], dtype=np.float64) for name in PRICE_COLUMNS))
+
+
+def compute_indicators(df, specs=DEFAULT_INDICATORS):
+    """
+    Compute every indicator over a time-ordered frame (or BarBatch) of one symbol's bars in one vectorized pass
+    (TA-Lib for SMA/EMA when it is installed). Returns a dict of float arrays keyed by column name.
+    """
+    if df.empty:
+        return {name: np.empty(0) for name in specs}
+    arrays = _arrays(df)
+    return {name: np.asarray(factory().compute(*arrays), dtype=np.float64) for name, factory in specs.items()}
+
+
+class IndicatorEngine:
+    """
+    Keeps the indicators of one symbol up to date as bars arrive, in O(1) per bar.
+
+    A bar with the same timestamp as the previous one (a bar that was still forming) replaces
+    its earlier contribution. Bars must otherwise arrive in time order.
+    """
+
+    def __init__(self, specs=DEFAULT_INDICATORS):
+        self.specs = specs
+        self.indicators = {name: factory() for name, factory in specs.items()}
+        self.last_timestamp = None
+        self.values = dict.fromkeys(specs, math.nan)
+
+    @property
+    def warmup(self):
+        """Number of trailing bars to replay so every indicator is warmed up."""
+        return max(indicator.warmup for indicator in self.indicators.values())
+
+    def update(self, timestamp, open_, high, low, close, volume):
+        """Apply one bar and return the indicator values at that bar."""
+        timestamp = int(timestamp)
+        if self.last_timestamp is not None and timestamp < self.last_timestamp:
+            raise ValueError("Bars must arrive in time order")
+        replace = timestamp == self.last_timestamp
+        bar = (timestamp, float(open_), float(high), float(low), float(close), float(volume))
+        self.values = {name: indicator.update(*bar, replace=replace) for name, indicator in self.indicators.items()}
+        self.last_timestamp = timestamp
+        return self.values
+
+    def update_frame(self, df):
+        """Apply a time-ordered frame (or BarBatch) of bars; returns a dict of arrays aligned with its rows."""
+        results = {name: np.full(len(df), np.nan) for name in self.specs}
+        for row, bar in enumerate(zip(*_arrays(df))):
+            for name, value in self.update(*bar).items():
+                results[name][row] = value
+        return results
+
+    def warm(self, df):
+        """
+        Reset the state from the tail of a time-ordered frame. VWAP needs the whole current
+        session day, so the replay starts at the earlier of the warm-up window and that day.
+        """
+        self.__init__(self.specs)
+        if df.empty:
+            return self
+        days = _local_days(to_epoch_ns(df['timestamp']))
+        session_start = int(np.searchsorted(days, days[-1], side='left'))
+        self.update_frame(df.iloc[min(max(len(df) - self.warmup, 0), session_start):])
+        return self
+
+
+def backfill_indicators(store, symbol, specs=DEFAULT_INDICATORS):
+    """Recompute a symbol's indicators over its whole stored history and write them back."""
+    batch = BarBatch.from_frame(store.get_bars(symbol, columns=[*PRICE_COLUMNS, 'source']), symbol)
+    if batch.empty:
+        return 0
+    batch.extras = compute_indicators(batch, specs)
+    store.batch_write(batch)
+    logging.info(f"Backfilled {len(specs)} indicators over {len(batch)} {symbol} bars.")
+    return len(batch)
+
+
+if __name__ == '__main__':
+    from aws_dynamo import MarketDataStore
+
+    parser = argparse.ArgumentParser(description='Recompute stored indicator columns.')
+    parser.add_argument('symbols', nargs='+')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    store = MarketDataStore()
+    for symbol in args.symbols:
+        backfill_indicators(store, symbol)
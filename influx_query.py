@@ -0,0 +1,141 @@
+"""
+Columnar bar reads from InfluxDB 3 over SQL and Arrow Flight.
+
+InfluxBarReader sends SQL (or InfluxQL) through InfluxDBClient3.query, which returns the result
+as one Arrow table, and hands it on as an Arrow table, NumPy columns (views of the Arrow buffers
+when the result arrived in one chunk without nulls) or a BarBatch. Filtering by symbol and time
+range and, with `timeframe`, OHLC aggregation into `date_bin` buckets run on the server, so a
+month of minute bars downsampled to 30m candles transfers a few hundred rows, not ten thousand.
+
+Buckets match resample.py for regular-hours bars: intraday candles are aligned to :30 past the
+hour in UTC (the session open is 9:30 New York time in both EST and EDT) and daily candles are
+labelled with New York midnight.
+
+Usage: python influx_query.py SPY [--days 5] [--timeframe 30m]
+"""
+import argparse
+import numpy as np
+import pandas as pd
+from bar_batch import BarBatch
+from bar_store import PRICE_COLUMNS, to_timestamp_ns
+from metrics import timed
+from resample import TIMEFRAMES, bucket_starts
+
+# date_bin origins: :30 UTC is the 9:30 session open, 04:00 UTC is at or before New York midnight
+INTRADAY_ORIGIN = '1970-01-01T00:30:00Z'
+DAILY_ORIGIN = '1970-01-01T04:00:00Z'
+
+
+def _literal(ns):
+    """An RFC 3339 timestamp literal for epoch ns (generated, never user text)."""
+    return "'" + np.datetime_as_string(np.datetime64(int(ns), 'ns')) + "Z'"
+
+
+def _identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _numpy(column, dtype):
+    """
+    A column as a NumPy array: a zero-copy view for one chunk without nulls, otherwise one
+    concatenating copy (nulls become NaN).
+    """
+    import pyarrow as pa  # Only needed for Arrow results, not to import the module
+    if pa.types.is_timestamp(column.type):
+        column = column.cast(pa.int64())
+    if column.num_chunks == 1 and column.null_count == 0:
+        values = column.chunk(0).to_numpy(zero_copy_only=False)
+    else:
+        values = column.to_numpy()
+    return values.astype(dtype, copy=False)
+
+
+class InfluxBarReader:
+    """Bars of the `measurement` written by influx_writer (a symbol tag and OHLCV fields)."""
+
+    def __init__(self, client, database, measurement='ohlcv'):
+        self.client = client
+        self.database = database
+        self.measurement = measurement
+
+    def query(self, text, language='sql', **parameters):
+        """Run a query and return the whole result as an Arrow table."""
+        with timed('influx_query'):
+            return self.client.query(text, language=language, mode='all', database=self.database,
+                                     query_parameters=parameters or None)
+
+    def bars_sql(self, start=None, end=None, timeframe=None):
+        """
+        The SQL for one symbol's bars in [start, end), raw or aggregated into `timeframe` candles
+        (see resample.TIMEFRAMES). The symbol is bound as $symbol.
+        """
+        where = ['symbol = $symbol']
+        if start is not None:
+            where.append(f"time >= {_literal(to_timestamp_ns(start))}")
+        if end is not None:
+            where.append(f"time < {_literal(to_timestamp_ns(end))}")
+        source = f"FROM {_identifier(self.measurement)} WHERE {' AND '.join(where)}"
+        if timeframe is None:
+            return f"SELECT time, {', '.join(PRICE_COLUMNS)} {source} ORDER BY time"
+        if timeframe not in TIMEFRAMES:
+            raise ValueError(f"Unsupported timeframe: {timeframe}. Expected one of {list(TIMEFRAMES)}")
+        seconds = TIMEFRAMES[timeframe]
+        interval, origin = (f"{seconds} seconds", INTRADAY_ORIGIN) if seconds else ('1 day', DAILY_ORIGIN)
+        return (
+            f"SELECT date_bin(INTERVAL '{interval}', time, TIMESTAMP '{origin}') AS time, "
+            "first_value(open ORDER BY time) AS open, max(high) AS high, min(low) AS low, "
+            "last_value(close ORDER BY time) AS close, sum(volume) AS volume "
+            f"{source} GROUP BY 1 ORDER BY 1"
+        )
+
+    def table(self, symbol, start=None, end=None, timeframe=None):
+        """Bars (or `timeframe` candles) of `symbol` as an Arrow table with a UTC `time` column."""
+        return self.query(self.bars_sql(start, end, timeframe), symbol=symbol)
+
+    def arrays(self, symbol, start=None, end=None, timeframe=None):
+        """
+        The same as a dict of NumPy arrays keyed by 'timestamp' (UTC epoch ns, the candle start)
+        and OHLCV, as resample.resample_arrays returns them.
+        """
+        table = self.table(symbol, start, end, timeframe)
+        arrays = {'timestamp': _numpy(table.column('time'), np.int64)}
+        arrays.update((name, _numpy(table.column(name), np.float64)) for name in PRICE_COLUMNS)
+        if timeframe is not None and TIMEFRAMES[timeframe] is None and len(arrays['timestamp']):
+            arrays['timestamp'] = bucket_starts(arrays['timestamp'], '1D')  # One row per day
+        return arrays
+
+    def batch(self, symbol, start=None, end=None, timeframe=None):
+        arrays = self.arrays(symbol, start, end, timeframe)
+        return BarBatch(symbol, arrays['timestamp'], *(arrays[name] for name in PRICE_COLUMNS), source='influx')
+
+    def frame(self, symbol, start=None, end=None, timeframe=None):
+        """A bar frame with New York timestamps, the shape BarCache returns."""
+        return self.batch(symbol, start, end, timeframe).to_frame()
+
+    def symbols(self):
+        """The symbols that have bars in the measurement."""
+        table = self.query(f"SELECT DISTINCT symbol FROM {_identifier(self.measurement)} ORDER BY symbol")
+        return table.column('symbol').to_pylist()
+
+
+_reader = None
+
+
+def get_reader():
+    """The reader over the influxdb_handler client and database, created on first use."""
+    global _reader
+    if _reader is None:
+        from influxdb_handler import database, get_client
+        _reader = InfluxBarReader(get_client(), database)
+    return _reader
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print bars read from InfluxDB.')
+    parser.add_argument('symbol')
+    parser.add_argument('--days', type=int, default=1)
+    parser.add_argument('--timeframe', choices=list(TIMEFRAMES))
+    args = parser.parse_args()
+
+    start = pd.Timestamp.now(tz='UTC') - pd.Timedelta(days=args.days)
+    print(get_reader().frame(args.symbol, start, timeframe=args.timeframe).to_string())
@@ -0,0 +1,206 @@
+import logging
+import queue
+import random
+import threading
+import time
+from collections import deque
+import numpy as np
+from bar_store import PRICE_COLUMNS, to_epoch_ns
+from metrics import STAGE_SECONDS
+
+
+def _escape_tag(value):
+    return str(value).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+def frame_to_line_protocol(df, measurement='ohlcv', tags=None, tag_columns=(), fields=PRICE_COLUMNS, time_column='timestamp'):
+    """
+    Convert a whole DataFrame (or BarBatch) to an array of line protocol strings with nanosecond timestamps.
+
+    Columns are formatted with NumPy string operations instead of building a Point per row.
+    `tags` are constant tags applied to every line; `tag_columns` are taken from the frame.
+    NaN and infinite values, which line protocol cannot express, are left out of their line, and
+    rows without any finite field are skipped.
+    """
+    if df.empty:
+        return np.array([], dtype=str)
+    prefix = _escape_tag(measurement) + ''.join(f',{_escape_tag(k)}={_escape_tag(v)}' for k, v in (tags or {}).items())
+    lines = np.full(len(df), prefix, dtype=object)
+    for column in tag_columns:
+        values = df[column].astype(str)
+        escaped = values.map({value: _escape_tag(value) for value in values.unique()}).to_numpy(dtype=object)
+        lines = lines + f',{_escape_tag(column)}=' + escaped
+    field_set = np.full(len(df), '', dtype=object)
+    present = np.zeros(len(df), dtype=bool)  # Rows with at least one field so far
+    for field in fields:
+        values = np.asarray(df[field], dtype=np.float64)
+        pairs = f'{field}=' + values.astype(str).astype(object)
+        finite = np.isfinite(values)
+        if finite.all() and present.all():
+            field_set = field_set + ',' + pairs
+        elif finite.all() and not present.any():
+            field_set = pairs
+        else:
+            field_set = np.where(finite, field_set + np.where(present, ',', '').astype(object) + pairs, field_set)
+        present |= finite
+    timestamps = to_epoch_ns(df[time_column]).astype(str).astype(object)
+    lines = lines + ' ' + field_set + ' ' + timestamps
+    return lines if present.all() else lines[present]
+
+
+class InfluxWritePipeline:
+    """
+    Background writer that batches line protocol for InfluxDB.
+
+    Producers enqueue whole frames (or pre-built lines) and return immediately. A worker thread
+    coalesces them into batches of up to `batch_size` lines, flushing when a batch is full or
+    `flush_interval` seconds after its first line arrived, and retries failed writes with
+    exponential backoff. The queue holds at most `max_pending` lines; when it is full, producers
+    block (backpressure) for up to `put_timeout` seconds before queue.Full is raised, or with
+    `block=False` (for callers on the IB event loop) the lines are dropped and counted at once.
+    """
+
+    def __init__(self, client, database, batch_size=5000, flush_interval=1.0, max_pending=200_000,
+                 max_retries=5, backoff=0.5, max_backoff=30.0, put_timeout=None):
+        self.client = client
+        self.database = database
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.put_timeout = put_timeout
+        self.lines_written = 0
+        self.lines_dropped = 0
+        self.batches_written = 0
+        self.retries = 0
+        self.write_seconds = 0.0
+        self._chunks = deque()
+        self._pending = 0  # Lines queued and not yet taken by the worker
+        self._unfinished = 0  # Lines queued or being written
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def pending(self):
+        """Number of queued lines not yet picked up by the worker."""
+        return self._pending
+
+    @property
+    def bars_per_second(self):
+        """Lines written per second of time spent in write calls."""
+        return self.lines_written / self.write_seconds if self.write_seconds else 0.0
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='influx-writer', daemon=True)
+            self._thread.start()
+        return self
+
+    def write_frame(self, df, measurement='ohlcv', tags=None, tag_columns=(), fields=PRICE_COLUMNS, time_column='timestamp',
+                    block=True):
+        """Convert a DataFrame to line protocol and enqueue it."""
+        return self.write_lines(frame_to_line_protocol(df, measurement, tags, tag_columns, fields, time_column), block)
+
+    def write_lines(self, lines, block=True):
+        """
+        Enqueue line protocol strings. While the queue is full this blocks (see the class
+        docstring), or with `block=False` drops the lines and returns False.
+        """
+        self.start()
+        if len(lines) == 0:
+            return True
+        deadline = None if self.put_timeout is None else time.monotonic() + self.put_timeout
+        with self._cond:
+            # A chunk larger than max_pending is still accepted into an empty queue
+            while self._pending and self._pending + len(lines) > self.max_pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if not block or (remaining is not None and remaining <= 0):
+                    self.lines_dropped += len(lines)
+                    if not block:
+                        return False
+                    raise queue.Full(f"{self._pending} InfluxDB lines pending for {self.put_timeout}s")
+                self._cond.wait(remaining)
+            self._chunks.append(lines)
+            self._pending += len(lines)
+            self._unfinished += len(lines)
+            self._cond.notify_all()
+        return True
+
+    def flush(self):
+        """Block until everything enqueued so far has been written (or dropped after retries)."""
+        with self._cond:
+            while self._unfinished:
+                self._cond.wait()
+
+    def close(self):
+        self.flush()
+        with self._cond:
+            self._stop.set()
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _take(self):
+        """
+        Wait for lines, then until `batch_size` are queued or `flush_interval` has passed, and
+        take up to `batch_size` of them. Returns None once stopped with nothing queued.
+        """
+        with self._cond:
+            while not self._chunks:
+                if self._stop.is_set():
+                    return None
+                self._cond.wait()
+            deadline = time.monotonic() + self.flush_interval
+            while self._pending < self.batch_size and not self._stop.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch, size = [], 0
+            while self._chunks and size < self.batch_size:
+                chunk = self._chunks.popleft()
+                room = self.batch_size - size
+                if len(chunk) > room:
+                    self._chunks.appendleft(chunk[room:])
+                    chunk = chunk[:room]
+                batch.append(chunk)
+                size += len(chunk)
+            self._pending -= size
+            self._cond.notify_all()  # Wakes producers waiting for room
+        return np.concatenate(batch).tolist()
+
+    def _run(self):
+        while True:
+            lines = self._take()
+            if lines is None:
+                return
+            self._write(lines)
+            with self._cond:
+                self._unfinished -= len(lines)
+                self._cond.notify_all()
+
+    def _write(self, lines):
+        delay = self.backoff
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                self.client.write(database=self.database, record=lines, write_precision='ns')
+                elapsed = time.perf_counter() - started
+                self.write_seconds += elapsed
+                STAGE_SECONDS.observe(elapsed, stage='influx_write')
+                self.lines_written += len(lines)
+                self.batches_written += 1
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    self.lines_dropped += len(lines)
+                    logging.error(f"Dropping {len(lines)} lines after {attempt + 1} failed InfluxDB writes: {e}")
+                    return
+                self.retries += 1
+                logging.warning(f"InfluxDB write failed ({e}); retrying in {delay:.1f}s.")
+                time.sleep(delay * (1 + random.random() * 0.1))
+                delay = min(delay * 2, self.max_backoff)
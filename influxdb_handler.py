@@ -1,29 +1,55 @@
 import os
 import time
-import requests  # Import requests to fetch live data
-from datetime import datetime
-from influxdb_client_3 import InfluxDBClient3, Point
 from dotenv import load_dotenv  # Import dotenv to load environment variables
 from pytz import timezone  # Add this import
+import numpy as np
+import pandas as pd
+from bar_store import PRICE_COLUMNS, to_epoch_ns
+from influx_writer import InfluxWritePipeline, frame_to_line_protocol
+from resample import resample_arrays
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Load environment variables
-token = os.getenv("INFLUXDB_TOKEN")
-if not token:
-    raise EnvironmentError("INFLUXDB_TOKEN is not set. Please check your environment variables.")
+# InfluxDB configuration; the client itself is created by get_client() on first use
+org = os.getenv("INFLUXDB_ORG", "US East - Prod")
+host = os.getenv("INFLUXDB_HOST", "https://us-east-1-1.aws.cloud2.influxdata.com")
+database = os.getenv("INFLUXDB_BUCKET", "spy_ohlcv_1m")  # Ensure this is consistent across the project
 
-org = "US East - Prod"
-host = "https://us-east-1-1.aws.cloud2.influxdata.com"
-database = "spy_ohlcv_1m"
+_client = None
+_write_pipeline = None
 
-# Initialize InfluxDB client
-try:
-    client = InfluxDBClient3(host=host, token=token, org=org)
-    database = "spy_ohlcv_1m"  # Ensure this is consistent across the project
-except Exception as e:
-    raise ConnectionError(f"Failed to connect to InfluxDB: {e}")
+def get_client():
+    """
+    Return the shared InfluxDB client, creating it on first use.
+    Importing this module needs neither INFLUXDB_TOKEN nor the InfluxDB client library.
+    """
+    global _client
+    if _client is None:
+        token = os.getenv("INFLUXDB_TOKEN")
+        if not token:
+            raise EnvironmentError("INFLUXDB_TOKEN is not set. Please check your environment variables.")
+        from influxdb_client_3 import InfluxDBClient3
+        try:
+            _client = InfluxDBClient3(host=host, token=token, org=org)
+        except Exception as e:
+            raise ConnectionError(f"Failed to connect to InfluxDB: {e}")
+    return _client
+
+def __getattr__(name):
+    # `influxdb_handler.client` still works, and creates the client when first read
+    if name == "client":
+        return get_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def get_write_pipeline():
+    """
+    Return the shared background write pipeline, starting it on first use.
+    """
+    global _write_pipeline
+    if _write_pipeline is None:
+        _write_pipeline = InfluxWritePipeline(get_client(), database).start()
+    return _write_pipeline
 
 def delete_mock_data():
     """
@@ -36,17 +62,22 @@ def write_new_data(data):
     """
     Writes new data points to the InfluxDB database.
     """
-    for key in data:
-        point = (
-            Point("census")
-            .tag("location", data[key]["location"])
-            .field(data[key]["species"], data[key]["count"])
-        )
-        try:
-            client.write(database=database, record=point)
-        except Exception as e:
-            raise RuntimeError(f"Failed to write data to InfluxDB: {e}")
-        time.sleep(1)  # Separate points by 1 second
+    from influxdb_client_3 import Point
+    # Points are spaced one second apart by timestamp and sent in a single request,
+    # rather than written one by one with a sleep in between
+    start = time.time_ns()
+    lines = [
+        Point("census")
+        .tag("location", data[key]["location"])
+        .field(data[key]["species"], data[key]["count"])
+        .time(start + i * 1_000_000_000)
+        .to_line_protocol()
+        for i, key in enumerate(data)
+    ]
+    try:
+        get_client().write(database=database, record=lines, write_precision='ns')
+    except Exception as e:
+        raise RuntimeError(f"Failed to write data to InfluxDB: {e}")
     print("New data written to InfluxDB.")
 
 def fetch_live_data():
@@ -54,6 +85,7 @@ def fetch_live_data():
     Fetches live SPY data from a market data API.
     Replace 'YOUR_API_ENDPOINT' and 'YOUR_API_KEY' with actual values.
     """
+    import requests  # Only this example fetch needs it
     url = "https://api.example.com/spy-live-data"  # Replace with actual API endpoint
     headers = {"Authorization": "Bearer YOUR_API_KEY"}  # Replace with actual API key
     try:
@@ -63,49 +95,40 @@ def fetch_live_data():
     except Exception as e:
         raise RuntimeError(f"Failed to fetch live data: {e}")
 
-def aggregate_to_daily(data):
+def aggregate_to_daily(data, symbol=None):
     """
-    Aggregates minute-level data into daily candles.
+    Aggregates minute-level data into daily candles (America/New_York trading days).
     """
-    eastern = timezone('America/New_York')  # Define the time zone
-    daily_data = {}
-    for point in data:
-        # Parse timestamp with America/New_York time zone
-        date = datetime.fromisoformat(point["timestamp"]).astimezone(eastern).date()
-        if date not in daily_data:
-            daily_data[date] = {
-                "open": point["open"],
-                "high": point["high"],
-                "low": point["low"],
-                "close": point["close"],
-                "volume": point["volume"],
-            }
-        else:
-            daily_data[date]["high"] = max(daily_data[date]["high"], point["high"])
-            daily_data[date]["low"] = min(daily_data[date]["low"], point["low"])
-            daily_data[date]["close"] = point["close"]
-            daily_data[date]["volume"] += point["volume"]
-    return daily_data
-
-def write_daily_data(daily_data):
+    df = pd.DataFrame(data)
+    if symbol is not None and "symbol" in df:
+        df = df[df["symbol"] == symbol]
+    if df.empty:
+        return {}
+    timestamps = to_epoch_ns(df["timestamp"])
+    order = np.argsort(timestamps, kind="stable")
+    candles = resample_arrays(
+        timestamps[order], *(df[name].to_numpy()[order] for name in PRICE_COLUMNS), timeframe="1D"
+    )
+    dates = pd.to_datetime(candles["timestamp"], utc=True).tz_convert(timezone("America/New_York")).date
+    return {
+        date: {name: candles[name][i].item() for name in PRICE_COLUMNS}
+        for i, date in enumerate(dates)
+    }
+
+def write_daily_data(daily_data, symbol="SPY"):
     """
     Writes daily candle data to the InfluxDB database.
     """
-    for date, candle in daily_data.items():
-        point = (
-            Point("daily_candles")
-            .tag("symbol", "SPY")
-            .field("open", candle["open"])
-            .field("high", candle["high"])
-            .field("low", candle["low"])
-            .field("close", candle["close"])
-            .field("volume", candle["volume"])
-            .time(datetime.combine(date, datetime.min.time()))
-        )
-        try:
-            client.write(database=database, record=point)
-        except Exception as e:
-            raise RuntimeError(f"Failed to write daily data to InfluxDB: {e}")
+    if not daily_data:
+        print("No daily data to write.")
+        return
+    df = pd.DataFrame.from_dict(daily_data, orient="index")
+    df["timestamp"] = pd.to_datetime(df.index)
+    lines = frame_to_line_protocol(df, measurement="daily_candles", tags={"symbol": symbol})
+    try:
+        get_client().write(database=database, record=lines.tolist(), write_precision='ns')
+    except Exception as e:
+        raise RuntimeError(f"Failed to write daily data to InfluxDB: {e}")
     print("Daily data written to InfluxDB.")
 
 if __name__ == "__main__":
@@ -0,0 +1,358 @@
+"""
+In-process publish/subscribe bus between bar producers (IBClient, BarCache) and the sinks that
+store or forward bars (MarketDataStore, InfluxDB, chart consumers).
+
+Publishing only enqueues: each sink has its own bounded queue and worker thread, so a fetch never
+waits on storage and a slow or failing sink never holds up the others. Workers drain up to
+`max_batch` items at a time and merge the BarBatches of each symbol into one call.
+
+When a sink's queue is full, its policy decides:
+- 'block': the publisher waits for room (up to `put_timeout` seconds, then the item is dropped);
+- 'drop_oldest': the oldest queued item is discarded;
+- 'spill': items go to pickle files under `spill_dir/<sink>/` and are delivered, in order, once
+  the queue has drained. Files left by a previous process are picked up at startup.
+
+Items a sink still cannot write after its retries are kept as spill files (whatever the policy,
+when the sink has a spill_dir), so the next start replays them.
+
+Queue depth, lag (age of the oldest undelivered item), delivery latency and outcomes per sink
+are exported through metrics.py.
+"""
+import atexit
+import glob
+import itertools
+import logging
+import os
+import pickle
+import threading
+import time
+import weakref
+from collections import Counter, deque
+from bar_batch import BarBatch
+from metrics import REGISTRY
+
+POLICIES = ('block', 'drop_oldest', 'spill')
+
+_buses = weakref.WeakSet()
+
+
+def _sinks():
+    return [sink for bus in list(_buses) for sink in bus.sinks.values()]
+
+
+REGISTRY.gauge('ingest_queue_depth', 'Items queued per ingest sink, in memory and spilled to disk.',
+               lambda: [({'sink': sink.name}, sink.depth) for sink in _sinks()])
+REGISTRY.gauge('ingest_lag_seconds', 'Age of the oldest item an ingest sink has not delivered yet.',
+               lambda: [({'sink': sink.name}, sink.lag()) for sink in _sinks()])
+REGISTRY.counter('ingest_items_total', 'Items handled per ingest sink by outcome.', lambda: [
+    ({'sink': sink.name, 'outcome': outcome}, count) for sink in _sinks() for outcome, count in sink.counts.items()
+])
+DELIVERY_SECONDS = REGISTRY.histogram('ingest_delivery_seconds', 'Time from publish to a completed sink write.')
+SINK_SECONDS = REGISTRY.histogram('ingest_sink_seconds', 'Time spent in each sink write call.')
+
+
+class _Item:
+    __slots__ = ('topic', 'payload', 'published', 'path', 'key')
+
+    def __init__(self, topic, payload, published, path=None, key=None):
+        self.topic = topic
+        self.payload = payload
+        self.published = published  # time.time() of publish, for lag across restarts
+        self.path = path  # Spill file holding the payload when it is not in memory
+        self.key = key  # The BarBatch symbol, for per-symbol flushes
+
+
+class Sink:
+    """
+    One subscriber: its bounded queue, overflow policy and worker thread. The worker starts, and
+    spill files left by a previous process are picked up, on first use, so building a bus (e.g.
+    by importing the app) starts no thread. With `exit_timeout`, what is queued at interpreter
+    exit is delivered for up to that many seconds.
+    """
+
+    def __init__(self, name, handler, topics, max_queue=256, policy='block', max_batch=64,
+                 put_timeout=None, retries=3, backoff=0.1, spill_dir=None, exit_timeout=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown backpressure policy: {policy} (expected one of {', '.join(POLICIES)})")
+        if policy == 'spill' and not spill_dir:
+            raise ValueError("The spill policy needs a spill_dir.")
+        self.name = name
+        self.handler = handler
+        self.topics = frozenset(topics)
+        self.max_queue = max_queue
+        self.policy = policy
+        self.max_batch = max_batch
+        self.put_timeout = put_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.exit_timeout = exit_timeout
+        self.spill_dir = os.path.join(spill_dir, name) if spill_dir else None
+        self.counts = {'delivered': 0, 'dropped': 0, 'spilled': 0, 'failed': 0}
+        self._queue = deque()
+        self._spilled = deque()  # Newer than everything in _queue while not empty
+        self._busy = 0  # Items taken by the worker and not yet delivered
+        self._busy_since = None
+        self._pending = Counter()  # Undelivered items per symbol; None counts items of unknown symbol
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._stop = False
+        self._thread = None
+
+    def start(self):
+        """Recover spilled items and start the worker, once."""
+        with self._cond:
+            if self._thread is not None:
+                return self
+            if self.spill_dir:
+                self._recover()
+            self._thread = threading.Thread(target=self._run, name=f"ingest-{self.name}", daemon=True)
+            self._thread.start()
+        if self.exit_timeout is not None:
+            atexit.register(self.close, self.exit_timeout)
+        return self
+
+    @property
+    def depth(self):
+        return len(self._queue) + len(self._spilled)
+
+    def lag(self):
+        """Seconds since the oldest undelivered item was published (0 when idle)."""
+        with self._cond:
+            oldest = self._oldest
+        return time.time() - oldest if oldest is not None else 0.0
+
+    @property
+    def _oldest(self):
+        if self._busy:
+            return self._busy_since
+        head = self._queue[0] if self._queue else self._spilled[0] if self._spilled else None
+        return head.published if head is not None else None
+
+    def put(self, topic, payload):
+        self.start()
+        item = _Item(topic, payload, time.time(), key=payload.symbol if isinstance(payload, BarBatch) else None)
+        with self._cond:
+            self._pending[item.key] += 1
+            if len(self._queue) < self.max_queue and not (self.policy == 'spill' and self._spilled):
+                self._queue.append(item)
+            elif self._overflow(item):
+                self._queue.append(item)
+            self._cond.notify_all()
+
+    def _done(self, item):
+        self._pending[item.key] -= 1
+        if self._pending[item.key] <= 0:
+            del self._pending[item.key]
+
+    def _overflow(self, item):
+        """Apply the policy to a full queue. Returns True if `item` should still be queued in memory."""
+        if self.policy == 'spill':
+            self._spill(item)
+            return False
+        if self.policy == 'drop_oldest':
+            self._done(self._queue.popleft())
+            self.counts['dropped'] += 1
+            return True
+        deadline = None if self.put_timeout is None else time.monotonic() + self.put_timeout
+        while len(self._queue) >= self.max_queue and not self._stop:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                self._done(item)
+                self.counts['dropped'] += 1
+                logging.warning(f"Ingest sink {self.name}: queue full for {self.put_timeout}s, dropping an item.")
+                return False
+            self._cond.wait(remaining)
+        return True
+
+    def _spill(self, item):
+        self._spilled.append(_Item(item.topic, None, item.published, self._write_spill(item), item.key))
+        self.counts['spilled'] += 1
+
+    def _write_spill(self, item):
+        """Pickle an item to a spill file named by its publish time, so recovery replays in publish order."""
+        os.makedirs(self.spill_dir, exist_ok=True)
+        path = os.path.join(self.spill_dir, f"{int(item.published * 1e9):020d}-{next(self._sequence):08d}.pkl")
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump((item.topic, item.payload, item.published), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+        return path
+
+    def _recover(self):
+        """Queue spill files left behind by a previous process, oldest first."""
+        paths = sorted(glob.glob(os.path.join(self.spill_dir, '*.pkl')))
+        for path in paths:
+            self._spilled.append(_Item(None, None, os.path.getmtime(path), path))
+            self._pending[None] += 1
+        if paths:
+            logging.info(f"Ingest sink {self.name}: {len(paths)} spilled items to deliver from {self.spill_dir}.")
+
+    def _take(self):
+        """Wait for work and take up to `max_batch` items: memory first, then the spill backlog."""
+        with self._cond:
+            while not self._queue and not self._spilled and not self._stop:
+                self._cond.wait()
+            items = []
+            while self._queue and len(items) < self.max_batch:
+                items.append(self._queue.popleft())
+            if not items:
+                while self._spilled and len(items) < self.max_batch:
+                    items.append(self._spilled.popleft())
+            self._busy = len(items)
+            self._busy_since = min((item.published for item in items), default=None)
+            self._cond.notify_all()  # Wakes publishers blocked on a full queue
+        for item in items:
+            if item.path is not None:
+                with open(item.path, 'rb') as f:
+                    item.topic, item.payload, item.published = pickle.load(f)
+        return items
+
+    def _run(self):
+        while True:
+            items = self._take()
+            if not items:
+                return  # Stopped with nothing left
+            for payload, group in _coalesce(items):
+                if self._deliver(payload, group):
+                    for item in group:
+                        if item.path is not None:
+                            os.remove(item.path)
+                else:
+                    self._keep(group)
+            with self._cond:
+                for item in items:
+                    self._done(item)
+                self._busy = 0
+                self._cond.notify_all()
+
+    def _deliver(self, payload, items):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                with SINK_SECONDS.time(sink=self.name):
+                    self.handler(payload)
+                break
+            except Exception as e:
+                if attempt == self.retries:
+                    self.counts['failed'] += len(items)
+                    logging.error(f"Ingest sink {self.name}: {len(items)} items not delivered after {attempt + 1} failed writes: {e}")
+                    return False
+                logging.warning(f"Ingest sink {self.name} write failed ({e}); retrying in {delay:.1f}s.")
+                time.sleep(delay)
+                delay *= 2
+        now = time.time()
+        self.counts['delivered'] += len(items)
+        for item in items:
+            DELIVERY_SECONDS.observe(now - item.published, sink=self.name)
+        return True
+
+    def _keep(self, items):
+        """
+        Leave undeliverable items on disk for the next start to replay: spilled items keep their
+        files, in-memory ones are spilled now. Without a spill_dir they are lost.
+        """
+        if not self.spill_dir:
+            return
+        kept = 0
+        for item in items:
+            try:
+                if item.path is None:
+                    self._write_spill(item)
+                kept += 1
+            except Exception as e:
+                logging.error(f"Ingest sink {self.name}: could not spill an undelivered item: {e}")
+        logging.warning(f"Ingest sink {self.name}: kept {kept} undelivered items in {self.spill_dir} for the next start.")
+
+    def flush(self, timeout=None, symbol=None):
+        """
+        Wait until everything queued so far (only the BarBatches of `symbol`, if given) has been
+        handled. Returns False on timeout.
+        """
+        self.start()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending if symbol is None else (symbol in self._pending or None in self._pending):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        """Deliver what is queued (spill files of an unfinished backlog stay for the next start), then stop."""
+        if self._thread is None:
+            return  # Never used
+        self.flush(timeout)
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+
+def _coalesce(items):
+    """
+    One payload per handler call: the BarBatches of each (topic, symbol) are concatenated in
+    publish order, anything else is delivered as is. Yields (payload, items).
+    """
+    groups = {}
+    for index, item in enumerate(items):
+        key = (item.topic, item.payload.symbol) if isinstance(item.payload, BarBatch) else index
+        groups.setdefault(key, []).append(item)
+    for group in groups.values():
+        payload = group[0].payload if len(group) == 1 else BarBatch.concat([item.payload for item in group])
+        yield payload, group
+
+
+class IngestBus:
+    """
+    Topic-based fan-out to sinks. `publish(topic, payload)` hands the payload to every sink
+    subscribed to the topic and returns without waiting for any of them (unless a sink with the
+    'block' policy is full).
+    """
+
+    def __init__(self, spill_dir=None, exit_timeout=None):
+        self.spill_dir = spill_dir
+        self.exit_timeout = exit_timeout
+        self.sinks = {}
+        self.published = 0
+        _buses.add(self)
+
+    def subscribe(self, name, handler, topics=('bars',), **options):
+        """Add a sink calling `handler(payload)` on its own worker. See Sink for the options."""
+        if name in self.sinks:
+            raise ValueError(f"Ingest sink {name} is already subscribed.")
+        options.setdefault('spill_dir', self.spill_dir)
+        options.setdefault('exit_timeout', self.exit_timeout)
+        sink = self.sinks[name] = Sink(name, handler, topics, **options)
+        return sink
+
+    def publish(self, topic, payload):
+        self.published += 1
+        for sink in list(self.sinks.values()):
+            if topic in sink.topics:
+                sink.put(topic, payload)
+
+    def flush(self, name=None, timeout=None, symbol=None):
+        """Wait for one sink, or all of them, to catch up (on one symbol's bars, if given)."""
+        sinks = [self.sinks[name]] if name is not None else list(self.sinks.values())
+        return all([sink.flush(timeout, symbol) for sink in sinks])
+
+    def close(self, timeout=None):
+        for sink in list(self.sinks.values()):
+            sink.close(timeout)
+
+
+def _write_influx(batch):
+    from influxdb_handler import get_write_pipeline
+    get_write_pipeline().write_frame(batch, measurement='ohlcv', tags={'symbol': batch.symbol})
+
+
+def bus_from_env():
+    """
+    A bus with the InfluxDB sink for live bars, configured by INGEST_SPILL_DIR, INGEST_QUEUE_SIZE
+    and INGEST_INFLUX_POLICY. BarCache adds the store sink when it is given the bus. Sinks start
+    on first use; queued items are delivered at interpreter exit.
+    """
+    bus = IngestBus(spill_dir=os.getenv('INGEST_SPILL_DIR', 'ingest_spill'), exit_timeout=30)
+    bus.subscribe('influx', _write_influx, topics=('live',), max_queue=int(os.getenv('INGEST_QUEUE_SIZE', '256')),
+                  policy=os.getenv('INGEST_INFLUX_POLICY', 'drop_oldest'))
+    return bus
@@ -0,0 +1,176 @@
+import asyncio
+import json
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from bar_store import to_epoch_ns, to_timestamp_ns
+from bar_stream import BarStream
+from ib_client import IBClient
+
+
+def format_event(event, data):
+    """Encode one server-sent event with a compact JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+def snapshot_payload(df):
+    """Columnar snapshot of a bar frame: epoch-ms timestamps and closes."""
+    if df.empty:
+        return {'t': [], 'c': []}
+    return {
+        't': (to_epoch_ns(df['timestamp']) // 1_000_000).tolist(),
+        'c': df['close'].tolist(),
+    }
+
+
+class LiveFeed:
+    """
+    Fans live bars out to any number of server-sent-event listeners.
+
+    Each symbol is subscribed upstream once, however many browsers are watching it. Every bar
+    update is encoded once and the same message is queued for each listener, so server work grows
+    with the update rate rather than with viewers times history length. A listener that falls
+    `max_queue` messages behind loses its oldest messages.
+
+    The subscriptions live on a dedicated IB connection on the pool's loop, not on a pooled
+    client: those are shared with requests and dropped by the pool's health check. When that
+    connection drops, it is reopened every `reconnect_delay` seconds and all symbols are
+    subscribed again.
+    """
+
+    def __init__(self, pool, max_queue=512, keepalive=15, reconnect_delay=5):
+        self.pool = pool
+        self.max_queue = max_queue
+        self.keepalive = keepalive
+        self.reconnect_delay = reconnect_delay
+        self.messages_sent = 0
+        self.messages_dropped = 0
+        self.reconnects = 0
+        self._stream = None
+        self._reconnecting = None
+        self._listeners = {}  # symbol -> tuple of queues, replaced (never mutated) so the IB loop can read it lock-free
+        self._upstream = {}  # symbol -> Future of its upstream subscription, pending while it is being made
+        self._lock = threading.Lock()
+
+    def listeners(self, symbol):
+        return len(self._listeners.get(symbol, ()))
+
+    def queue_depth(self):
+        """Messages waiting across all listener queues."""
+        return sum(listener.qsize() for listeners in list(self._listeners.values()) for listener in listeners)
+
+    def listen(self, symbol):
+        """
+        Register a listener queue, subscribing upstream if it is the symbol's first. The
+        subscription is made outside the lock; other listeners of the symbol wait for it, while
+        other symbols are not held up.
+        """
+        listener = queue.Queue(self.max_queue)
+        with self._lock:
+            self._listeners[symbol] = self._listeners.get(symbol, ()) + (listener,)
+            upstream = self._upstream.get(symbol)
+            first = upstream is None
+            if first:
+                upstream = self._upstream[symbol] = Future()
+        if first:
+            try:
+                self.pool.call(lambda: self._subscribe(symbol))
+            except Exception as e:
+                with self._lock:
+                    del self._upstream[symbol]  # The next listener tries again
+                upstream.set_exception(e)
+            else:
+                upstream.set_result(None)
+        try:
+            upstream.result()
+        except Exception:
+            self._remove(symbol, listener)
+            raise
+        return listener
+
+    def unlisten(self, symbol, listener):
+        """Remove a listener; the upstream subscription is cancelled with the last one."""
+        if self._remove(symbol, listener):
+            self.pool.call(lambda: self._stream.unsubscribe(symbol, self._on_bar))
+
+    def _remove(self, symbol, listener):
+        """Drop a listener; True if it was the last one of a subscribed symbol."""
+        with self._lock:
+            remaining = tuple(other for other in self._listeners.get(symbol, ()) if other is not listener)
+            if remaining:
+                self._listeners[symbol] = remaining
+                return False
+            self._listeners.pop(symbol, None)
+            upstream = self._upstream.get(symbol)
+            if upstream is None or not upstream.done() or upstream.exception() is not None:
+                return False
+            del self._upstream[symbol]
+            return True
+
+    async def _subscribe(self, symbol):
+        if self._stream is None:
+            client = IBClient(self.pool.host, self.pool.port, bar_cache=self.pool.bar_cache, pacing=self.pool.pacing)
+            client.ib.disconnectedEvent += self._on_disconnected
+            self._stream = BarStream(client)  # Its callbacks run on the pool loop
+        await self._stream.subscribe_async(symbol, self._on_bar)
+
+    def _on_disconnected(self):
+        if self._reconnecting is None or self._reconnecting.done():
+            logging.warning("Live feed: IB connection lost, reconnecting.")
+            self._reconnecting = asyncio.ensure_future(self._resubscribe())
+
+    async def _resubscribe(self):
+        while True:
+            await asyncio.sleep(self.reconnect_delay)
+            try:
+                await self._stream.resubscribe_async()
+            except Exception as e:
+                logging.warning(f"Live feed: resubscribing failed ({e}), retrying in {self.reconnect_delay}s.")
+                continue
+            self.reconnects += 1
+            logging.info("Live feed: resubscribed after reconnecting.")
+            return
+
+    def _on_bar(self, symbol, bar, is_new):
+        message = format_event('bar', {
+            't': to_timestamp_ns(bar['timestamp']) // 1_000_000,
+            'c': bar['close'],
+            'new': is_new,
+        })
+        for listener in self._listeners.get(symbol, ()):
+            self._put(listener, message)
+
+    def _put(self, listener, message):
+        try:
+            listener.put_nowait(message)
+        except queue.Full:
+            try:
+                listener.get_nowait()
+                self.messages_dropped += 1
+            except queue.Empty:
+                pass
+            listener.put_nowait(message)
+
+    def events(self, symbol, load_snapshot):
+        """
+        Yield SSE messages for one browser: a snapshot of `load_snapshot()` (a bar DataFrame) first,
+        then each bar update until the client disconnects. The listener is registered before the
+        snapshot is loaded, so no update is missed in between; clients replace or skip bars whose
+        timestamp they already have.
+        """
+        listener = self.listen(symbol)
+        try:
+            yield format_event('snapshot', snapshot_payload(load_snapshot()))
+            while True:
+                try:
+                    message = listener.get(timeout=self.keepalive)
+                    self.messages_sent += 1
+                    yield message
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+        except Exception as e:
+            logging.error(f"Live feed for {symbol} failed: {e}")
+            raise
+        finally:
+            self.unlisten(symbol, listener)
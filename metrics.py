@@ -0,0 +1,233 @@
+"""
+In-process counters, gauges and histograms rendered in the Prometheus text exposition format,
+and a sampling profiler for single requests. No client library is needed: metrics are plain
+objects updated under a lock and rendered on demand by the /metrics route.
+"""
+import collections
+import contextlib
+import math
+import os
+import sys
+import threading
+import time
+
+PREFIX = 'marketdata_'
+
+# Upper bounds in seconds, from sub-millisecond store lookups to slow IB history requests
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+WAIT_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 15, 30, 60, 120, 300, 600)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(key, extra=()):
+    pairs = [*key, *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, int):
+        return str(value)
+    value = float(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+def _label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+class _Metric:
+    type = 'untyped'
+
+    def __init__(self, name, help, function=None):
+        self.name = PREFIX + name
+        self.help = help
+        self.function = function  # Called at render time: a number, or a list of (labels dict, value)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _samples(self):
+        if self.function is None:
+            with self._lock:
+                return [(self.name, key, value) for key, value in self._values.items()]
+        result = self.function()
+        if not isinstance(result, (list, tuple)):
+            result = [({}, result)]
+        return [(self.name, _label_key(labels), value) for labels, value in result]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for name, key, value, *extra in self._samples():
+            lines.append(f"{name}{_format_labels(key, *extra)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+
+class Histogram(_Metric):
+    """Cumulative-bucket histogram; each label set keeps per-bucket counts plus sum and count."""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self):
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+        samples = []
+        for key, counts in values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", key, cumulative, (('le', _format_value(bound)),)))
+            samples.append((f"{self.name}_sum", key, counts[-1]))
+            samples.append((f"{self.name}_count", key, cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, *args, **kwargs):
+        """Create a metric, or return the one already registered under `name`."""
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, help, function=None):
+        return self._register(Counter, name, help, function)
+
+    def gauge(self, name, help, function=None):
+        return self._register(Gauge, name, help, function)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, help, buckets)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram('stage_seconds', 'Time spent per hot-path stage.')
+BARS_INGESTED = REGISTRY.counter('bars_ingested_total', 'Bars received from IB.')
+PACING_WAIT_SECONDS = REGISTRY.histogram('ib_pacing_wait_seconds', 'Delay imposed on IB requests by the pacing scheduler.', WAIT_BUCKETS)
+
+
+def timed(stage, **labels):
+    """Context manager that records the block's duration in the stage histogram."""
+    return STAGE_SECONDS.time(stage=stage, **labels)
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler: a background thread records the stacks of the target thread (and of
+    the threads named in `threads`, or of every thread with '*') every `interval` seconds via
+    sys._current_frames(), so the profiled code runs unmodified and the overhead is bounded by
+    the sampling rate. Stacks are rooted at their thread's name, so work handed to another
+    thread (e.g. the 'ib-pool' loop) shows up next to the caller's. Samples of shared threads
+    include whatever else they ran meanwhile. `collapsed()` returns the samples in the
+    folded-stack format flame graph tools read ('thread;outer;inner count' per line).
+    """
+
+    def __init__(self, thread_id=None, interval=0.005, max_depth=64, threads=()):
+        self.thread_id = thread_id or threading.get_ident()
+        self.threads = frozenset(threads)
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = 0
+        self._stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self
+
+    def _targets(self):
+        """Thread ident -> name of the threads to sample."""
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        targets = {self.thread_id: names.get(self.thread_id, str(self.thread_id))}
+        if self.threads:
+            own = threading.get_ident()
+            targets.update((ident, name) for ident, name in names.items()
+                           if ident != own and ('*' in self.threads or name in self.threads))
+        return targets
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            sampled = False
+            for ident, name in self._targets().items():
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if stack:
+                    self._stacks[';'.join([name, *reversed(stack)])] += 1
+                    sampled = True
+            self.samples += sampled
+
+    def collapsed(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in self._stacks.most_common())
@@ -0,0 +1,110 @@
+import asyncio
+import bisect
+import logging
+import threading
+import time
+from metrics import PACING_WAIT_SECONDS
+
+
+def _earliest(times, at, limit, span):
+    """
+    The earliest time from `at` on where one more entry keeps every `span`-second window of the
+    sorted `times` at `limit` entries or fewer. Reservations can lie in the future, so windows
+    that start at or after `at` count as well as those ending at it.
+    """
+    while True:
+        moved = at
+        first = bisect.bisect_left(times, at)
+        if bisect.bisect_left(times, at + span, first) - first >= limit and times[first] > at:
+            moved = times[first]  # The window starting here is full; windows from its entries are checked next
+        for start in range(bisect.bisect_right(times, at - span), bisect.bisect_right(times, at)):
+            if bisect.bisect_left(times, times[start] + span, start) - start >= limit:
+                moved = max(moved, times[start] + span)
+        if moved == at:
+            return at
+        at = moved
+
+
+class PacingScheduler:
+    """
+    Schedules IB historical data requests so they stay within IB's pacing rules:
+
+    - no identical request within `identical_interval` seconds (15 s),
+    - no more than `contract_requests` requests for the same contract within
+      `contract_window` seconds (IB rejects six or more within two seconds),
+    - no more than `max_requests` requests within any `window` seconds (60 per 10 minutes).
+
+    Each caller reserves the earliest send time that satisfies all three rules and then waits
+    until it, so concurrent callers are spread out instead of all sleeping a fixed interval.
+    The same scheduler can be shared by threads (`wait`) and asyncio tasks (`acquire`).
+    """
+
+    def __init__(self, max_requests=60, window=600, identical_interval=15, contract_requests=5, contract_window=2):
+        self.max_requests = max_requests
+        self.window = window
+        self.identical_interval = identical_interval
+        self.contract_requests = contract_requests
+        self.contract_window = contract_window
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self._sent = []  # Sorted reserved send times across all requests
+        self._by_contract = {}  # contract key -> sorted reserved send times
+        self._by_request = {}  # request key -> last reserved send time
+        self._lock = threading.Lock()
+
+    def reserve(self, request_key, contract_key):
+        """
+        Reserve a send slot and return how many seconds the caller must wait before sending.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._prune(now)
+            at = now
+            last = self._by_request.get(request_key)
+            if last is not None:
+                at = max(at, last + self.identical_interval)
+            recent = self._by_contract.setdefault(contract_key, [])
+            while True:  # Moving `at` for one rule can break another, so check until it settles
+                settled = at
+                at = _earliest(recent, at, self.contract_requests, self.contract_window)
+                at = _earliest(self._sent, at, self.max_requests, self.window)
+                if at == settled:
+                    break
+
+            bisect.insort(self._sent, at)
+            bisect.insort(recent, at)
+            self._by_request[request_key] = at
+            delay = at - now
+            if delay > 0:
+                self.waits += 1
+                self.wait_seconds += delay
+            PACING_WAIT_SECONDS.observe(max(delay, 0.0))
+            return delay
+
+    def _prune(self, now):
+        horizon = now - self.window
+        del self._sent[:bisect.bisect_left(self._sent, horizon)]
+        for key in [key for key, at in self._by_request.items() if at < now - self.identical_interval]:
+            del self._by_request[key]
+        for key, recent in list(self._by_contract.items()):
+            del recent[:bisect.bisect_left(recent, now - self.contract_window)]
+            if not recent:
+                del self._by_contract[key]
+
+    def wait(self, request_key, contract_key):
+        """Block the calling thread until the request may be sent."""
+        delay = self.reserve(request_key, contract_key)
+        if delay > 0:
+            logging.info(f"Pacing: waiting {delay:.1f}s before requesting {contract_key}.")
+            time.sleep(delay)
+
+    async def acquire(self, request_key, contract_key):
+        """Suspend the calling task until the request may be sent."""
+        delay = self.reserve(request_key, contract_key)
+        if delay > 0:
+            logging.info(f"Pacing: waiting {delay:.1f}s before requesting {contract_key}.")
+            await asyncio.sleep(delay)
+
+
+# IB enforces pacing per account session, so clients in one process share a scheduler by default
+default_scheduler = PacingScheduler()
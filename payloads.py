@@ -0,0 +1,85 @@
+import gzip
+import hashlib
+import json
+import numpy as np
+import pandas as pd
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# format -> mimetype; 'json' is the original {'timestamps', 'prices'} shape
+FORMATS = {
+    'json': 'application/json',
+    'columnar': 'application/json',
+    'msgpack': 'application/msgpack',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+
+GZIP_MIN_BYTES = 1024
+
+
+def local_time_strings(timestamps, tz):
+    """
+    Format UTC epoch-ns timestamps as 'YYYY-MM-DD HH:MM:SS' wall-clock strings in `tz`, with one
+    vectorized timezone conversion and no per-row strftime.
+    """
+    local = pd.DatetimeIndex(pd.to_datetime(np.asarray(timestamps, dtype=np.int64), utc=True)).tz_convert(tz)
+    wall = local.tz_localize(None).as_unit('ns').asi8.astype('datetime64[ns]').astype('datetime64[s]')
+    strings = np.datetime_as_string(wall)
+    strings.view('<U1').reshape(len(strings), -1)[:, 10] = ' '  # 'T' separator -> space, in place
+    return strings
+
+
+def bars_etag(timestamps, closes, *key):
+    """Strong ETag over the served bars and whatever else shapes the response (symbol, format, ...)."""
+    digest = hashlib.blake2b(repr(key).encode(), digest_size=16)
+    digest.update(np.ascontiguousarray(timestamps, dtype=np.int64).tobytes())
+    digest.update(np.ascontiguousarray(closes, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def encode_bars(timestamps, closes, fmt='json', tz='UTC'):
+    """
+    Serialize bars (UTC epoch-ns timestamps and closes) and return (body bytes, mimetype).
+
+    'json' keeps the original payload of local time strings and prices. The compact formats are
+    columnar, with epoch-ms UTC timestamps: 'columnar' as JSON {'t': [...], 'c': [...]}, 'msgpack'
+    the same dict (needs msgpack) and 'arrow' an Arrow IPC stream with columns t and c (needs pyarrow).
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format: {fmt}. Expected one of {list(FORMATS)}")
+    closes = np.asarray(closes, dtype=np.float64)
+    if fmt == 'json':
+        payload = {'timestamps': local_time_strings(timestamps, tz).tolist(), 'prices': closes.tolist()}
+        return json.dumps(payload, separators=(',', ':')).encode(), FORMATS[fmt]
+
+    millis = np.asarray(timestamps, dtype=np.int64) // 1_000_000
+    if fmt == 'arrow':
+        if pa is None:
+            raise ValueError("The arrow format needs pyarrow installed.")
+        table = pa.table({'t': pa.array(millis, pa.timestamp('ms', tz='UTC')), 'c': pa.array(closes)})
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes(), FORMATS[fmt]
+
+    payload = {'t': millis.tolist(), 'c': closes.tolist()}
+    if fmt == 'msgpack':
+        if msgpack is None:
+            raise ValueError("The msgpack format needs msgpack installed.")
+        return msgpack.packb(payload), FORMATS[fmt]
+    return json.dumps(payload, separators=(',', ':')).encode(), FORMATS[fmt]
+
+
+def gzip_body(body, accept_encoding, level=5):
+    """Gzip a body when the client accepts it and it is big enough to be worth it. Returns (body, encoding)."""
+    if len(body) < GZIP_MIN_BYTES or 'gzip' not in (accept_encoding or ''):
+        return body, None
+    return gzip.compress(body, compresslevel=level), 'gzip'
@@ -1,69 +1,52 @@
+import argparse
 import os
-from influxdb_client_3 import InfluxDBClient3
-from dotenv import load_dotenv
-
-# Load environment variables from .env file
-load_dotenv()
-
-# Load InfluxDB configuration
-token = os.getenv("INFLUXDB_TOKEN")
-org = "US East - Prod"
-host = "https://us-east-1-1.aws.cloud2.influxdata.com"
-database = os.getenv("INFLUXDB_BUCKET", "spy_ohlcv_1m")  # Default to "spy_ohlcv_1m" if not set
-
-# Debug: Print loaded environment variables
-print(f"Loaded INFLUXDB_TOKEN: {'Set' if token else 'Not Set'}")
-print(f"Loaded INFLUXDB_BUCKET: {database}")
-
-# Validate database configuration
-if not database:
-    raise ValueError("Database (bucket) name is not set. Please check the 'INFLUXDB_BUCKET' environment variable.")
-
-# Initialize InfluxDB client
-client = InfluxDBClient3(host=host, token=token, org=org)
+import pandas as pd
+from influx_query import get_reader
+from influxdb_handler import database  # Loads .env; the client is only created by get_reader()
+from resample import TIMEFRAMES
 
 def test_bucket_access():
     """
     Test if the bucket is accessible.
     """
-    query = f"""
-    from(bucket: "{database}")
-        |> range(start: -1m)
-        |> limit(n: 1)
-    """
     print(f"Testing access to bucket: {database}")
     try:
-        result = client.query(query=query)
-        if not result:
+        symbols = get_reader().symbols()
+        if not symbols:
             print(f"Bucket '{database}' is accessible but contains no data.")
         else:
-            print(f"Bucket '{database}' is accessible.")
+            print(f"Bucket '{database}' is accessible. Symbols: {', '.join(symbols)}")
     except Exception as e:
         print(f"Error accessing bucket '{database}': {e}")
 
-def print_spy_data():
+def print_spy_data(days=1, timeframe=None):
     """
     Query and print SPY data from the InfluxDB database.
     """
-    query = f"""
-    from(bucket: "{database}")
-        |> range(start: -1d)
-        |> filter(fn: (r) => r._measurement == "ohlcv" and r.symbol == "SPY")
-        |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")
-        |> sort(columns: ["_time"])
-    """
-    print(f"Executing query: {query}")
+    start = pd.Timestamp.now(tz='UTC') - pd.Timedelta(days=days)
     print("Fetching SPY data...")
     try:
-        result = client.query(query=query)
-        if not result:
+        reader = get_reader()
+        print(f"Executing query: {reader.bars_sql(start, timeframe=timeframe)}")
+        # One Arrow table for the whole range, printed at once rather than record by record
+        table = reader.table("SPY", start, timeframe=timeframe)
+        if table.num_rows == 0:
             print("No data found for SPY in the specified time range.")
-        for record in result:
-            print(record)
+        else:
+            print(table.to_pandas().to_string())
     except Exception as e:
         print(f"Error querying InfluxDB: {e}")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print SPY bars stored in InfluxDB.")
+    parser.add_argument("--days", type=int, default=1)
+    parser.add_argument("--timeframe", choices=list(TIMEFRAMES), help="Aggregate into candles on the server")
+    args = parser.parse_args()
+
+    # Debug: Print loaded environment variables
+    print(f"Loaded INFLUXDB_TOKEN: {'Set' if os.getenv('INFLUXDB_TOKEN') else 'Not Set'}")
+    print(f"Loaded INFLUXDB_BUCKET: {database}")
+
     print("Fetching SPY data from InfluxDB...")
     test_bucket_access()  # Test bucket access
-    print_spy_data()
+    print_spy_data(args.days, args.timeframe)
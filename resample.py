@@ -0,0 +1,157 @@
+import numpy as np
+import pandas as pd
+from bar_store import PRICE_COLUMNS, to_epoch_ns
+
+EXCHANGE_TZ = 'America/New_York'
+SESSION_OPEN = '09:30'
+
+NS_PER_SECOND = 1_000_000_000
+NS_PER_DAY = 86400 * NS_PER_SECOND
+
+# Candle length in seconds; None means one candle per exchange-local calendar day
+TIMEFRAMES = {'1m': 60, '5m': 300, '15m': 900, '30m': 1800, '1h': 3600, '1D': None}
+
+
+def _offset_ns(hhmm):
+    hours, minutes = hhmm.split(':')
+    return (int(hours) * 3600 + int(minutes) * 60) * NS_PER_SECOND
+
+
+def bucket_starts(timestamps, timeframe, tz=EXCHANGE_TZ, session_open=SESSION_OPEN):
+    """
+    Map UTC epoch-ns timestamps to the UTC epoch-ns start of their candle.
+
+    Intraday candles are aligned to the session open in exchange-local time (so 1h candles run
+    9:30-10:30, 10:30-11:30, ...) and never span two trading days; daily candles start at local
+    midnight.
+    """
+    if timeframe not in TIMEFRAMES:
+        raise ValueError(f"Unsupported timeframe: {timeframe}. Expected one of {list(TIMEFRAMES)}")
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    local = pd.DatetimeIndex(pd.to_datetime(timestamps, utc=True)).tz_convert(tz)
+    wall = local.tz_localize(None).as_unit('ns').asi8
+    day = wall - wall % NS_PER_DAY
+    length = TIMEFRAMES[timeframe]
+    if length is None:
+        bucket_wall = day
+    else:
+        anchor = day + _offset_ns(session_open)
+        step = length * NS_PER_SECOND
+        bucket_wall = anchor + np.floor_divide(wall - anchor, step) * step
+        # Pre-open bars belong to the same day, never to the previous day's last candle
+        bucket_wall = np.maximum(bucket_wall, day)
+    # Shift by each bar's own UTC offset; sessions never straddle a DST change
+    return timestamps - (wall - bucket_wall)
+
+
+def resample_arrays(timestamps, open_, high, low, close, volume, timeframe, tz=EXCHANGE_TZ, session_open=SESSION_OPEN):
+    """
+    Aggregate sorted minute bars of one symbol into candles with ufunc.reduceat.
+    Returns a dict of arrays keyed by 'timestamp' (candle start, UTC epoch ns) and OHLCV.
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    if len(timestamps) == 0:
+        return {'timestamp': timestamps, **{name: np.empty(0) for name in PRICE_COLUMNS}}
+    buckets = bucket_starts(timestamps, timeframe, tz, session_open)
+    starts = np.flatnonzero(np.diff(buckets, prepend=buckets[0] - 1))
+    ends = np.append(starts[1:], len(buckets)) - 1
+    return {
+        'timestamp': buckets[starts],
+        'open': np.asarray(open_, dtype=np.float64)[starts],
+        'high': np.maximum.reduceat(np.asarray(high, dtype=np.float64), starts),
+        'low': np.minimum.reduceat(np.asarray(low, dtype=np.float64), starts),
+        'close': np.asarray(close, dtype=np.float64)[ends],
+        'volume': np.add.reduceat(np.asarray(volume, dtype=np.float64), starts),
+    }
+
+
+def resample_frame(df, timeframe, tz=EXCHANGE_TZ, session_open=SESSION_OPEN):
+    """
+    Resample a DataFrame of minute bars (any number of symbols) into candles of `timeframe`.
+    Timestamps may be ISO strings, datetimes or epoch ns; the result has UTC timestamps.
+    """
+    columns = ['timestamp', *PRICE_COLUMNS, 'symbol']
+    if df.empty:
+        return pd.DataFrame(columns=columns)
+    timestamps = to_epoch_ns(df['timestamp'])
+    symbols = df['symbol'].to_numpy() if 'symbol' in df else np.full(len(df), None, dtype=object)
+    frames = []
+    for symbol in pd.unique(symbols):
+        mask = symbols == symbol
+        order = np.argsort(timestamps[mask], kind='stable')
+        arrays = resample_arrays(
+            timestamps[mask][order],
+            *(df[name].to_numpy()[mask][order] for name in PRICE_COLUMNS),
+            timeframe=timeframe, tz=tz, session_open=session_open
+        )
+        frame = pd.DataFrame(arrays)
+        frame['symbol'] = symbol
+        frames.append(frame)
+    result = pd.concat(frames, ignore_index=True)
+    result['timestamp'] = pd.to_datetime(result['timestamp'], utc=True)
+    return result[columns]
+
+
+class IncrementalResampler:
+    """
+    Keeps the open candle of one symbol up to date as minute bars stream in.
+
+    Each update is O(1): the current candle's bounds are cached, so the timezone work only
+    happens when a new candle starts. A minute bar that is re-sent with new values (because it
+    was still forming) replaces its previous contribution instead of being counted twice.
+    """
+
+    def __init__(self, timeframe, tz=EXCHANGE_TZ, session_open=SESSION_OPEN):
+        self.timeframe = timeframe
+        self.tz = tz
+        self.session_open = session_open
+        self.candle_start = None
+        self._candle_end = None
+        self._base = None  # OHLCV of the closed minutes in the open candle
+        self._minute = None  # (timestamp, OHLCV) of the latest minute bar
+
+    def update(self, timestamp, open_, high, low, close, volume):
+        """
+        Apply a minute bar. Returns (closed, candle): `closed` is the candle that the bar closed,
+        as (start, open, high, low, close, volume), or None; `candle` is the open candle.
+        """
+        timestamp = int(timestamp)
+        values = (float(open_), float(high), float(low), float(close), float(volume))
+        closed = None
+        if self.candle_start is None or not self.candle_start <= timestamp < self._candle_end:
+            if self.candle_start is not None and timestamp < self.candle_start:
+                raise ValueError("Minute bars must arrive in time order")
+            closed = self.candle()
+            self._open_candle(timestamp)
+            self._base, self._minute = None, (timestamp, values)
+        elif timestamp == self._minute[0]:
+            self._minute = (timestamp, values)
+        elif timestamp > self._minute[0]:
+            self._base = self._combine(self._base, self._minute[1])
+            self._minute = (timestamp, values)
+        else:
+            raise ValueError("Minute bars must arrive in time order")
+        return closed, self.candle()
+
+    def candle(self):
+        """The open candle as (start, open, high, low, close, volume), or None."""
+        if self._minute is None:
+            return None
+        return (self.candle_start, *self._combine(self._base, self._minute[1]))
+
+    def _open_candle(self, timestamp):
+        self.candle_start = int(bucket_starts([timestamp], self.timeframe, self.tz, self.session_open)[0])
+        # Candles never run past local midnight, which is not always 24h away across DST changes
+        local_start = pd.Timestamp(self.candle_start, tz='UTC').tz_convert(self.tz)
+        next_midnight = int((local_start.normalize() + pd.DateOffset(days=1)).as_unit('ns').value)
+        length = TIMEFRAMES[self.timeframe]
+        if length is None:
+            self._candle_end = next_midnight
+        else:
+            self._candle_end = min(self.candle_start + length * NS_PER_SECOND, next_midnight)
+
+    @staticmethod
+    def _combine(base, values):
+        if base is None:
+            return values
+        return (base[0], max(base[1], values[1]), min(base[2], values[2]), values[3], base[4] + values[4])